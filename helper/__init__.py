@@ -15,6 +15,7 @@
 #   along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import sys
+import codecs
 import logging
 import subprocess
 
@@ -69,10 +70,12 @@ LOGGER.addHandler(FH)
 LOGGER.info("----- %s : Starting Android Helper v%s -----", strftime("%Y-%m-%d %H:%M:%S"), VERSION)
 
 
-def exe(executable, *args, return_output=False, as_list=False, stdout_=sys.stdout):
+def exe(executable, *args, return_output=False, as_list=False, stdout_=None):
     """Run provided file as executable.
     Return string containing the output of executed command.
     """
+    if stdout_ is None:
+        stdout_ = sys.stdout
     LOGGER.debug("Executing %s %s", executable.name, args)
     try:
         if return_output:
@@ -96,41 +99,110 @@ def exe(executable, *args, return_output=False, as_list=False, stdout_=sys.stdou
             cmd_out = subprocess.Popen((executable.__fspath__(),) + args,
                                        stdout=subprocess.PIPE,
                                        stderr=subprocess.STDOUT)
-            lines = iter(cmd_out.stdout.readline, b'')
-            while cmd_out.poll() is None:
-                for line in lines:
-                    stdout_.write(line.decode("utf-8", "replace"))
+            for line in iter(cmd_out.stdout.readline, b''):
+                stdout_.write(line.decode("utf-8", "replace"))
+            cmd_out.wait()
         else:
             subprocess.run((executable.__fspath__(),) + args)
 
         return ""
-    except PermissionError:
+    except OSError as error:
+        _exe_error(executable, error, stdout_)
+
+
+def _exe_error(executable, error, stdout_=None):
+    """Report an error encountered while trying to run an executable
+    and exit.
+    """
+    if stdout_ is None:
+        stdout_ = sys.stdout
+    if isinstance(error, PermissionError):
         if executable.is_dir():
             stdout_.write("ERROR: Provided path points to a directory and not a file")
         else:
             stdout_.write(
                 "ERROR: Could not execute the provided binary due permission error!\n"
                 "   Please make sure the current user has necessary permissions!\n")
-        stdout_.write(f"    {executable}")
-        sys.exit()
-    except FileNotFoundError:
+    elif isinstance(error, FileNotFoundError):
         stdout_.write(
             f"ERROR: Executable does not exist: {executable}\n")
-        stdout_.write(f"    {executable}")
-        sys.exit()
-    except OSError as error:
+    else:
         stdout_.write(
             "ERROR: Could not execute provided file due to an OS Error\n"
-            f"    Executable's path: {AAPT}\n"
+            f"    Executable's path: {executable}\n"
             f"    OSError error number: {error.errno}\n"
             f"    Error message: {error}")
         if error.errno == 8:
             stdout_.write(
                 "    This is most likely because the file is not in executable format!\n")
-        stdout_.write(f"    {executable}")
-        #TODO: should either re-raise the error or throw a custom one
-        # preferrably, sys.exit() should only be thrwon in cli/gui
-        sys.exit()
+    stdout_.write(f"    {executable}")
+    #TODO: should either re-raise the error or throw a custom one
+    # preferrably, sys.exit() should only be thrwon in cli/gui
+    sys.exit()
+
+
+def exe_chunks(executable, *args, chunk_size=65536):
+    """Run provided file as executable.
+    Yield raw output of executed command in chunks of bytes, as soon as
+    they are produced. Unlike exe, the output is never held in memory
+    as a whole.
+    """
+    LOGGER.debug("Executing %s %s", executable.name, args)
+    try:
+        process = subprocess.Popen((executable.__fspath__(),) + args,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+    except OSError as error:
+        _exe_error(executable, error)
+
+    try:
+        while True:
+            chunk = process.stdout.read1(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        process.stdout.close()
+        if process.poll() is None:
+            # generator was closed before the command has finished
+            process.kill()
+        process.wait()
+
+
+def iter_lines(chunks, encoding="utf-8"):
+    """Decode an iterable of byte chunks and yield lines of text,
+    line endings included.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)("replace")
+    pending = ""
+    for chunk in chunks:
+        pending += decoder.decode(chunk)
+        lines = pending.splitlines(keepends=True)
+        # last line is kept until its end arrives
+        # ("\r" can still be followed by "\n")
+        pending = ""
+        if lines and not lines[-1].endswith("\n"):
+            pending = lines.pop()
+        yield from lines
+
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield from pending.splitlines(keepends=True)
+
+
+def write_chunks(chunks, out_file):
+    """Write an iterable of byte chunks to a binary file-like object or
+    to a file at given path. Return number of bytes written.
+    """
+    if isinstance(out_file, (str, Path)):
+        with Path(out_file).open(mode="wb") as out_file_:
+            return write_chunks(chunks, out_file_)
+
+    written = 0
+    for chunk in chunks:
+        written += out_file.write(chunk)
+
+    return written
 
 
 
@@ -0,0 +1,492 @@
+"""Client for the adb server's host protocol.
+
+Instead of spawning a new adb client process for every command, this
+module talks to the already running adb server directly over its TCP
+socket (localhost:5037 by default). Requests are sent as a 4-digit hex
+length followed by the request string, the server replies with either
+'OKAY' or 'FAIL' followed by a hex-prefixed error message.
+
+Only a subset of adb's functionality is implemented here, anything
+that is not supported raises UnsupportedCommandError so that callers
+can fall back to the adb executable.
+"""
+import os
+import socket
+import struct
+import logging
+from collections import namedtuple
+
+LOGGER = logging.getLogger(__name__)
+
+ENABLED = True
+ADB_HOST = "127.0.0.1"
+ADB_PORT = int(os.environ.get("ANDROID_ADB_SERVER_PORT", 5037))
+TIMEOUT = 10
+ENCODING = "utf-8"
+# maximum size of a single DATA packet in the sync protocol
+SYNC_DATA_MAX = 64 * 1024
+
+# result of the sync protocol's stat requests
+SyncStat = namedtuple("SyncStat", ("mode", "size", "mtime"))
+# size of replies to STAT (32-bit fields) and LST2 (64-bit fields, needs
+# the stat_v2 feature on device) requests
+SYNC_STAT_SIZE = 16
+SYNC_STAT2_SIZE = 72
+# size of sync responses' id and 32-bit argument
+SYNC_HEADER_SIZE = 8
+# features of devices by serial, read once per serial
+_FEATURES = {}
+
+
+class AdbClientError(Exception):
+    """Base class for all adb client errors."""
+
+
+class AdbConnectionError(AdbClientError):
+    """Could not connect to the adb server."""
+
+
+class AdbCommandError(AdbClientError):
+    """adb server responded with 'FAIL'."""
+
+
+class UnsupportedCommandError(AdbClientError):
+    """Command cannot be handled by this client."""
+
+
+def connect(timeout=TIMEOUT):
+    """Open a new connection to the adb server and return the socket.
+    """
+    if not ENABLED:
+        raise AdbConnectionError("Native adb client is disabled")
+
+    try:
+        return socket.create_connection((ADB_HOST, ADB_PORT), timeout=timeout)
+    except OSError as error:
+        raise AdbConnectionError(
+            f"Could not connect to adb server at {ADB_HOST}:{ADB_PORT} ({error})")
+
+
+def read_exactly(sock, size):
+    """Read exactly 'size' bytes from socket."""
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise AdbClientError(
+                f"Connection closed after {len(data)} of {size} bytes")
+        data += chunk
+
+    return bytes(data)
+
+
+def encode_request(request):
+    """Return host request prefixed with its length as 4 hex digits."""
+    if isinstance(request, str):
+        request = request.encode(ENCODING)
+
+    return b"%04x" % len(request) + request
+
+
+def request_failed(status):
+    """Return True if server's response status is 'FAIL' (and an error
+    message follows), False if it is 'OKAY'.
+    Raise AdbClientError for any other status.
+    """
+    if status == b"OKAY":
+        return False
+
+    if status == b"FAIL":
+        return True
+
+    raise AdbClientError(f"Unexpected response from adb server: {status}")
+
+
+def encode_sync(request_id, data):
+    """Return sync request of id (4 ascii characters), length of data
+    as little-endian 32-bit integer and the data itself.
+    """
+    if isinstance(data, str):
+        data = data.encode(ENCODING)
+
+    return sync_header(request_id, len(data)) + data
+
+
+def sync_header(request_id, argument):
+    """Return sync request id followed by 32-bit argument, used on its
+    own by 'DONE' and 'QUIT' requests.
+    """
+    return request_id + struct.pack("<I", int(argument))
+
+
+def parse_sync_header(header):
+    """Return id and the 32-bit argument of a sync response header."""
+    return struct.unpack("<4sI", header)
+
+
+def read_hex_block(sock):
+    """Read a block of data prefixed with its length as 4 hex digits."""
+    size = int(read_exactly(sock, 4), 16)
+    return read_exactly(sock, size)
+
+
+def send_request(sock, request):
+    """Send a request and check the server's response.
+    Raise AdbCommandError if the server responded with 'FAIL'.
+    """
+    sock.sendall(encode_request(request))
+    if request_failed(read_exactly(sock, 4)):
+        raise AdbCommandError(read_hex_block(sock).decode(ENCODING, "replace"))
+
+
+def host_request(request, timeout=TIMEOUT):
+    """Send a host request (for example 'host:devices') and return the
+    server's decoded reply.
+    """
+    with connect(timeout) as sock:
+        send_request(sock, request)
+        return read_hex_block(sock).decode(ENCODING, "replace")
+
+
+def open_service(serial, service, timeout=TIMEOUT):
+    """Switch to the transport of the given device and open a service
+    on it (for example 'shell:ls' or 'sync:').
+
+    Return connected socket, it is the caller's responsibility to
+    close it.
+    """
+    sock = connect(timeout)
+    try:
+        send_request(sock, f"host:transport:{serial}")
+        send_request(sock, service)
+    except (AdbClientError, OSError):
+        sock.close()
+        raise
+
+    # services such as shell can run for a long time, the timeout is
+    # only meant for establishing the connection
+    sock.settimeout(None)
+    return sock
+
+
+def parse_device_list(device_list):
+    """Parse device list sent by the adb server.
+    Return list of two-element tuples, same as device.get_serials.
+    Tuple[0] = device's serial number
+    Tuple[1] = device's adb status
+    """
+    parsed = []
+    for line in device_list.splitlines():
+        if not line.strip():
+            continue
+        try:
+            serial, status = line.strip().split(maxsplit=1)
+            parsed.append((serial, status))
+        except ValueError:
+            LOGGER.error("Could not split line: %s", line)
+
+    return parsed
+
+
+def devices():
+    """Return list of connected devices and their states."""
+    return parse_device_list(host_request("host:devices"))
+
+
+def parse_features(reply):
+    """Return set of device features from reply to a features request.
+    """
+    return {x.strip() for x in reply.split(",") if x.strip()}
+
+
+def features(serial):
+    """Return set of features supported by device's adbd (for example
+    'stat_v2' or 'shell_v2').
+    """
+    if serial not in _FEATURES:
+        _FEATURES[serial] = parse_features(host_request(f"host-serial:{serial}:features"))
+
+    return _FEATURES[serial]
+
+
+def parse_sync_stat(reply):
+    """Return SyncStat from reply to STAT request, or None if the path
+    does not exist. Size is a 32-bit value, sizes of files over 4GB
+    wrap around.
+    """
+    response_id, mode, size, mtime = struct.unpack("<4sIII", reply)
+    if response_id != b"STAT":
+        raise AdbClientError(f"Unexpected sync response: {response_id}")
+
+    return SyncStat(mode, size, mtime) if mode else None
+
+
+def parse_sync_stat2(reply):
+    """Return SyncStat from reply to LST2 request, or None if the path
+    does not exist.
+    """
+    # id, error, dev, ino, mode, nlink, uid, gid, size, atime, mtime, ctime
+    fields = struct.unpack("<4sIQQIIIIQqqq", reply)
+    if fields[0] != b"LST2":
+        raise AdbClientError(f"Unexpected sync response: {fields[0]}")
+
+    if fields[1] or not fields[4]:
+        return None
+
+    return SyncStat(fields[4], fields[8], fields[10])
+
+
+def track_devices():
+    """Subscribe to device state changes.
+
+    Return a generator yielding the full list of devices (as returned
+    by devices()) every time the state of any device changes, starting
+    with the current state. Connection errors are raised as soon as
+    the generator is advanced for the first time.
+    """
+    sock = connect()
+    try:
+        send_request(sock, "host:track-devices")
+        sock.settimeout(None)
+        while True:
+            yield parse_device_list(read_hex_block(sock).decode(ENCODING, "replace"))
+    finally:
+        sock.close()
+
+
+def shell(serial, *args):
+    """Execute a shell command on device and return its decoded output.
+    Arguments are joined with spaces, just like adb does it.
+    """
+    command = " ".join(str(arg) for arg in args)
+    with open_service(serial, f"shell:{command}") as sock:
+        return b"".join(iter_chunks(sock)).decode(ENCODING, "replace")
+
+
+def exec_command(serial, command, input_file=None, length=None):
+    """Execute a command through the 'exec:' service, which, unlike
+    'shell:', passes data through unchanged in both directions.
+
+    If input_file (a binary file object) is given, length bytes of its
+    contents are sent to the command's stdin. The command must know
+    when to stop reading, as stdin cannot be closed separately from the
+    connection. Return command's decoded output, which is all that was
+    received if the command closed the connection early (for example a
+    package manager rejecting an install).
+    """
+    with open_service(serial, f"exec:{command}") as sock:
+        if input_file is not None:
+            sent = 0
+            try:
+                while sent < length:
+                    chunk = input_file.read(min(SYNC_DATA_MAX, length - sent))
+                    if not chunk:
+                        break
+                    sock.sendall(chunk)
+                    sent += len(chunk)
+            except OSError as error:
+                LOGGER.debug("'%s' stopped reading after %s bytes: %s", command, sent, error)
+
+        output = []
+        try:
+            for chunk in iter_chunks(sock):
+                output.append(chunk)
+        except OSError as error:
+            LOGGER.debug("Lost connection to '%s': %s", command, error)
+
+        return b"".join(output).decode(ENCODING, "replace")
+
+
+def iter_chunks(sock, chunk_size=65536):
+    """Yield data received from socket until the connection is closed.
+    """
+    while True:
+        chunk = sock.recv(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def split_serial(args):
+    """Split adb's command line arguments into the serial number given
+    with '-s' (or None) and the rest of the arguments.
+    """
+    args = list(args)
+    if len(args) > 2 and args[0] == "-s":
+        return args[1], args[2:]
+
+    return None, args
+
+
+def open_shell(args):
+    """Open a shell service for adb command given as a list of adb's
+    command line arguments. Only non-interactive shell commands are
+    supported, UnsupportedCommandError is raised for anything else.
+
+    Return connected socket, which receives command's output.
+    """
+    serial, args = split_serial(args)
+    if not serial or len(args) < 2 or args[0] != "shell":
+        raise UnsupportedCommandError(args)
+
+    LOGGER.debug("Executing natively on %s: %s", serial, args)
+    command = " ".join(str(arg) for arg in args[1:])
+    return open_service(serial, f"shell:{command}")
+
+
+def stream(args):
+    """Execute adb command given as a list of adb's command line
+    arguments and yield its raw output in chunks of bytes.
+
+    The command is started before the generator is returned, so errors
+    are raised right away. Same commands as in open_shell are supported.
+    """
+    try:
+        sock = open_shell(args)
+    except AdbCommandError as error:
+        # mimic the adb executable, which prints errors to output
+        return iter([f"error: {error}\n".encode(ENCODING)])
+
+    def generator():
+        with sock:
+            yield from iter_chunks(sock)
+
+    return generator()
+
+
+def run(args, return_output=False, as_list=False, **kwargs):
+    """Execute adb command given as a list of adb's command line
+    arguments.
+
+    Only commands whose output is returned are supported: 'devices'
+    and non-interactive 'shell' commands. UnsupportedCommandError is
+    raised for everything else, AdbConnectionError is raised if the adb
+    server is not running.
+    """
+    if not return_output:
+        raise UnsupportedCommandError(args)
+
+    if list(args) == ["devices"]:
+        lines = ["List of devices attached"]
+        lines.extend(f"{serial}\t{status}" for serial, status in devices())
+        output = "\n".join(lines) + "\n"
+    else:
+        output = b"".join(stream(args)).decode(ENCODING, "replace")
+
+    if as_list:
+        return output.splitlines()
+
+    return output
+
+
+class SyncConnection:
+    """Connection to a device's file sync service ('sync:').
+
+    Requests are an id (4 ascii characters) followed by the length of
+    data as little-endian 32-bit integer and the data itself.
+    Only one transfer can happen on a connection at a time, open more
+    connections to transfer several files concurrently.
+    """
+    def __init__(self, serial):
+        self.serial = serial
+        self.sock = open_service(serial, "sync:")
+        self._stat_v2 = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+    def close(self):
+        """End the sync session and close the connection."""
+        try:
+            self.sock.sendall(sync_header(b"QUIT", 0))
+        except OSError:
+            pass
+        self.sock.close()
+
+
+    def _send(self, request_id, data):
+        self.sock.sendall(encode_sync(request_id, data))
+
+
+    def _read_response(self):
+        """Return id and the 32-bit argument of next response."""
+        response_id, argument = parse_sync_header(
+            read_exactly(self.sock, SYNC_HEADER_SIZE))
+        if response_id == b"FAIL":
+            raise AdbCommandError(
+                read_exactly(self.sock, argument).decode(ENCODING, "replace"))
+
+        return response_id, argument
+
+
+    @property
+    def stat_v2(self):
+        """True if device supports stat requests with 64-bit sizes."""
+        if self._stat_v2 is None:
+            try:
+                self._stat_v2 = "stat_v2" in features(self.serial)
+            except (AdbClientError, OSError) as error:
+                LOGGER.debug("Could not read features of %s: %s", self.serial, error)
+                self._stat_v2 = False
+
+        return self._stat_v2
+
+
+    def stat(self, remote_path):
+        """Return SyncStat of remote path or None if it does not exist.
+        Sizes of files over 4GB wrap around on devices without stat_v2
+        (see stat_v2 property).
+        """
+        if self.stat_v2:
+            self._send(b"LST2", remote_path)
+            return parse_sync_stat2(read_exactly(self.sock, SYNC_STAT2_SIZE))
+
+        self._send(b"STAT", remote_path)
+        return parse_sync_stat(read_exactly(self.sock, SYNC_STAT_SIZE))
+
+
+    def push(self, local_file, remote_path, mode=0o100644, mtime=0, length=None):
+        """Send contents of binary file object to remote path.
+        If length is given, only that many bytes are sent, starting at
+        the file's current position.
+        Return number of bytes sent.
+        """
+        self._send(b"SEND", f"{remote_path},{mode}")
+        sent = 0
+        while length is None or sent < length:
+            size = SYNC_DATA_MAX if length is None else min(SYNC_DATA_MAX, length - sent)
+            chunk = local_file.read(size)
+            if not chunk:
+                break
+            self._send(b"DATA", chunk)
+            sent += len(chunk)
+
+        self.sock.sendall(sync_header(b"DONE", mtime))
+        response_id, _ = self._read_response()
+        if response_id != b"OKAY":
+            raise AdbClientError(f"Unexpected sync response: {response_id}")
+
+        return sent
+
+
+    def pull(self, remote_path, local_file):
+        """Receive contents of remote path and write them to binary file
+        object. Return number of bytes received.
+        """
+        self._send(b"RECV", remote_path)
+        received = 0
+        while True:
+            response_id, size = self._read_response()
+            if response_id == b"DONE":
+                return received
+            if response_id != b"DATA":
+                raise AdbClientError(f"Unexpected sync response: {response_id}")
+
+            local_file.write(read_exactly(self.sock, size))
+            received += size
@@ -1,9 +1,18 @@
 """Module for analyzing apk packages with aapt"""
 import re
+import csv
+import sys
+import glob
+import json
 import logging
+from time import perf_counter
 from pathlib import Path
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import helper
+import helper.axml
+import helper.cache
+import helper.compat
 
 VERSION = 0.1
 LOGGER = logging.getLogger(__name__)
@@ -75,6 +84,99 @@ API_LEVEL_MATRIX = {
     1  : ("1.0", "BASE", "Base")
 }
 
+# App attributes parsed from the apk and saved in the apk cache
+CACHED_FIELDS = (
+    "app_name", "display_name", "version_name", "version_code",
+    "launchable_activity", "min_sdk", "max_sdk", "target_sdk",
+    "used_permissions", "used_implied_features", "used_opt_features",
+    "used_features", "supported_abis", "supported_texture_compressions",
+)
+OUTPUT_FORMATS = ("report", "jsonl", "csv")
+
+# Tables used for dispatching badging lines on their prefix (text
+# before the first colon). Values are always enclosed in single quotes.
+# prefix : App field, collecting the first value of every line
+BADGING_LISTS = {
+    "uses-feature" : "used_features",
+    "uses-feature-not-required" : "used_opt_features",
+    "supports-gl-texture" : "supported_texture_compressions",
+}
+# prefix : (App field, text preceding the value)
+# collecting pairs of the first value and the value following the text
+BADGING_DICTS = {
+    "uses-permission" : ("used_permissions", " maxSdkVersion='"),
+    "uses-implied-feature" : ("used_implied_features", " reason='"),
+}
+# prefix : ((text preceding the value, App field), ...)
+# only the first line with the prefix is used
+BADGING_FIRST = {
+    "package" : ((" name='", "app_name"),
+                 (" versionCode='", "version_code"),
+                 (" versionName='", "version_name")),
+    "application" : ((" label='", "display_name"),),
+    "sdkVersion" : (("'", "min_sdk"),),
+    "targetSdkVersion" : (("'", "target_sdk"),),
+    "maxSdkVersion" : (("'", "max_sdk"),),
+    "launchable-activity" : ((" name='", "launchable_activity"),),
+}
+
+
+def badging_value(line, needle):
+    """Return quoted value following needle in badging line, or None."""
+    start = line.find(needle)
+    if start == -1:
+        return None
+
+    start += len(needle)
+    end = line.find("'", start)
+    return line[start:end] if end != -1 else None
+
+
+def parse_badging(dump):
+    """Parse output of 'aapt dump badging' in a single pass over its
+    lines, dispatching on the prefix of each line.
+    Return dict of App fields found in the output.
+    """
+    info = {}
+    seen = set()
+    for line in dump.splitlines():
+        prefix, _, rest = line.partition(":")
+        start = rest.find("'") + 1
+        if not start:
+            continue
+
+        field = BADGING_LISTS.get(prefix)
+        if field is not None:
+            info.setdefault(field, []).append(rest[start:rest.find("'", start)])
+            continue
+
+        entry = BADGING_DICTS.get(prefix)
+        if entry is not None:
+            field, needle = entry
+            end = rest.find("'", start)
+            value = ""
+            value_start = rest.find(needle, end)
+            if value_start != -1:
+                value_start += len(needle)
+                value = rest[value_start:rest.find("'", value_start)]
+            info.setdefault(field, {})[rest[start:end]] = value
+            continue
+
+        if prefix in seen:
+            continue
+
+        if prefix in BADGING_FIRST:
+            seen.add(prefix)
+            for needle, field in BADGING_FIRST[prefix]:
+                value = badging_value(rest, needle)
+                if value is not None:
+                    info[field] = value.strip()
+        elif prefix == "native-code":
+            seen.add(prefix)
+            info["supported_abis"] = rest.split("'")[1::2]
+
+    return info
+
 
 def aapt_command(*args, **kwargs):
     """Execute AAPT command."""
@@ -82,10 +184,13 @@ def aapt_command(*args, **kwargs):
 
 
 class App:
+    __slots__ = ("host_path", "device_path") + CACHED_FIELDS
+
     def __init__(self, apk_file):
 
         #basic info
         self.host_path = Path(apk_file)
+        self.device_path = ''
         self.app_name = ''
 
         self.display_name = 'Unknown'
@@ -107,7 +212,23 @@ class App:
         self.supported_abis = ()
         self.supported_texture_compressions = ()
 
-        self.from_file()
+        self.from_cache() or self.from_file()
+
+
+    def from_cache(self):
+        """Load app data from the apk cache.
+        Return True if the apk was found in the cache.
+        """
+        info = helper.cache.load_apk_info(self.host_path)
+        if info is None:
+            return False
+
+        LOGGER.debug("Loaded %s from apk cache", self.host_path)
+        for field in CACHED_FIELDS:
+            if field in info:
+                setattr(self, field, info[field])
+
+        return True
 
 
     def from_device(self, device, limited_init=True):
@@ -126,7 +247,7 @@ class App:
         for key, value in search_group.items():
             extracted = re.search(value, dump)
             if extracted:
-                self.__dict__[key] = extracted.group(1).strip()
+                setattr(self, key, extracted.group(1).strip())
 
         # not much can be read from the app while on device
         # so lets get the app to host and check it out!
@@ -145,53 +266,43 @@ class App:
 
 
     def from_file(self):
-        """Load app data from a local apk file."""
+        """Load app data from a local apk file.
+        The manifest is parsed in-process, aapt is used only for apks
+        which could not be parsed that way.
+        """
+        try:
+            info = helper.axml.read_apk(self.host_path)
+        except helper.axml.AxmlError as error:
+            LOGGER.warning("Could not parse %s, falling back to aapt: %s",
+                           self.host_path, error)
+            self.from_aapt()
+            return
+
+        for field in CACHED_FIELDS:
+            if field in info:
+                setattr(self, field, info[field])
+
+        helper.cache.store_apk_info(
+            self.host_path, {x:getattr(self, x) for x in CACHED_FIELDS})
+
+
+    def from_aapt(self):
+        """Load app data from aapt's dump of a local apk file."""
         dump = aapt_command("dump", "badging", self.host_path.__fspath__(),
                             return_output=True, as_list=False)
 
-        if "error: dump failed" in dump.lower():
+        dump_failed = "error: dump failed" in dump.lower()
+        if dump_failed:
             unknown = f"Unknown! ({self.host_path.name})"
             self.app_name = unknown
             self.display_name = unknown
 
-        search_group = {
-            "app_name" : "(?:name\\=\\')([^\\']*)",
-            "display_name" : "(?:^application\\:\\ label\\=\\')([^\\']*)",
-            "version_name" : "(?:versionName\\=\\')([^\\']*)",
-            "version_code" : "(?:versionCode\\=\\')([^\\']*)",
-            "min_sdk" : "(?:^sdkVersion\\:\\')([^\\']*)",
-            "target_sdk" : "(?:^targetSdkVersion\\:\\')([^\\']*)",
-            "max_sdk" : "(?:^maxSdkVersion\\=\\')([^\\']*)",
-            "supported_abis" : "(?:^native-code\\:\\ )(.*)",
-            "launchable_activity" : "(?:launchable\\-activity\\:\\ name=\\')([^\\']*)",
-            }
-
-        findall_group = {
-            "supported_texture_compressions" : "(?:supports\\-gl\\-texture\\:\\')([^\\']*)",
-            "used_permissions" : "(?:uses\\-permission\\:\\ name\\=\\')([^\\']*)(?:.*max\\-sdkVersion\\=\\')?([^\\']*)",
-            "used_implied_features" : "(?:uses\\-implied\\-feature\\:\\ name\\=\\')([^\\']*)(?:.*reason\\=\\')?([^\\']*)",
-            "used_opt_features" : "(?:uses\\-feature\\-not\\-required\\:\\ name\\=\\')([^\\']*)",
-            "used_features" : "(?:uses\\-feature\\:\\ name\\=\\')([^\\']*)",
-            }
-
-        for key, value in search_group.items():
-            extracted = re.search(value, dump, re.M)
-            if extracted:
-                self.__dict__[key] = extracted.group(1).strip()
-
-        for key, value in findall_group.items():
-            extracted = re.findall(value, dump, re.M)
-            if extracted:
-                self.__dict__[key] = extracted
-
-        if self.supported_abis:
-            self.supported_abis = self.supported_abis.replace("'", "").strip().split()
-
-        if self.used_implied_features:
-            self.used_implied_features = dict(self.used_implied_features)
+        for field, value in parse_badging(dump).items():
+            setattr(self, field, value)
 
-        if self.used_permissions:
-            self.used_permissions = dict(self.used_permissions)
+        if not dump_failed and self.app_name:
+            helper.cache.store_apk_info(
+                self.host_path, {x:getattr(self, x) for x in CACHED_FIELDS})
 
 
     def check_compatibility(self, device):
@@ -208,62 +319,14 @@ class App:
         the app crashing or certain functionality being inaccessible by
         the user.
         """
-        compatible = True
-        reasons = []
-        # Ensure the necessary data is available
-        device.extract_data(limit_to=("os", "chipset", "gpu", "features"))
-
-        # check if device uses a supported Android version
-        device_sdk = device.info_dict["android_api_level"]
-        if int(self.min_sdk):
-            if int(self.min_sdk) > int(device_sdk):
-                compatible = False
-                reasons.append(
-                    f"API level of at least {self.min_sdk} is required but "
-                    f"the device uses {device_sdk}")
-
-        if int(self.max_sdk):
-            if int(device_sdk) > int(self.max_sdk):
-                compatible = False
-                reasons.append(
-                    f"API level of at most {self.max_sdk} is allowed but "
-                    f"the device uses {device_sdk}")
-
-        # check if device uses one of supported abis
-        if self.supported_abis:
-            device_abis = device.info_dict["cpu_abis"]
-            unique_abis = set(list(device_abis) + self.supported_abis)
-            all_abis = list(device_abis) + self.supported_abis
-
-            # if len(unique_abis) == len(all_abis), then there is
-            # no overlap between device's and app's abis
-            if not len(unique_abis) < len(all_abis):
-                compatible = False
-                reasons.append(
-                    f"Device does not use supported abis ({self.supported_abis})")
-
-        # check if device uses one of supported texture compressions
-        if self.supported_texture_compressions:
-            unique_textures = set(list(device.info_dict["gles_extensions"] \
-                                  + self.supported_texture_compressions))
-            all_textures = list(device.info_dict["gles_extensions"]) \
-                           + self.supported_texture_compressions
-
-            # just like with abis
-            if not len(unique_textures) < len(all_textures):
-                compatible = False
-                reasons.append(
-                    f"Device does not use supported texture compressions"
-                    f"{self.supported_texture_compressions}")
-
-        # check if all features are available
-        for feature in self.used_features:
-            if feature not in device.info_dict["device_features"]:
-                compatible = False
-                reasons.append(
-                    f"Feature {feature} not available on device")
-
-        return (compatible, reasons)
+        return helper.compat.check_matrix([self], [device])[0][0]
+
+
+    def to_dict(self):
+        """Return dict of all app info, with host path as a string."""
+        info = {"path":str(self.host_path)}
+        info.update((x, getattr(self, x)) for x in CACHED_FIELDS)
+        return info
 
 
     def get_report(self, extended=False, indent=4):
@@ -321,20 +384,165 @@ class App:
         return "\n".join(lines)
 
 
+def has_magic(pattern):
+    """Return True if pattern contains glob's special characters."""
+    return any(x in pattern for x in "*?[")
+
+
+def find_apks(patterns):
+    """Return list of apk paths from given files, directories (searched
+    recursively) and glob patterns.
+    """
+    paths = []
+    for pattern in patterns:
+        if Path(pattern).is_dir():
+            paths.extend(sorted(Path(pattern).rglob("*.apk")))
+        elif has_magic(pattern):
+            paths.extend(Path(x) for x in sorted(glob.glob(pattern, recursive=True))
+                         if Path(x).is_file())
+        else:
+            paths.append(Path(pattern))
+
+    return paths
+
+
+def inspect_apk(apk_path):
+    """Return App loaded from apk file, the time it took and the apk's
+    record for helper.cache.store_apk_infos.
+    """
+    if not Path(apk_path).is_file():
+        raise FileNotFoundError(f"No such file: {apk_path}")
+
+    start = perf_counter()
+    app = App(apk_path)
+    return app, perf_counter() - start, helper.cache.apk_file_record(apk_path)
+
+
+def _init_inspector():
+    """Initialize process of bulk_inspect's pool. Only the parent
+    process writes the apk cache, as processes writing it at the same
+    time would overwrite each other's entries.
+    """
+    helper.cache.APK_CACHE_READ_ONLY = True
+
+
+def csv_value(value):
+    """Return App field's value flattened into a single csv cell."""
+    if isinstance(value, dict):
+        value = list(value)
+    if isinstance(value, (list, tuple)):
+        return ";".join(value)
+    return value
+
+
+def bulk_inspect(apk_paths, output_format="jsonl", jobs=None,
+                 stdout_=None, stderr_=None):
+    """Inspect apks in a pool of processes and write info of each one
+    as soon as it is available, in the order they finish.
+
+    Output format is either "jsonl" (one JSON object per line), "csv" or
+    "report" (App.get_report). Summary timings are written to stderr_.
+    Return number of apks which could not be inspected.
+    """
+    if stdout_ is None:
+        stdout_ = sys.stdout
+    if stderr_ is None:
+        stderr_ = sys.stderr
+
+    start = perf_counter()
+    writer = None
+    if output_format == "csv":
+        writer = csv.DictWriter(stdout_, ("path",) + CACHED_FIELDS)
+        writer.writeheader()
+
+    failed = []
+    timings = []
+    cache_records = []
+    with ProcessPoolExecutor(jobs, initializer=_init_inspector) as executor:
+        futures = {executor.submit(inspect_apk, x):x for x in apk_paths}
+        for future in as_completed(futures):
+            try:
+                app, elapsed, file_record = future.result()
+            except Exception as error:
+                LOGGER.debug("Could not inspect %s", futures[future], exc_info=True)
+                failed.append(futures[future])
+                stderr_.write(f"ERROR: Could not inspect {futures[future]}: {error}\n")
+                continue
+
+            timings.append((elapsed, app.host_path))
+            if file_record and app.app_name and not app.app_name.startswith("Unknown"):
+                cache_records.append(
+                    (app.host_path, file_record, {x:getattr(app, x) for x in CACHED_FIELDS}))
+            if output_format == "csv":
+                writer.writerow({key:csv_value(value)
+                                 for key, value in app.to_dict().items()})
+            elif output_format == "jsonl":
+                stdout_.write(json.dumps(app.to_dict()) + "\n")
+            else:
+                stdout_.write(app.get_report(True) + "\n\n")
+            stdout_.flush()
+
+    helper.cache.store_apk_infos(cache_records)
+    total = perf_counter() - start
+    stderr_.write(f"Inspected {len(timings)} apks in {total:.2f}s")
+    if failed:
+        stderr_.write(f", {len(failed)} failed")
+    stderr_.write("\n")
+    if timings:
+        slowest = max(timings)
+        stderr_.write(
+            f"Time per apk: {sum(x[0] for x in timings) / len(timings):.3f}s average, "
+            f"{slowest[0]:.3f}s slowest ({slowest[1]})\n")
+
+    return len(failed)
+
+
+def job_count(value):
+    """Type of --jobs arguments, integers of 0 or more. 0 stands for the
+    default number of jobs.
+    """
+    try:
+        jobs = int(value)
+    except ValueError:
+        raise ArgumentTypeError(f"invalid number of jobs: '{value}'")
+    if jobs < 0:
+        raise ArgumentTypeError(f"number of jobs cannot be negative: '{value}'")
+    return jobs
+
+
 def main(arguments=None):
     parser = ArgumentParser(prog="ApkInspector")
-    parser.add_argument("apk")
+    parser.add_argument(
+        "apk", nargs="+",
+        help="Apk files, directories with apks or glob patterns.")
+    parser.add_argument(
+        "-f", "--format", choices=OUTPUT_FORMATS, default="report",
+        help="Output format, with jsonl and csv apks are inspected in bulk.")
+    parser.add_argument(
+        "-j", "--jobs", type=job_count, default=0,
+        help="""Number of processes used in bulk inspection. By default, one
+        process per CPU is used.""")
     parser.add_argument(
         "-v", "--version", action="version", version="%(prog)s {}".format(VERSION))
 
     args = parser.parse_args(arguments)
 
-    if not Path(args.apk).is_file:
-        print("ERROR: provided path is not a file")
-        print(f"    : {args.apk}")
+    if len(args.apk) == 1 and args.format == "report" \
+            and not Path(args.apk[0]).is_dir() and not has_magic(args.apk[0]):
+        if not Path(args.apk[0]).is_file():
+            print("ERROR: provided path is not a file")
+            print(f"    : {args.apk[0]}")
+            return
+
+        print(App(args.apk[0]).get_report(True))
+        return
+
+    apk_paths = find_apks(args.apk)
+    if not apk_paths:
+        print("ERROR: no apks found")
         return
 
-    print(App(args.apk).get_report(True))
+    bulk_inspect(apk_paths, args.format, args.jobs or None)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,446 @@
+"""asyncio counterpart of helper.device.
+
+AsyncDevice talks to the adb server over asyncio streams, so a single
+event loop can run commands on many devices at once, without a thread
+per device. When the server cannot be reached directly, the adb
+executable is run as an asyncio subprocess instead.
+
+Extracted info is kept in a regular helper.device.Device, available as
+AsyncDevice.device, so both share the same info_dict and extraction
+functions.
+"""
+import re
+import uuid
+import asyncio
+import logging
+import functools
+from pathlib import Path
+
+import helper
+import helper.device
+import helper.adb_client
+import helper.extract_data
+from helper.adb_client import (
+    AdbClientError, AdbCommandError, AdbConnectionError, SyncStat, ENCODING, SYNC_DATA_MAX,
+    SYNC_HEADER_SIZE, SYNC_STAT_SIZE, SYNC_STAT2_SIZE, encode_request, encode_sync,
+    parse_sync_header, request_failed, sync_header)
+from helper.device import DeviceOfflineError
+
+LOGGER = logging.getLogger(__name__)
+
+# maximum number of connections opened at the same time for one device
+MAX_CONNECTIONS = 16
+
+
+async def connect():
+    """Open a new connection to the adb server.
+    Return asyncio stream reader and writer.
+    """
+    if not helper.adb_client.ENABLED:
+        raise AdbConnectionError("Native adb client is disabled")
+
+    host, port = helper.adb_client.ADB_HOST, helper.adb_client.ADB_PORT
+    try:
+        return await asyncio.wait_for(
+            asyncio.open_connection(host, port), helper.adb_client.TIMEOUT)
+    except (OSError, asyncio.TimeoutError) as error:
+        raise AdbConnectionError(
+            f"Could not connect to adb server at {host}:{port} ({error})")
+
+
+async def read_exactly(reader, size):
+    """Read exactly 'size' bytes from stream."""
+    try:
+        return await reader.readexactly(size)
+    except asyncio.IncompleteReadError as error:
+        raise AdbClientError(
+            f"Connection closed after {len(error.partial)} of {size} bytes")
+
+
+async def send_request(reader, writer, request):
+    """Send a request and check the server's response.
+    Raise AdbCommandError if the server responded with 'FAIL'.
+    """
+    writer.write(encode_request(request))
+    await writer.drain()
+    if request_failed(await read_exactly(reader, 4)):
+        size = int(await read_exactly(reader, 4), 16)
+        message = (await read_exactly(reader, size)).decode(ENCODING, "replace")
+        raise AdbCommandError(message)
+
+
+async def open_service(serial, service):
+    """Switch to the transport of the given device and open a service
+    on it. Return stream reader and writer, it is the caller's
+    responsibility to close the writer.
+    """
+    reader, writer = await connect()
+    try:
+        try:
+            await send_request(reader, writer, f"host:transport:{serial}")
+        except AdbCommandError as error:
+            # device is missing or offline
+            raise DeviceOfflineError(f"{error}", serial)
+        await send_request(reader, writer, service)
+    except (DeviceOfflineError, AdbClientError, OSError):
+        writer.close()
+        raise
+
+    return reader, writer
+
+
+async def run_adb(*args, input_path=None):
+    """Run the adb executable and return its decoded output.
+    If input_path is given, contents of that file are sent to its stdin.
+    """
+    LOGGER.debug("Executing adb %s", args)
+    stdin = None
+    if input_path is not None:
+        stdin = Path(input_path).open(mode="rb")
+    try:
+        process = await asyncio.create_subprocess_exec(
+            helper.ADB.__fspath__(), *[str(x) for x in args], stdin=stdin,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+        output, _ = await process.communicate()
+    finally:
+        if stdin is not None:
+            stdin.close()
+
+    return output.decode(ENCODING, "replace")
+
+
+class AsyncDevice:
+    """Awaitable interface to a physical Android device."""
+    def __init__(self, serial, device=None):
+        self.serial = serial
+        self.device = device if device is not None else helper.device.Device(serial)
+        self._semaphore = None
+
+
+    @property
+    def info_dict(self):
+        """info_dict of the underlying Device."""
+        return self.device.info_dict
+
+
+    @property
+    def semaphore(self):
+        """Semaphore limiting the number of concurrent connections."""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(MAX_CONNECTIONS)
+        return self._semaphore
+
+
+    async def _service_output(self, service, input_file=None, length=None):
+        """Open a service on device, optionally send length bytes of
+        binary file object input_file to it and return its output.
+        """
+        async with self.semaphore:
+            reader, writer = await open_service(self.serial, service)
+            try:
+                if input_file is not None:
+                    sent = 0
+                    try:
+                        while sent < length:
+                            chunk = input_file.read(min(SYNC_DATA_MAX, length - sent))
+                            if not chunk:
+                                break
+                            writer.write(chunk)
+                            await writer.drain()
+                            sent += len(chunk)
+                    except OSError as error:
+                        # output of the command explains why it stopped reading
+                        LOGGER.debug("'%s' stopped reading after %s bytes: %s",
+                                     service, sent, error)
+
+                return (await reader.read()).decode(ENCODING, "replace")
+            finally:
+                writer.close()
+
+
+    async def shell(self, *args):
+        """Execute a shell command and return its output.
+        Arguments are joined with spaces, like adb does it.
+        """
+        self.device._forget_stats(args)
+        command = " ".join(str(arg) for arg in args)
+        try:
+            return await self._service_output(f"shell:{command}")
+        except AdbConnectionError as error:
+            LOGGER.debug("Falling back to adb executable: %s", error)
+
+        return await run_adb("-s", self.serial, "shell", *args)
+
+
+    async def exec_command(self, command, input_path=None):
+        """Execute a command through adb's 'exec:' service, sending
+        contents of file at input_path to its stdin.
+        Return command's output.
+        """
+        self.device._forget_stats([command])
+        try:
+            if input_path is None:
+                return await self._service_output(f"exec:{command}")
+
+            size = Path(input_path).stat().st_size
+            with Path(input_path).open(mode="rb") as input_file:
+                return await self._service_output(f"exec:{command}", input_file, size)
+        except AdbConnectionError as error:
+            LOGGER.debug("Falling back to adb executable: %s", error)
+
+        return await run_adb("-s", self.serial, "shell", command, input_path=input_path)
+
+
+    async def _stat_v2(self):
+        """Return True if device supports stat requests with 64-bit
+        sizes.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            features = await loop.run_in_executor(
+                None, helper.adb_client.features, self.serial)
+        except (AdbClientError, OSError) as error:
+            LOGGER.debug("Could not read features of %s: %s", self.serial, error)
+            return False
+
+        return "stat_v2" in features
+
+
+    async def _sync_stat(self, reader, writer, remote_path, stat_v2=False):
+        """Return SyncStat of remote path. Sizes of files over 4GB wrap
+        around unless stat_v2 is true.
+        """
+        request_id = b"LST2" if stat_v2 else b"STAT"
+        writer.write(encode_sync(request_id, str(remote_path)))
+        await writer.drain()
+        if stat_v2:
+            return helper.adb_client.parse_sync_stat2(
+                await read_exactly(reader, SYNC_STAT2_SIZE))
+
+        return helper.adb_client.parse_sync_stat(
+            await read_exactly(reader, SYNC_STAT_SIZE))
+
+
+    async def _shell_stat(self, remote_path):
+        """Return SyncStat of a file on device, read with shell's stat.
+        """
+        out = (await self.shell(helper.device.SH_STAT.format(
+            helper.device.shell_quote(remote_path)))).split()
+        try:
+            return SyncStat(int(out[0], 16), int(out[1]), int(out[2]))
+        except (IndexError, ValueError):
+            return None
+
+
+    async def _sync_response(self, reader):
+        response_id, argument = parse_sync_header(
+            await read_exactly(reader, SYNC_HEADER_SIZE))
+        if response_id == b"FAIL":
+            raise AdbCommandError(
+                (await read_exactly(reader, argument)).decode(ENCODING, "replace"))
+
+        return response_id, argument
+
+
+    async def _sync(self, function, *args):
+        """Open a sync session, run coroutine function with its reader,
+        writer and args, then end the session.
+        """
+        async with self.semaphore:
+            reader, writer = await open_service(self.serial, "sync:")
+            try:
+                result = await function(reader, writer, *args)
+                writer.write(sync_header(b"QUIT", 0))
+                await writer.drain()
+                return result
+            finally:
+                writer.close()
+
+
+    async def stat(self, remote_path):
+        """Return SyncStat of a file on device, or None if it does not
+        exist.
+        """
+        try:
+            if await self._stat_v2():
+                return await self._sync(self._sync_stat, remote_path, True)
+        except AdbConnectionError as error:
+            LOGGER.debug("Falling back to adb executable: %s", error)
+
+        # sizes reported by the old STAT request are 32-bit, but toolbox's
+        # stat of Android 5 and older does not support -c
+        remote_stat = await self._shell_stat(remote_path)
+        if remote_stat is not None:
+            return remote_stat
+
+        try:
+            return await self._sync(self._sync_stat, remote_path)
+        except AdbConnectionError as error:
+            LOGGER.debug("Could not stat %s: %s", remote_path, error)
+            return None
+
+
+    async def push(self, local_path, remote_path):
+        """Copy a local file to device.
+        Return SyncStat of the pushed file, or None if it could not be
+        copied.
+        """
+        self.device._stat_cache.clear()
+        local_path = Path(local_path)
+
+        async def send(reader, writer):
+            local_stat = local_path.stat()
+            writer.write(encode_sync(b"SEND", f"{remote_path},{local_stat.st_mode}"))
+            with local_path.open(mode="rb") as local_file:
+                while True:
+                    chunk = local_file.read(SYNC_DATA_MAX)
+                    if not chunk:
+                        break
+                    writer.write(encode_sync(b"DATA", chunk))
+                    await writer.drain()
+            writer.write(sync_header(b"DONE", local_stat.st_mtime))
+            await writer.drain()
+            response_id, _ = await self._sync_response(reader)
+            if response_id != b"OKAY":
+                raise AdbClientError(f"Unexpected sync response: {response_id}")
+
+        try:
+            await self._sync(send)
+            return await self.stat(remote_path)
+        except AdbConnectionError as error:
+            LOGGER.debug("Falling back to adb executable: %s", error)
+        except (AdbClientError, OSError) as error:
+            LOGGER.error("Could not push %s to %s: %s", local_path, remote_path, error)
+            return None
+
+        await run_adb("-s", self.serial, "push", local_path, remote_path)
+        return await self.stat(remote_path)
+
+
+    async def pull(self, remote_path, local_path):
+        """Copy a file from device.
+        Return SyncStat of the copied remote file, or None if it does
+        not exist or could not be copied.
+        """
+        local_path = Path(local_path)
+
+        async def receive(reader, writer, stat_v2):
+            remote_stat = await self._sync_stat(reader, writer, remote_path, stat_v2)
+            if remote_stat is None:
+                return None
+
+            writer.write(encode_sync(b"RECV", str(remote_path)))
+            await writer.drain()
+            with local_path.open(mode="wb") as local_file:
+                while True:
+                    response_id, size = await self._sync_response(reader)
+                    if response_id == b"DONE":
+                        return remote_stat
+                    if response_id != b"DATA":
+                        raise AdbClientError(f"Unexpected sync response: {response_id}")
+                    local_file.write(await read_exactly(reader, size))
+
+        try:
+            stat_v2 = await self._stat_v2()
+            remote_stat = await self._sync(receive, stat_v2)
+            if remote_stat is not None and not stat_v2:
+                # sizes reported by the old STAT request are 32-bit
+                remote_stat = await self._shell_stat(remote_path) or remote_stat
+            return remote_stat
+        except AdbConnectionError as error:
+            LOGGER.debug("Falling back to adb executable: %s", error)
+        except (AdbClientError, OSError) as error:
+            LOGGER.error("Could not pull %s: %s", remote_path, error)
+            if local_path.exists():
+                local_path.unlink()
+            return None
+
+        remote_stat = await self.stat(remote_path)
+        if remote_stat is None:
+            return None
+
+        await run_adb("-s", self.serial, "pull", remote_path, local_path)
+        return remote_stat if local_path.is_file() else None
+
+
+    async def extract_data(self, limit_to=(), force_extract=False, keys=()):
+        """Extract info groups into info_dict, see Device.extract_data.
+
+        Outputs of all needed info sources are fetched asynchronously,
+        extraction functions are then run in the default executor, so
+        that they do not block the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        device = self.device
+        _, groups = await loop.run_in_executor(None, functools.partial(
+            device._pending_groups, limit_to, force_extract, keys))
+        if not groups:
+            return
+
+        group_names = [name for name, function in groups]
+        source_names = [x for x in helper.extract_data.sources_for_groups(group_names)
+                        if x not in device._init_cache]
+        marker = f"HELPER_SECTION_{uuid.uuid4().hex}"
+        scripts = helper.extract_data.build_batch_scripts(source_names, marker)
+        for batch_output in await asyncio.gather(*[self.shell(x) for x in scripts]):
+            device._init_cache.update(
+                helper.extract_data.split_batch_output(batch_output, marker))
+
+        await loop.run_in_executor(None, functools.partial(
+            device.extract_data, group_names, force_extract, batch=False))
+
+
+    async def install(self, apk_path, split_paths=(), options=("-r",)):
+        """Install apk (and its splits) by streaming it to the package
+        manager. Single apks are copied to device first on devices older
+        than Android 6.0 (API 23), splits require Android 5.0 (API 21).
+        Return True if installation succeeded.
+        """
+        await self.extract_data(keys=["android_api_level"])
+        api_level = int(self.info_dict["android_api_level"] or 0)
+        if api_level >= 24:
+            package_manager = "cmd package"
+        else:
+            package_manager = "pm"
+        options = " ".join(options)
+        apk_paths = [Path(apk_path)] + [Path(x) for x in split_paths]
+
+        if split_paths and api_level < helper.device.SESSION_INSTALL_MIN_API:
+            LOGGER.error("Split apks can only be installed on Android 5.0 or newer")
+            return False
+
+        if len(apk_paths) == 1 and api_level < helper.device.STREAM_INSTALL_MIN_API:
+            destination = ("/data/local/tmp/helper_" + apk_paths[0].name).replace(" ", "_")
+            if await self.push(apk_paths[0], destination) is None:
+                return False
+            destination = helper.device.shell_quote(destination)
+            process_log = await self.shell("pm", "install", options, destination)
+            await self.shell("rm", destination)
+            return "success" in process_log.lower()
+
+        if len(apk_paths) == 1:
+            size = apk_paths[0].stat().st_size
+            process_log = await self.exec_command(
+                f"{package_manager} install {options} -S {size}", apk_paths[0])
+            return "success" in process_log.lower()
+
+        total_size = sum(x.stat().st_size for x in apk_paths)
+        process_log = await self.exec_command(
+            f"{package_manager} install-create {options} -S {total_size}")
+        session = re.search(r"\[(\d+)\]", process_log)
+        if not session:
+            LOGGER.error("Could not create install session: %s", process_log)
+            return False
+
+        session = session.group(1)
+        for index, path in enumerate(apk_paths):
+            process_log = await self.exec_command(
+                f"{package_manager} install-write -S {path.stat().st_size} {session} {index}.apk -",
+                path)
+            if "success" not in process_log.lower():
+                LOGGER.error("Could not write %s: %s", path, process_log)
+                await self.exec_command(f"{package_manager} install-abandon {session}")
+                return False
+
+        process_log = await self.exec_command(f"{package_manager} install-commit {session}")
+        return "success" in process_log.lower()
@@ -0,0 +1,483 @@
+"""Parser for the binary XML format of compiled AndroidManifest.xml.
+
+Apks contain their manifest compiled into a chunk-based binary format.
+Every chunk starts with a header holding its type, the size of the
+header and the size of the whole chunk. A manifest is a single XML
+chunk, containing a string pool, an optional resource id map and a
+flat sequence of element start/end chunks.
+
+Resource references (app labels mostly) are resolved using
+resources.arsc, of which only the parts necessary to look up string
+values are parsed.
+
+Only the info used by apk.App is extracted. Anything this module
+cannot handle raises AxmlError, in which case aapt should be used
+instead.
+"""
+import struct
+import logging
+import zipfile
+import zlib
+
+LOGGER = logging.getLogger(__name__)
+
+MANIFEST_NAME = "AndroidManifest.xml"
+RESOURCES_NAME = "resources.arsc"
+
+# chunk types
+RES_STRING_POOL_TYPE = 0x0001
+RES_TABLE_TYPE = 0x0002
+RES_XML_TYPE = 0x0003
+RES_XML_START_NAMESPACE_TYPE = 0x0100
+RES_XML_END_NAMESPACE_TYPE = 0x0101
+RES_XML_START_ELEMENT_TYPE = 0x0102
+RES_XML_END_ELEMENT_TYPE = 0x0103
+RES_XML_RESOURCE_MAP_TYPE = 0x0180
+RES_TABLE_PACKAGE_TYPE = 0x0200
+RES_TABLE_TYPE_TYPE = 0x0201
+
+# string pool flags
+UTF8_FLAG = 1 << 8
+
+# types of attribute values
+TYPE_NULL = 0x00
+TYPE_REFERENCE = 0x01
+TYPE_STRING = 0x03
+TYPE_INT_DEC = 0x10
+TYPE_INT_HEX = 0x11
+TYPE_INT_BOOLEAN = 0x12
+
+# resource table entry and type flags
+FLAG_COMPLEX = 0x0001
+FLAG_SPARSE = 0x01
+FLAG_OFFSET16 = 0x02
+NO_ENTRY = 0xFFFFFFFF
+
+# names of android attributes by resource id, used when an apk's string
+# pool has the attribute names stripped
+ATTRIBUTE_IDS = {
+    0x01010001 : "label",
+    0x01010003 : "name",
+    0x0101020c : "minSdkVersion",
+    0x0101021b : "versionCode",
+    0x0101021c : "versionName",
+    0x01010270 : "targetSdkVersion",
+    0x01010271 : "maxSdkVersion",
+    0x0101028e : "required",
+}
+
+# features implied by permissions, added when the app does not declare
+# them on its own, as aapt does
+# permission : tuple of implied features
+IMPLIED_FEATURES = {
+    "android.permission.CAMERA" : (
+        "android.hardware.camera", "android.hardware.camera.autofocus"),
+    "android.permission.ACCESS_FINE_LOCATION" : (
+        "android.hardware.location.gps", "android.hardware.location"),
+    "android.permission.ACCESS_COARSE_LOCATION" : (
+        "android.hardware.location.network", "android.hardware.location"),
+    "android.permission.ACCESS_MOCK_LOCATION" : ("android.hardware.location",),
+    "android.permission.ACCESS_LOCATION_EXTRA_COMMANDS" : (
+        "android.hardware.location",),
+    "android.permission.INSTALL_LOCATION_PROVIDER" : ("android.hardware.location",),
+    "android.permission.BLUETOOTH" : ("android.hardware.bluetooth",),
+    "android.permission.BLUETOOTH_ADMIN" : ("android.hardware.bluetooth",),
+    "android.permission.RECORD_AUDIO" : ("android.hardware.microphone",),
+    "android.permission.ACCESS_WIFI_STATE" : ("android.hardware.wifi",),
+    "android.permission.CHANGE_WIFI_STATE" : ("android.hardware.wifi",),
+    "android.permission.CHANGE_WIFI_MULTICAST_STATE" : ("android.hardware.wifi",),
+    "android.permission.CALL_PHONE" : ("android.hardware.telephony",),
+    "android.permission.CALL_PRIVILEGED" : ("android.hardware.telephony",),
+    "android.permission.MODIFY_PHONE_STATE" : ("android.hardware.telephony",),
+    "android.permission.PROCESS_OUTGOING_CALLS" : ("android.hardware.telephony",),
+    "android.permission.READ_SMS" : ("android.hardware.telephony",),
+    "android.permission.RECEIVE_SMS" : ("android.hardware.telephony",),
+    "android.permission.RECEIVE_MMS" : ("android.hardware.telephony",),
+    "android.permission.RECEIVE_WAP_PUSH" : ("android.hardware.telephony",),
+    "android.permission.SEND_SMS" : ("android.hardware.telephony",),
+    "android.permission.WRITE_APN_SETTINGS" : ("android.hardware.telephony",),
+    "android.permission.WRITE_SMS" : ("android.hardware.telephony",),
+}
+DEFAULT_FEATURE = "android.hardware.faketouch"
+
+
+class AxmlError(Exception):
+    """Data could not be parsed."""
+
+
+def read_chunk_header(data, offset):
+    """Return type, header size and size of chunk at offset."""
+    try:
+        chunk_type, header_size, size = struct.unpack_from("<HHI", data, offset)
+    except struct.error:
+        raise AxmlError(f"Truncated chunk at offset {offset}")
+
+    if header_size < 8 or size < header_size or offset + size > len(data):
+        raise AxmlError(f"Malformed chunk at offset {offset}")
+
+    return chunk_type, header_size, size
+
+
+def iter_chunks(data, start, end):
+    """Yield offset, type and header size of every chunk between start
+    and end offsets.
+    """
+    offset = start
+    while offset + 8 <= end:
+        chunk_type, header_size, size = read_chunk_header(data, offset)
+        yield offset, chunk_type, header_size
+        offset += size
+
+
+def _string_length(data, offset, utf8):
+    """Return length stored at offset and offset of data following it.
+    Lengths are stored in one or two units (bytes for utf-8, 16-bit
+    words for utf-16), high bit of the first unit marks the long form.
+    """
+    if utf8:
+        length = data[offset]
+        if length & 0x80:
+            return (length & 0x7F) << 8 | data[offset + 1], offset + 2
+        return length, offset + 1
+
+    length, = struct.unpack_from("<H", data, offset)
+    if length & 0x8000:
+        low, = struct.unpack_from("<H", data, offset + 2)
+        return (length & 0x7FFF) << 16 | low, offset + 4
+    return length, offset + 2
+
+
+def parse_string_pool(data, offset):
+    """Return list of strings from string pool chunk at offset."""
+    _, header_size, size = read_chunk_header(data, offset)
+    string_count, _, flags, strings_start, _ = struct.unpack_from(
+        "<IIIII", data, offset + 8)
+    utf8 = bool(flags & UTF8_FLAG)
+    string_offsets = struct.unpack_from(
+        f"<{string_count}I", data, offset + header_size)
+
+    strings = []
+    strings_start += offset
+    try:
+        for string_offset in string_offsets:
+            position = strings_start + string_offset
+            if utf8:
+                # character count followed by byte count
+                _, position = _string_length(data, position, True)
+                length, position = _string_length(data, position, True)
+                strings.append(
+                    data[position:position + length].decode("utf-8", "replace"))
+            else:
+                length, position = _string_length(data, position, False)
+                strings.append(
+                    data[position:position + length * 2].decode("utf-16-le", "replace"))
+    except (IndexError, struct.error):
+        raise AxmlError(f"Malformed string pool at offset {offset}")
+
+    return strings
+
+
+def iter_elements(data):
+    """Parse binary XML document and yield an (event, name, attributes)
+    tuple for every element. Event is either "start" or "end",
+    attributes is a dict of attribute names (without namespaces) and
+    raw values of type tuple (value type, data, string value).
+    """
+    chunk_type, header_size, size = read_chunk_header(data, 0)
+    if chunk_type != RES_XML_TYPE:
+        raise AxmlError(f"Not a binary XML document (chunk type {chunk_type:#x})")
+
+    strings = []
+    resource_ids = ()
+    for offset, chunk_type, chunk_header_size in iter_chunks(data, header_size, size):
+        if chunk_type == RES_STRING_POOL_TYPE:
+            strings = parse_string_pool(data, offset)
+        elif chunk_type == RES_XML_RESOURCE_MAP_TYPE:
+            _, _, chunk_size = read_chunk_header(data, offset)
+            count = (chunk_size - chunk_header_size) // 4
+            resource_ids = struct.unpack_from(
+                f"<{count}I", data, offset + chunk_header_size)
+        elif chunk_type == RES_XML_START_ELEMENT_TYPE:
+            name, attributes = _parse_start_element(
+                data, offset + chunk_header_size, strings, resource_ids)
+            yield "start", name, attributes
+        elif chunk_type == RES_XML_END_ELEMENT_TYPE:
+            _, name_index = struct.unpack_from("<II", data, offset + chunk_header_size)
+            yield "end", _get_string(strings, name_index), {}
+
+
+def _get_string(strings, index):
+    if index == NO_ENTRY:
+        return ""
+
+    try:
+        return strings[index]
+    except IndexError:
+        raise AxmlError(f"String index {index} out of range")
+
+
+def _parse_start_element(data, offset, strings, resource_ids):
+    """Return name and attributes of element starting at offset."""
+    (_, name_index, attribute_start, attribute_size,
+     attribute_count) = struct.unpack_from("<IIHHH", data, offset)
+    name = _get_string(strings, name_index)
+
+    attributes = {}
+    position = offset + attribute_start
+    for _ in range(attribute_count):
+        (_, attr_name_index, raw_index, _, _, value_type,
+         value) = struct.unpack_from("<IIIHBBI", data, position)
+        position += attribute_size
+
+        attr_name = _get_string(strings, attr_name_index)
+        if not attr_name and attr_name_index < len(resource_ids):
+            attr_name = ATTRIBUTE_IDS.get(resource_ids[attr_name_index], "")
+
+        string_value = None
+        if value_type == TYPE_STRING:
+            string_value = _get_string(strings, value)
+        elif raw_index != NO_ENTRY:
+            string_value = _get_string(strings, raw_index)
+
+        attributes[attr_name] = (value_type, value, string_value)
+
+    return name, attributes
+
+
+def parse_resource_strings(data):
+    """Return dict of resource ids and string values from resources.arsc.
+    Values from the default configuration are preferred, for resources
+    without one, value from the first configuration is used.
+    """
+    chunk_type, header_size, size = read_chunk_header(data, 0)
+    if chunk_type != RES_TABLE_TYPE:
+        raise AxmlError(f"Not a resource table (chunk type {chunk_type:#x})")
+
+    values = {}
+    default_values = {}
+    strings = []
+    for offset, chunk_type, _ in iter_chunks(data, header_size, size):
+        if chunk_type == RES_STRING_POOL_TYPE:
+            strings = parse_string_pool(data, offset)
+        elif chunk_type == RES_TABLE_PACKAGE_TYPE:
+            _parse_package(data, offset, strings, values, default_values)
+
+    values.update(default_values)
+    return values
+
+
+def _parse_package(data, offset, strings, values, default_values):
+    """Collect string values from resource table package chunk."""
+    _, header_size, size = read_chunk_header(data, offset)
+    package_id, = struct.unpack_from("<I", data, offset + 8)
+    for type_offset, chunk_type, type_header_size in iter_chunks(
+            data, offset + header_size, offset + size):
+        if chunk_type != RES_TABLE_TYPE_TYPE:
+            continue
+
+        type_id, flags, _, entry_count, entries_start = struct.unpack_from(
+            "<BBHII", data, type_offset + 8)
+        config_size, = struct.unpack_from("<I", data, type_offset + 20)
+        # every field of the default configuration is zero
+        config = data[type_offset + 24:type_offset + 20 + config_size]
+        target = default_values if not any(config) else values
+
+        resource_base = package_id << 24 | type_id << 16
+        entries_start += type_offset
+        for index, entry_offset in _iter_entry_offsets(
+                data, type_offset + type_header_size, entry_count, flags):
+            entry = entries_start + entry_offset
+            entry_size, entry_flags = struct.unpack_from("<HH", data, entry)
+            if entry_flags & FLAG_COMPLEX:
+                continue
+
+            _, _, value_type, value = struct.unpack_from(
+                "<HBBI", data, entry + entry_size)
+            if value_type == TYPE_STRING and value < len(strings):
+                target.setdefault(resource_base | index, strings[value])
+
+
+def _iter_entry_offsets(data, offset, entry_count, flags):
+    """Yield index and offset of every entry present in type chunk."""
+    if flags & FLAG_SPARSE:
+        for position in range(offset, offset + entry_count * 4, 4):
+            index, entry_offset = struct.unpack_from("<HH", data, position)
+            yield index, entry_offset * 4
+    elif flags & FLAG_OFFSET16:
+        for index, entry_offset in enumerate(
+                struct.unpack_from(f"<{entry_count}H", data, offset)):
+            if entry_offset != 0xFFFF:
+                yield index, entry_offset * 4
+    else:
+        for index, entry_offset in enumerate(
+                struct.unpack_from(f"<{entry_count}I", data, offset)):
+            if entry_offset != NO_ENTRY:
+                yield index, entry_offset
+
+
+def attribute_value(attribute, resources=None):
+    """Return attribute's value as a string, the way aapt prints it.
+    Return None for references which could not be resolved.
+    """
+    value_type, value, string_value = attribute
+    if string_value is not None:
+        return string_value
+
+    if value_type == TYPE_INT_BOOLEAN:
+        return "true" if value else "false"
+
+    if value_type == TYPE_REFERENCE:
+        if resources is not None and value in resources:
+            return resources[value]
+        return None
+
+    if value_type == TYPE_INT_HEX:
+        return f"{value:#x}"
+
+    # signed integer otherwise
+    return str(value - (1 << 32) if value & 0x80000000 else value)
+
+
+def component_name(package, name):
+    """Return fully qualified name of a component declared in manifest.
+    """
+    if name.startswith("."):
+        return package + name
+    if "." not in name:
+        return f"{package}.{name}"
+    return name
+
+
+def parse_manifest(manifest, resources=None):
+    """Return dict of apk.App fields extracted from binary manifest.
+    Fields not declared in the manifest are left out.
+    """
+    info = {}
+    permissions = {}
+    features = []
+    opt_features = []
+    textures = []
+
+    # name of launchable activity candidate, and whether main action and
+    # launcher category were found in its intent filters
+    activity = None
+    is_main = is_launcher = False
+    path = []
+    for event, name, attributes in iter_elements(manifest):
+        if event == "end":
+            if name in ("activity", "activity-alias"):
+                activity = None
+            elif name == "intent-filter":
+                if activity and is_main and is_launcher:
+                    info.setdefault("launchable_activity", activity)
+                is_main = is_launcher = False
+            if path:
+                path.pop()
+            continue
+
+        path.append(name)
+        values = {}
+        for key, attribute in attributes.items():
+            value = attribute_value(attribute, resources)
+            if value is not None:
+                values[key] = value
+        parent = path[-2] if len(path) > 1 else ""
+
+        if name == "manifest":
+            info["app_name"] = values.get("package", "")
+            for key, field in (("versionCode", "version_code"),
+                               ("versionName", "version_name")):
+                if key in values:
+                    info[field] = values[key]
+        elif name == "uses-sdk":
+            for key, field in (("minSdkVersion", "min_sdk"),
+                               ("targetSdkVersion", "target_sdk"),
+                               ("maxSdkVersion", "max_sdk")):
+                if key in values:
+                    info[field] = values[key]
+        elif name == "application" and "label" in values:
+            info["display_name"] = values["label"]
+        elif name == "uses-permission" and "name" in values:
+            permissions[values["name"]] = values.get("maxSdkVersion", "")
+        elif name == "uses-feature" and "name" in values:
+            if values.get("required") == "false":
+                opt_features.append(values["name"])
+            else:
+                features.append(values["name"])
+        elif name == "supports-gl-texture" and "name" in values:
+            textures.append(values["name"])
+        elif name in ("activity", "activity-alias") and parent == "application":
+            activity = component_name(
+                info.get("app_name", ""), values.get("name", ""))
+        elif name == "action" and parent == "intent-filter":
+            is_main |= values.get("name") == "android.intent.action.MAIN"
+        elif name == "category" and parent == "intent-filter":
+            is_launcher |= values.get("name") == "android.intent.category.LAUNCHER"
+
+    if "app_name" not in info:
+        raise AxmlError("Manifest element not found")
+
+    # same defaults aapt uses
+    if "min_sdk" in info and "target_sdk" not in info:
+        info["target_sdk"] = info["min_sdk"]
+
+    implied = {}
+    for permission in permissions:
+        for feature in IMPLIED_FEATURES.get(permission, ()):
+            if feature in features or feature in opt_features or feature in implied:
+                continue
+            implied[feature] = f"requested {permission} permission"
+
+    if DEFAULT_FEATURE not in features and DEFAULT_FEATURE not in opt_features:
+        implied[DEFAULT_FEATURE] = "default feature for all apps"
+
+    features.extend(implied)
+    info["used_permissions"] = permissions
+    info["used_features"] = features
+    info["used_opt_features"] = opt_features
+    info["used_implied_features"] = implied
+    info["supported_texture_compressions"] = textures
+    return info
+
+
+def native_abis(names):
+    """Return sorted list of ABIs with native libraries in the apk,
+    given the list of names of files in it.
+    """
+    abis = set()
+    for name in names:
+        parts = name.split("/")
+        if len(parts) > 2 and parts[0] == "lib" and parts[1]:
+            abis.add(parts[1])
+
+    return sorted(abis)
+
+
+def read_apk(apk_path):
+    """Return dict of apk.App fields read from apk file.
+    Raise AxmlError if the apk could not be parsed.
+    """
+    try:
+        with zipfile.ZipFile(apk_path) as apk:
+            names = apk.namelist()
+            manifest = apk.read(MANIFEST_NAME)
+            resources = None
+            if RESOURCES_NAME in names:
+                try:
+                    resources = parse_resource_strings(apk.read(RESOURCES_NAME))
+                except (AxmlError, struct.error, IndexError) as error:
+                    LOGGER.warning("Could not parse resources of %s: %s",
+                                   apk_path, error)
+    # RuntimeError is raised for encrypted entries and NotImplementedError
+    # for unsupported compression methods
+    except (OSError, KeyError, zipfile.BadZipFile, zlib.error, RuntimeError,
+            NotImplementedError) as error:
+        raise AxmlError(f"Could not read {apk_path}: {error}")
+
+    try:
+        info = parse_manifest(manifest, resources)
+    except struct.error as error:
+        raise AxmlError(f"Malformed manifest in {apk_path}: {error}")
+
+    info["supported_abis"] = native_abis(names)
+    return info
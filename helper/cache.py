@@ -0,0 +1,336 @@
+"""Persistent on-disk cache for information which rarely changes.
+
+Device info is cached per device, in one JSON file for each serial
+number. Cached info is only valid for as long as device's build
+fingerprint stays the same, so reflashing or updating the device
+invalidates it.
+
+Info parsed from apk files is kept in a single JSON file, keyed by the
+sha256 of the apk's contents. Hashes of known files are remembered
+along with their size and modification time, so unchanged files do
+not even need to be read. Entries are discarded whenever the way apks
+are parsed changes (see APK_CACHE_VERSION), and looking entries up does
+not rewrite the file. Results of compatibility checks are cached
+by apk's sha256 and device's build fingerprint.
+"""
+import os
+import json
+import atexit
+import hashlib
+import logging
+from pathlib import Path
+from time import time
+
+from helper import CWD
+
+LOGGER = logging.getLogger(__name__)
+
+ENABLED = True
+# if true, the apk cache is read but never written, as in processes
+# inspecting apks for helper.apk.bulk_inspect
+APK_CACHE_READ_ONLY = False
+CACHE_DIR = Path(CWD, "cache")
+APK_CACHE_NAME = "apk_metadata.json"
+# least recently used apks are discarded above this many entries
+APK_CACHE_MAX_ENTRIES = 256
+# version of info parsed from apks, entries of other versions are
+# discarded; must be changed whenever parsing of apks changes
+APK_CACHE_VERSION = 2
+COMPATIBILITY_CACHE_NAME = "compatibility.json"
+# oldest results are discarded above this many entries
+COMPATIBILITY_CACHE_MAX_ENTRIES = 4096
+HASH_CHUNK_SIZE = 1024*1024
+
+# info group name : seconds after which cached info is discarded
+# None - info is kept until device's build fingerprint changes
+# 0 - info is never cached
+# groups not listed here are never cached
+GROUP_TTL = {
+    "identity" : None,
+    "chipset" : None,
+    "cpu" : None,
+    "gpu" : None,
+    "display" : None,
+    "features" : None,
+    "available_commands" : None,
+    "storage" : 0,
+    "installed_packages" : 0,
+}
+
+
+def load_json(path):
+    """Return contents of a JSON file, or an empty dict if the file
+    does not exist or cannot be read.
+    """
+    try:
+        with Path(path).open(mode="r", encoding="utf-8") as json_file:
+            return json.load(json_file)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as error:
+        LOGGER.warning("Could not load cache file %s: %s", path, error)
+        return {}
+
+
+def save_json(path, data):
+    """Save data to a JSON file. The file is replaced atomically, so
+    concurrent readers never see a partially written file.
+    """
+    path = Path(path)
+    # temporary file is unique to the process, as the apk cache may be
+    # written to by a pool of processes
+    temp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with temp_path.open(mode="w", encoding="utf-8") as json_file:
+            json.dump(data, json_file)
+        temp_path.replace(path)
+    except OSError as error:
+        LOGGER.warning("Could not save cache file %s: %s", path, error)
+
+
+def device_cache_path(serial):
+    """Return path of the cache file for device with given serial."""
+    filename = "".join([x if x.isalnum() or x in "-_." else "_" for x in serial])
+    return Path(CACHE_DIR, f"device_{filename}.json")
+
+
+def load_device_info(serial, fingerprint, group_name):
+    """Return dict of cached info keys and values for given info group,
+    or None if there is no valid cached info.
+    """
+    ttl = GROUP_TTL.get(group_name, 0)
+    if not ENABLED or not fingerprint or ttl == 0:
+        return None
+
+    cached = load_json(device_cache_path(serial))
+    if cached.get("fingerprint") != fingerprint:
+        return None
+
+    try:
+        group = cached["groups"][group_name]
+    except KeyError:
+        return None
+
+    if ttl is not None and time() - group["time"] > ttl:
+        return None
+
+    return group["info"]
+
+
+def store_device_info(serial, fingerprint, group_name, info):
+    """Save info extracted for given info group.
+    All previously cached info is discarded if device's build
+    fingerprint has changed.
+    """
+    if not ENABLED or not fingerprint or GROUP_TTL.get(group_name, 0) == 0:
+        return
+
+    path = device_cache_path(serial)
+    cached = load_json(path)
+    if cached.get("fingerprint") != fingerprint:
+        cached = {"fingerprint":fingerprint, "groups":{}}
+
+    cached["groups"][group_name] = {"time":time(), "info":info}
+    save_json(path, cached)
+
+
+def file_sha256(path):
+    """Return hex digest of sha256 of file's contents."""
+    digest = hashlib.sha256()
+    with Path(path).open(mode="rb") as hashed_file:
+        for chunk in iter(lambda: hashed_file.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+# hashes of apks computed by this process and times at which cached
+# entries were used, both are saved with the next change of the apk
+# cache or at exit
+_APK_HASHES = {}
+_APK_USAGE = {}
+
+
+def apk_cache_path():
+    """Return path of the apk metadata cache file."""
+    return Path(CACHE_DIR, APK_CACHE_NAME)
+
+
+def _apk_hash(cached, path):
+    """Return sha256 of apk file, reusing the hash remembered for the
+    file if its size and modification time have not changed.
+    """
+    file_stat = path.stat()
+    file_key = [file_stat.st_size, file_stat.st_mtime_ns]
+    for known in (cached["files"].get(str(path)), _APK_HASHES.get(str(path))):
+        if known and known[:2] == file_key:
+            cached["files"][str(path)] = _APK_HASHES[str(path)] = known
+            return known[2]
+
+    sha256 = file_sha256(path)
+    cached["files"][str(path)] = _APK_HASHES[str(path)] = file_key + [sha256]
+    return sha256
+
+
+def _evict_apks(cached):
+    """Discard least recently used entries above APK_CACHE_MAX_ENTRIES,
+    along with remembered files pointing to them.
+    """
+    entries = cached["entries"]
+    excess = len(entries) - APK_CACHE_MAX_ENTRIES
+    if excess > 0:
+        for sha256 in sorted(entries, key=lambda x: entries[x]["used"])[:excess]:
+            del entries[sha256]
+
+    cached["files"] = {
+        path:known for path, known in cached["files"].items() if known[2] in entries}
+
+
+def _load_apk_cache():
+    cached = load_json(apk_cache_path())
+    cached.setdefault("files", {})
+    cached["entries"] = {
+        sha256:entry for sha256, entry in cached.get("entries", {}).items()
+        if entry.get("version") == APK_CACHE_VERSION}
+    return cached
+
+
+def _save_apk_cache(cached):
+    """Save apk cache along with pending times of use of its entries."""
+    if APK_CACHE_READ_ONLY:
+        return
+
+    for sha256, used in _APK_USAGE.items():
+        if sha256 in cached["entries"]:
+            cached["entries"][sha256]["used"] = used
+    _APK_USAGE.clear()
+    _evict_apks(cached)
+    save_json(apk_cache_path(), cached)
+
+
+@atexit.register
+def flush_apk_usage():
+    """Save pending times of use of apk cache entries."""
+    if ENABLED and _APK_USAGE:
+        _save_apk_cache(_load_apk_cache())
+
+
+def apk_sha256(apk_path):
+    """Return sha256 of apk file, or None if it could not be read.
+    Hashes are remembered in the apk cache.
+    """
+    apk_path = Path(apk_path).resolve()
+    cached = _load_apk_cache()
+    known = cached["files"].get(str(apk_path))
+    try:
+        sha256 = _apk_hash(cached, apk_path)
+    except OSError as error:
+        LOGGER.warning("Could not hash apk %s: %s", apk_path, error)
+        return None
+
+    if ENABLED and cached["files"][str(apk_path)] != known:
+        _save_apk_cache(cached)
+
+    return sha256
+
+
+def load_apk_info(apk_path):
+    """Return dict of cached info parsed from apk file, or None if
+    the apk is not in the cache.
+    """
+    if not ENABLED:
+        return None
+
+    apk_path = Path(apk_path).resolve()
+    cached = _load_apk_cache()
+    try:
+        sha256 = _apk_hash(cached, apk_path)
+    except OSError as error:
+        LOGGER.warning("Could not hash apk %s: %s", apk_path, error)
+        return None
+
+    # nothing is saved here, the hash of a missing apk is saved along
+    # with its info and the time of use of a found one is saved later
+    entry = cached["entries"].get(sha256)
+    if entry is None:
+        return None
+
+    _APK_USAGE[sha256] = time()
+    return entry["info"]
+
+
+def store_apk_info(apk_path, info):
+    """Save info parsed from apk file."""
+    if not ENABLED or APK_CACHE_READ_ONLY:
+        return
+
+    apk_path = Path(apk_path).resolve()
+    cached = _load_apk_cache()
+    try:
+        sha256 = _apk_hash(cached, apk_path)
+    except OSError as error:
+        LOGGER.warning("Could not hash apk %s: %s", apk_path, error)
+        return
+
+    _APK_USAGE.pop(sha256, None)
+    cached["entries"][sha256] = {
+        "version":APK_CACHE_VERSION, "used":time(), "info":info}
+    _save_apk_cache(cached)
+
+
+def apk_file_record(apk_path):
+    """Return [size, mtime_ns, sha256] of apk file hashed (or found in
+    the cache) by this process, or None.
+    """
+    return _APK_HASHES.get(str(Path(apk_path).resolve()))
+
+
+def store_apk_infos(records):
+    """Save info of many apks at once. Records are tuples of apk path,
+    its apk_file_record and info parsed from it.
+    """
+    if not ENABLED or APK_CACHE_READ_ONLY or not records:
+        return
+
+    cached = _load_apk_cache()
+    now = time()
+    for apk_path, file_record, info in records:
+        sha256 = file_record[2]
+        cached["files"][str(Path(apk_path).resolve())] = file_record
+        _APK_USAGE.pop(sha256, None)
+        cached["entries"][sha256] = {
+            "version":APK_CACHE_VERSION, "used":now, "info":info}
+    _save_apk_cache(cached)
+
+
+def compatibility_cache_path():
+    """Return path of the compatibility results cache file."""
+    return Path(CACHE_DIR, COMPATIBILITY_CACHE_NAME)
+
+
+def load_compatibility(keys):
+    """Return dict of cached compatibility results for given keys
+    (apk's sha256 and device's fingerprint joined with '/').
+    Results are lists of [compatible, reasons].
+    """
+    if not ENABLED or not keys:
+        return {}
+
+    cached = load_json(compatibility_cache_path())
+    return {key:cached[key] for key in keys if key in cached}
+
+
+def store_compatibility(results):
+    """Save dict of compatibility results, discarding the oldest ones
+    above COMPATIBILITY_CACHE_MAX_ENTRIES.
+    """
+    if not ENABLED or not results:
+        return
+
+    cached = load_json(compatibility_cache_path())
+    cached.update(results)
+    # dicts keep insertion order, so the oldest results are first
+    for key in list(cached)[:max(0, len(cached) - COMPATIBILITY_CACHE_MAX_ENTRIES)]:
+        del cached[key]
+    save_json(compatibility_cache_path(), cached)
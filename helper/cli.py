@@ -1,12 +1,17 @@
 """Command line interface module"""
+import io
 import sys
 import logging
+import threading
 from pathlib import Path
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 
 import helper
+import helper.apk
 import helper.main
 import helper.device
+import helper.shell_session
 
 LOGGER = logging.getLogger(__name__)
 
@@ -17,6 +22,14 @@ PARSER = ArgumentParser(
 )
 PARSER.add_argument(
     "-v", "--version", action="version", version="%(prog)s {}".format(helper.VERSION))
+PARSER.add_argument(
+    "--shell-session", action="store_true",
+    help="""Run shell commands in one long-lived shell on each device, instead
+    of starting a new shell for every command.""")
+PARSER.add_argument(
+    "--wait-timeout", type=float, default=None, metavar="SECONDS",
+    help="""Give up if no device comes online within this many seconds. By
+    default, helper waits indefinitely.""")
 
 COMMANDS = PARSER.add_subparsers(title="Commands", dest="command", metavar="")
 
@@ -34,6 +47,13 @@ OPT_OUTPUT.add_argument(
     will be saved in the same directory helper was launched from.""")
 
 
+OPT_JOBS = ArgumentParser("jobs", add_help=False)
+OPT_JOBS.add_argument(
+    "-j", "--jobs", default=0, type=helper.apk.job_count, metavar="N",
+    help="""Number of devices to work on at the same time. By default, all
+    connected devices are handled at once.""")
+
+
 ### Helper Commands definitions
 CMD = COMMANDS.add_parser(
     "install", parents=[OPT_DEVICE, OPT_OUTPUT], aliases=["i"],
@@ -51,10 +71,21 @@ CMD.add_argument(
     "--obb", nargs="+", metavar="OBB",
     help="Keep data and cache directories when replacing apps.")
 
+CMD.add_argument(
+    "--split", nargs="+", default=(), metavar="APK",
+    help="""Split apks to install along with the base apk, in one install
+    session. Requires Android 5.0 or newer.""")
+
 CMD.add_argument(
     "--keep-data", action="store_true",
     help="Keep data and cache directories when replacing apps.")
 
+CMD.add_argument(
+    "--skip-identical", action="store_true",
+    help="""Do not install the apk if the same version of the app is already
+    installed from identical apk files. Apks are compared by their
+    checksums, which requires sha256sum on the device.""")
+
 CMD.add_argument(
     "--location", choices=["internal", "external"], default="automatic",
     help="""Set the install location to either internal or external SD card. By
@@ -75,7 +106,7 @@ CMD.add_argument(
     functionality.""")
 
 CMD = COMMANDS.add_parser(
-    "clean", parents=[OPT_DEVICE, OPT_OUTPUT], aliases="c",
+    "clean", parents=[OPT_DEVICE, OPT_OUTPUT, OPT_JOBS], aliases="c",
     help="Clean the device storage as per the instructions in cleaner config.",
     epilog=f"""By default, this command removes only helper-created
     files but its behavior can be customized with cleaner config file.
@@ -122,8 +153,19 @@ COMMANDS.add_parser(
     status of all devices connected. If a connection with device could not
     be established, only its serial and connection status is shown.""")
 
+CMD = COMMANDS.add_parser(
+    "compat", parents=[OPT_DEVICE],
+    help="Check if apps are compatible with connected devices.",
+    epilog="""Every apk is checked against every connected device (or only
+    the one chosen with '-d'). Android version, CPU ABIs, texture
+    compressions and required features are compared.""")
+
+CMD.add_argument(
+    "compat", nargs="+", metavar="APK",
+    help="Apk files, directories with apks or glob patterns.")
+
 COMMANDS.add_parser(
-    "dump", aliases=["d"], parents=[OPT_DEVICE, OPT_OUTPUT],
+    "dump", aliases=["d"], parents=[OPT_DEVICE, OPT_OUTPUT, OPT_JOBS],
     help="Dump all available device information to file.",
     epilog="Dump all available device information to file.")
 
@@ -149,7 +191,7 @@ CMD .add_argument(
 
 
 ### Hidden commands
-CMD = COMMANDS.add_parser("debug-dump", parents=[OPT_DEVICE, OPT_OUTPUT])
+CMD = COMMANDS.add_parser("debug-dump", parents=[OPT_DEVICE, OPT_OUTPUT, OPT_JOBS])
 CMD.add_argument("--full", action="store_true")
 COMMANDS.add_parser("run-tests")
 
@@ -259,13 +301,15 @@ def record(device, args):
 
 
 def install(device, args):
-    if not Path(args.install).is_file():
-        print("ERROR: Provided path does not point to an existing file:")
-        print(args.install)
-        return
+    for apk_file in [args.install, *args.split]:
+        if not Path(apk_file).is_file():
+            print("ERROR: Provided path does not point to an existing file:")
+            print(apk_file)
+            return
     helper.main.install(
         device, args.install, args.obb, install_location=args.location,
-        keep_data=args.keep_data, installer_name=args.installer_name)
+        keep_data=args.keep_data, installer_name=args.installer_name,
+        split_files=args.split, skip_identical=args.skip_identical)
 
 
 def pull_traces(device, args):
@@ -287,15 +331,36 @@ def extract_apk(device, args):
             print(out)
 
 
-def clean(device, args):
-    """"""
+def confirm_clean(args):
+    """Validate the cleaner config and ask user for confirmation.
+    This is done once, before any of the devices are cleaned.
+    """
     config_file = args.clean
     if not Path(config_file).is_file():
         print("Provided path does not point to an existing config file:")
         print(config_file)
-        return
+        return False
 
-    helper.main.clean(device, config_file)
+    parsed_config, bad_config = helper.main.parse_cleaner_config(config_file)
+    if bad_config:
+        print(f"Errors encountered in the config file ({config_file}):")
+        print("\n".join(bad_config))
+        print("Aborting cleaning!")
+        return False
+
+    if not parsed_config:
+        print("Empty config! Cannot clean!")
+        return False
+
+    args.parsed_config = parsed_config
+    return helper.main.confirm_clean(parsed_config)
+
+
+def clean(device, args):
+    """"""
+    return helper.main.clean(
+        device, args.clean, parsed_config=args.parsed_config, force=True,
+        stdout_=sys.stdout)
 
 
 def scan(args):
@@ -329,6 +394,25 @@ def scan(args):
         print(format_str.format(*line))
 
 
+def compatibility(args):
+    """"""
+    apk_paths = helper.apk.find_apks(args.compat)
+    if not apk_paths:
+        print("ERROR: No apks found!")
+        return
+
+    devices = helper.device.get_devices(True, ["identity"])
+    if args.device:
+        devices = [device for device in devices if device.serial == args.device]
+
+    if not devices:
+        print()
+        print("No devices detected")
+        return
+
+    helper.main.check_compatibility(apk_paths, devices, sys.stdout)
+
+
 def info_dump(device, args):
     """"""
     device.extract_data(limit_to=["identity"])
@@ -352,34 +436,25 @@ def debug_dump(device, args):
     directory = Path(args.output)
     directory.mkdir(exist_ok=True)
 
-    # this is very silly
-    # make _init_cache getter retrieve the value from immortal_cache
-    # while its setter simply does nothing, which prevents device.get_data from
-    # "deleting" the cache (it does so by assigning an empty dict to _init_cache)
-    # because doing it this way modifies the class definition at runtime and prevents
-    # updating device information (except for methods which skip cache checks
-    # explicitly), helper should exit immediately after data is dumped
-    # The only reason I'm going with this is because I don't want to mess with
-    # device module right now
-    device.immortal_cache = {}
-    helper.device.Device._init_cache = property(
-        lambda self: self.immortal_cache,
-        lambda self, value: None
-    )
     print("-----")
     print("\nDumping", device.name)
     device_dir = Path(directory, (device.filename + "_DUMP"))
     device_dir.mkdir(exist_ok=True)
 
+    # dumped outputs are put in device's _init_cache, so that the info_dict
+    # dumped below is extracted from exactly the same data
     from helper.extract_data import INFO_SOURCES
     for source_name, command in INFO_SOURCES.items():
-        if source_name.startswith("debug") and not args.full:
+        if source_name.startswith("debug"):
+            # debug sources are not used in extraction and can be huge,
+            # so they are spooled straight to disk
+            if args.full:
+                device.shell_to_file(Path(device_dir, source_name), *command)
+                print(".", end="", flush=True)
             continue
 
-        if source_name in device.immortal_cache:
-            output = device.immortal_cache[source_name]
-        else:
-            output = device.shell_command(*command, return_output=True, as_list=False)
+        output = device.shell_command(*command, return_output=True, as_list=False)
+        device._init_cache[source_name] = output
 
         with Path(device_dir, source_name).open(mode="w", encoding="utf-8") as dump_file:
             dump_file.write(output)
@@ -420,9 +495,109 @@ def adb_command(args):
     helper.device.adb_command(*args.command_, return_output=False, check_server=False)
 
 
+class DeviceOutput(io.TextIOBase):
+    """Replacement for sys.stdout used while running commands on
+    multiple devices at once.
+
+    Text written from threads registered with this object is collected
+    in per-thread buffers, everything else is passed to the original
+    stream.
+    """
+    def __init__(self, stream):
+        super().__init__()
+        self.stream = stream
+        self._buffers = {}
+
+
+    def register(self):
+        """Start buffering output of the calling thread."""
+        buffer = io.StringIO()
+        self._buffers[threading.get_ident()] = buffer
+        return buffer
+
+
+    def unregister(self):
+        """Stop buffering output of the calling thread and return the
+        collected text.
+        """
+        return self._buffers.pop(threading.get_ident()).getvalue()
+
+
+    def write(self, text):
+        buffer = self._buffers.get(threading.get_ident())
+        if buffer is None:
+            return self.stream.write(text)
+
+        return buffer.write(text)
+
+
+    def flush(self):
+        self.stream.flush()
+
+
+def run_on_devices(command, devices, args, jobs=0):
+    """Run command on all devices, using up to 'jobs' threads (one for
+    each device by default).
+
+    Each device's output is buffered and printed all at once, with
+    device's serial number prepended to each line. Command is
+    considered to have failed if it raised an exception or returned
+    False.
+
+    Return dict of serial numbers and failure reasons.
+    """
+    failed = {}
+    if len(devices) == 1:
+        device = devices[0]
+        try:
+            if command(device, args) is False:
+                failed[device.serial] = "command failed"
+        except helper.device.DeviceOfflineError:
+            print(f"Device {device.name} has been suddenly disconnected!")
+            failed[device.serial] = "device disconnected"
+
+        return failed
+
+    print_lock = threading.Lock()
+    output = DeviceOutput(sys.stdout)
+
+    def run(device):
+        output.register()
+        try:
+            if command(device, args) is False:
+                failed[device.serial] = "command failed"
+        except helper.device.DeviceOfflineError:
+            print(f"Device {device.name} has been suddenly disconnected!")
+            failed[device.serial] = "device disconnected"
+        except Exception as error:
+            LOGGER.exception("Unhandled exception on device %s", device.serial)
+            failed[device.serial] = f"unexpected error: {error!r}"
+        finally:
+            device_output = output.unregister()
+            with print_lock:
+                for line in device_output.splitlines():
+                    output.stream.write(f"[{device.serial}] {line}\n")
+                output.stream.flush()
+
+    sys.stdout = output
+    try:
+        with ThreadPoolExecutor(max_workers=jobs or len(devices)) as executor:
+            list(executor.map(run, devices))
+    finally:
+        sys.stdout = output.stream
+
+    print()
+    print(f"Finished on {len(devices) - len(failed)} of {len(devices)} devices.")
+    for serial, reason in failed.items():
+        print(f"    {serial}: {reason}")
+
+    return failed
+
+
 COMMAND_DICT = { #command : (function, required_devices),
     #No device commands
     "adb":(adb_command, 0),
+    "compat":(compatibility, 0),
     "run-tests":(run_tests, 0),
     "scan":(scan, 0), "s": (scan, 0),
     #Single device commands
@@ -446,6 +621,7 @@ def main(args=None):
     args = PARSER.parse_args(args)
 
     LOGGER.info("Starting helper with option %s", args.command)
+    helper.shell_session.ENABLED = args.shell_session
 
     if args == PARSER_NO_ARGS:
         PARSER.parse_args(["-h"])
@@ -466,9 +642,12 @@ def main(args=None):
     chosen_device = None
     #FIXME: do not initialize other devices when performing actions on specific device
 
-    #TODO: Implement a timeout
     print("Waiting for any device to come online...")
-    helper.device.adb_command('wait-for-device', return_output=True)
+    # chosen device is looked up afterwards, waiting for its serial would
+    # block indefinitely if it is not connected at all
+    if not helper.device.wait_for_device(None, args.wait_timeout):
+        print(f"No device came online within {args.wait_timeout} seconds!")
+        return
 
     connected_devices = helper.device.get_devices(initialize=False)
     connected_serials = {device.serial:device for device in connected_devices}
@@ -482,7 +661,6 @@ def main(args=None):
                 print(f"Device with serial number {args.device} was not found by Helper!")
                 return
 
-    #TODO: implement concurrent commands
     if required_devices == 1:
         if not chosen_device:
             chosen_device = pick_device()
@@ -495,11 +673,11 @@ def main(args=None):
     if required_devices == 2:
         if chosen_device:
             connected_devices = [chosen_device]
-        for device in connected_devices:
-            try:
-                command(device, args)
-            except helper.device.DeviceOfflineError:
-                print(f"Device {device.name} has been suddenly disconnected!")
+
+        if args.command in ("clean", "c") and not confirm_clean(args):
+            return
+
+        run_on_devices(command, connected_devices, args, args.jobs)
 
 #TODO: Implement screenshot command
 #TODO: Implement keyboard and keyboard-interactive
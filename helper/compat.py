@@ -0,0 +1,231 @@
+"""Compatibility checks of many apks against many devices at once.
+
+ABIs, texture compressions and features of apps and devices are interned
+into bitsets (plain integers, one bit per distinct name), so that every
+check is a couple of integer operations. Apps and devices with identical
+requirements and capabilities are checked only once, and results are
+cached by apk's sha256 and device's build fingerprint.
+
+Devices whose info could not be extracted are neither compatible nor
+incompatible, their results are None instead of True or False and are
+never cached.
+"""
+import logging
+from collections import namedtuple
+
+import helper.cache
+
+LOGGER = logging.getLogger(__name__)
+
+# device info needed for checks
+DEVICE_KEYS = ("android_api_level", "cpu_abis", "gles_extensions", "device_features")
+# keys which can be empty on devices whose info was extracted
+EMPTY_KEYS = ("gles_extensions",)
+
+AppProfile = namedtuple(
+    "AppProfile", ("min_sdk", "max_sdk", "abis", "textures", "features"))
+# missing is a tuple of DEVICE_KEYS which could not be extracted
+DeviceProfile = namedtuple(
+    "DeviceProfile", ("api_level", "abis", "textures", "features", "missing"))
+
+
+class Interner:
+    """Assigns consecutive bits to names."""
+    def __init__(self):
+        self.bits = {}
+        self.names = []
+
+
+    def mask(self, names):
+        """Return bitset of given names."""
+        mask = 0
+        for name in names:
+            bit = self.bits.get(name)
+            if bit is None:
+                bit = self.bits[name] = len(self.names)
+                self.names.append(name)
+            mask |= 1 << bit
+
+        return mask
+
+
+    def names_of(self, mask):
+        """Return list of names in bitset, in order of interning."""
+        names = []
+        bit = 0
+        while mask:
+            if mask & 1:
+                names.append(self.names[bit])
+            mask >>= 1
+            bit += 1
+
+        return names
+
+
+def sdk_level(value):
+    """Return API level as int, or 0 if it is unknown."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def missing_keys(info):
+    """Return tuple of DEVICE_KEYS missing from device's info."""
+    missing = []
+    for key in DEVICE_KEYS:
+        value = info.get(key)
+        if key == "android_api_level":
+            value = sdk_level(value)
+        if value is None or (not value and key not in EMPTY_KEYS):
+            missing.append(key)
+
+    return tuple(missing)
+
+
+class CompatibilityEngine:
+    """Checks apps against devices, using the same interned names for
+    all of them.
+    """
+    def __init__(self):
+        self.abis = Interner()
+        self.textures = Interner()
+        self.features = Interner()
+
+
+    def app_profile(self, app):
+        """Return AppProfile of apk.App."""
+        return AppProfile(
+            sdk_level(app.min_sdk), sdk_level(app.max_sdk),
+            self.abis.mask(app.supported_abis),
+            self.textures.mask(app.supported_texture_compressions),
+            self.features.mask(app.used_features))
+
+
+    def device_profile(self, device):
+        """Return DeviceProfile of device, extracting missing info."""
+        device.extract_data(keys=DEVICE_KEYS)
+        info = device.info_dict
+        return DeviceProfile(
+            sdk_level(info.get("android_api_level")),
+            self.abis.mask(info.get("cpu_abis") or ()),
+            self.textures.mask(info.get("gles_extensions") or ()),
+            self.features.mask(info.get("device_features") or ()),
+            missing_keys(info))
+
+
+    def check(self, app, device):
+        """Check if device described by DeviceProfile meets requirements
+        of app described by AppProfile.
+        Return tuple of (compatible, list of reasons), compatible is None
+        if device's info needed for the check is missing.
+        """
+        if device.missing:
+            return (None, [f"Could not read device's {', '.join(device.missing)}"])
+
+        reasons = []
+        if device.api_level:
+            if app.min_sdk and app.min_sdk > device.api_level:
+                reasons.append(
+                    f"API level of at least {app.min_sdk} is required but "
+                    f"the device uses {device.api_level}")
+
+            if app.max_sdk and device.api_level > app.max_sdk:
+                reasons.append(
+                    f"API level of at most {app.max_sdk} is allowed but "
+                    f"the device uses {device.api_level}")
+
+        if app.abis and not app.abis & device.abis:
+            reasons.append(
+                f"Device does not use supported abis "
+                f"({self.abis.names_of(app.abis)})")
+
+        if app.textures and not app.textures & device.textures:
+            reasons.append(
+                f"Device does not use supported texture compressions "
+                f"{self.textures.names_of(app.textures)}")
+
+        missing = app.features & ~device.features
+        for feature in self.features.names_of(missing):
+            reasons.append(f"Feature {feature} not available on device")
+
+        return (not reasons, reasons)
+
+
+    def matrix(self, apps, devices):
+        """Check every app against every device.
+        Apps and devices are given as lists of profiles.
+        Return list of rows (one for every app) of (compatible, reasons)
+        tuples (one for every device).
+        """
+        results = {}
+        rows = []
+        for app in apps:
+            row = []
+            for device in devices:
+                # namedtuples of ints compare and hash by value, so
+                # identical apps and devices share the result
+                key = (app, device)
+                if key not in results:
+                    results[key] = self.check(app, device)
+                row.append(results[key])
+            rows.append(row)
+
+        return rows
+
+
+def check_matrix(apps, devices):
+    """Check every apk.App against every device.
+
+    Results for apks and devices checked before are loaded from cache
+    (see helper.cache), only the remaining ones are checked.
+    Return list of rows (one for every app) of (compatible, reasons)
+    tuples (one for every device).
+    """
+    engine = CompatibilityEngine()
+    app_hashes = [helper.cache.apk_sha256(app.host_path) for app in apps]
+    fingerprints = [device.build_fingerprint for device in devices]
+    cache_keys = [[f"{sha256}/{fingerprint}" if sha256 and fingerprint else None
+                   for fingerprint in fingerprints] for sha256 in app_hashes]
+    cached = helper.cache.load_compatibility(
+        [key for row in cache_keys for key in row if key])
+
+    app_profiles = {}
+    device_profiles = {}
+    new_results = {}
+    rows = []
+    for app_index, app in enumerate(apps):
+        row = []
+        for device_index, device in enumerate(devices):
+            key = cache_keys[app_index][device_index]
+            if key in cached:
+                compatible, reasons = cached[key]
+                row.append((compatible, reasons))
+                continue
+
+            if app_index not in app_profiles:
+                app_profiles[app_index] = engine.app_profile(app)
+            if device_index not in device_profiles:
+                device_profiles[device_index] = engine.device_profile(device)
+
+            row.append(None)
+        rows.append(row)
+
+    # check everything not found in cache in one pass
+    app_indexes = sorted(app_profiles)
+    device_indexes = sorted(device_profiles)
+    checked = engine.matrix([app_profiles[x] for x in app_indexes],
+                            [device_profiles[x] for x in device_indexes])
+    for app_index, checked_row in zip(app_indexes, checked):
+        for device_index, result in zip(device_indexes, checked_row):
+            if rows[app_index][device_index] is not None:
+                continue
+
+            rows[app_index][device_index] = result
+            key = cache_keys[app_index][device_index]
+            # unknown results would otherwise stick until the device is updated
+            if key and result[0] is not None:
+                new_results[key] = result
+
+    helper.cache.store_compatibility(new_results)
+    return rows
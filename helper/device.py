@@ -3,39 +3,91 @@
 import re
 import sys
 import logging
+import threading
 from pathlib import Path
-from time import sleep, strftime
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from time import strftime, monotonic
 
 import helper
 import helper.apk
+import helper.cache
+import helper.adb_client
 import helper.extract_data
+import helper.shell_session
 from helper import ADB, VERSION, exe
 
 #ADB = helper_.ADB
 LOGGER = logging.getLogger(__name__)
-EXTRACTION_FUNCTIONS = {x[8::]:getattr(helper.extract_data, x) for x in dir(helper.extract_data) if x.startswith("extract_")}
-
-#returns 6 integers, corresponding to following tests:
-# exists, is a symlink, user can read, user can write, user can execute, custom test
-SH_FILE_TEST = """
-if [ -e "{}" ]; then echo -n 1;
-if [ -L "{}" ]; then echo -n 1; else echo -n 0; fi;
-if [ -r "{}" ]; then echo -n 1; else echo -n 0; fi;
-if [ -w "{}" ]; then echo -n 1; else echo -n 0; fi;
-if [ -x "{}" ]; then echo -n 1; else echo -n 0; fi;
-if [ -{} "{}" ]; then echo -n 1; else echo -n 0; fi;
-else echo -n 000000; fi
-""".strip().replace("\n", " ")
-
-SH_ECHO_GLOB = "for path in {}; do echo -n $path\\;; done"
+EXTRACTION_FUNCTIONS = {name:group[0] for name, group in helper.extract_data.INFO_GROUPS.items()}
+
+# defines function printing one line describing a path:
+# <index> <exists><is link><can read><can write><can execute> <type> <size> <mtime>
+SH_STAT_FUNCTION = (
+    'hs() { e=0; l=0; r=0; w=0; x=0; t=-; '
+    '[ -e "$2" ] && e=1; [ -L "$2" ] && l=1; '
+    'for c in f d c b p S; do [ -$c "$2" ] && t=$c; done; '
+    '[ -r "$2" ] && r=1; [ -w "$2" ] && w=1; [ -x "$2" ] && x=1; '
+    'echo "$1 $e$l$r$w$x $t $(stat -L -c "%s %Y" "$2" 2>/dev/null)"; }; ')
+STAT_TYPES = {
+    "f" : "file", "d" : "dir", "c" : "char", "b" : "block", "p" : "fifo", "S" : "socket",
+}
+# seconds for which results of stat_many are reused
+STAT_CACHE_TTL = 2.0
+# shell commands and redirections (other than to /dev/null or another
+# descriptor) which can change files, results of stat_many are discarded
+# after running them
+RE_MUTATING_COMMAND = re.compile(
+    r"(?:^|[;&|(]|\bthen\b|\bdo\b)\s*"
+    r"(?:rm|mv|cp|mkdir|rmdir|touch|ln|chmod|chown|chgrp|dd|pm|cmd|tar|unzip|gzip)\b"
+    r"|>+\s*(?!/dev/null|&)")
+# adb commands which can change files on device
+ADB_MUTATING_COMMANDS = (
+    "push", "install", "install-multiple", "uninstall", "restore", "remount", "sync")
+# result of stat_many, size and mtime are -1 if they could not be read
+PathStat = namedtuple("PathStat", (
+    "path", "exists", "type", "link", "read", "write", "execute", "size", "mtime"))
+
+# unmatched patterns are left unexpanded by shell, hence the existence test
+SH_ECHO_GLOB = "for path in {}; do [ -e \"$path\" ] || [ -L \"$path\" ] && echo \"$path\"; done; "
+SH_FIND_GLOB = "find {root} -mindepth {mindepth} {maxdepth}\\( {predicates} \\) 2>/dev/null; "
+RE_GLOB_MAGIC = re.compile(r"[*?[]")
+SH_STAT = "stat -c '%f %s %Y' {} 2>/dev/null"
+# exec: cannot close command's stdin, head stops after the given length
+SH_APPEND_STDIN = "head -c {length} >> {path}"
+
+# resumable pushes append straight to a partial file on device, which
+# needs exec: and toybox's head
+RESUME_MIN_API = 24
+# apks are streamed to the package manager's stdin by 'pm install -S',
+# which became session based on Android 6.0, and by install sessions,
+# which are available since Android 5.0
+STREAM_INSTALL_MIN_API = 23
+SESSION_INSTALL_MIN_API = 21
+# number of transfers done at once by Device.transfer_many
+TRANSFER_JOBS = 4
 
 
 def adb_command(*args, check_server=None, **kwargs):
     """Execute an ADB command.
 
+    Commands are sent directly to the adb server through
+    helper.adb_client whenever possible, the adb executable is used for
+    everything the client does not support or when the server cannot
+    be reached.
+
     If check_server is true, function will first make sure that an ADB
     server is available before executing the command.
     """
+    try:
+        return helper.adb_client.run(args, **kwargs)
+    except helper.adb_client.UnsupportedCommandError:
+        pass
+    except helper.adb_client.AdbConnectionError as error:
+        LOGGER.debug("Falling back to adb executable: %s", error)
+    except (helper.adb_client.AdbClientError, OSError) as error:
+        _connection_lost(args, error)
+
     if check_server is None:
         check_server = False
         try:
@@ -51,6 +103,175 @@ def adb_command(*args, check_server=None, **kwargs):
     return exe(helper.ADB, *args, **kwargs)
 
 
+def adb_stream(*args):
+    """Execute an ADB command and yield its raw output in chunks of
+    bytes, as soon as they are received.
+    Like adb_command, the adb server is used directly when possible.
+    """
+    try:
+        chunks = helper.adb_client.stream(args)
+    except helper.adb_client.UnsupportedCommandError:
+        pass
+    except helper.adb_client.AdbConnectionError as error:
+        LOGGER.debug("Falling back to adb executable: %s", error)
+    except (helper.adb_client.AdbClientError, OSError) as error:
+        _connection_lost(args, error)
+    else:
+        return _stream_chunks(args, chunks)
+
+    exe(helper.ADB, "start-server", return_output=True)
+    return helper.exe_chunks(helper.ADB, *args)
+
+
+def _stream_chunks(args, chunks):
+    """Yield chunks of output of adb command streamed by adb_client,
+    see _connection_lost for how errors are handled.
+    """
+    try:
+        yield from chunks
+    except (helper.adb_client.AdbClientError, OSError) as error:
+        _connection_lost(args, error)
+
+
+def _connection_lost(args, error):
+    """Handle connection to adb server breaking partway through adb
+    command given as list of arguments.
+
+    Commands sent to a device might have already run, so they are not
+    repeated and DeviceOfflineError is raised instead. Commands sent to
+    the server alone are repeated with the adb executable.
+    """
+    serial, _ = helper.adb_client.split_serial(args)
+    if serial:
+        raise DeviceOfflineError(
+            f"Lost connection to device {serial} during adb command ({error})", serial)
+
+    LOGGER.debug("Falling back to adb executable: %s", error)
+
+
+def split_glob(pattern):
+    """Split glob pattern into its leading directory without wildcards
+    and a list of the remaining path segments.
+    """
+    segments = pattern.split("/")
+    for index, segment in enumerate(segments):
+        if RE_GLOB_MAGIC.search(segment):
+            break
+    else:
+        return pattern, []
+
+    root = "/".join(segments[:index])
+    if not root:
+        root = "/" if pattern.startswith("/") else "."
+
+    return root, segments[index:]
+
+
+def glob_segment_to_regex(segment):
+    """Translate one segment of glob pattern into a regular expression.
+    """
+    regex = []
+    index = 0
+    while index < len(segment):
+        char = segment[index]
+        index += 1
+        if char == "*":
+            regex.append("[^/]*")
+        elif char == "?":
+            regex.append("[^/]")
+        elif char == "[":
+            end = index
+            if end < len(segment) and segment[end] == "!":
+                end += 1
+            if end < len(segment) and segment[end] == "]":
+                end += 1
+            end = segment.find("]", end)
+            if end == -1:
+                regex.append(re.escape(char))
+                continue
+            chars = segment[index:end].replace("\\", "\\\\")
+            if chars.startswith("!"):
+                chars = "^" + chars[1:]
+            elif chars.startswith("^"):
+                chars = "\\" + chars
+            regex.append(f"(?!/)[{chars}]")
+            index = end + 1
+        else:
+            regex.append(re.escape(char))
+
+    # as in shell, wildcards do not match hidden files
+    if RE_GLOB_MAGIC.match(segment):
+        regex.insert(0, r"(?!\.)")
+
+    return "".join(regex)
+
+
+def glob_to_regex(pattern):
+    """Translate glob pattern into a regular expression matching whole
+    paths. '**' segments match any number of directories.
+    """
+    segments = pattern.split("/")
+    regex = ""
+    after_recursive = False
+    for index, segment in enumerate(segments):
+        if index and not after_recursive:
+            regex += "/"
+        after_recursive = False
+
+        if segment == "**":
+            if index == len(segments) - 1:
+                regex += r"(?!\.)[^/]+(?:/(?!\.)[^/]+)*"
+            else:
+                regex += r"(?:(?!\.)[^/]+/)*"
+                after_recursive = True
+        else:
+            regex += glob_segment_to_regex(segment)
+
+    return regex
+
+
+def shell_quote(string):
+    """Quote string for use in device's shell."""
+    return "'{}'".format(str(string).replace("'", "'\\''"))
+
+
+def shell_glob(pattern):
+    """Quote glob pattern for shell, leaving its wildcards unquoted."""
+    parts = re.split(r"(\*|\?|\[[^]/]+\])", pattern)
+    return "".join(x if index % 2 else shell_quote(x) if x else ""
+                   for index, x in enumerate(parts))
+
+
+def find_glob_script(patterns):
+    """Return shell script finding paths matching glob patterns.
+    Patterns are grouped by their leading directory, each group is
+    searched with a single 'find' call limited to the depth range the
+    patterns can match.
+    """
+    groups = {}
+    for pattern in patterns:
+        root, rest = split_glob(pattern)
+        groups.setdefault(root, []).append(rest)
+
+    script = ""
+    for root, rests in groups.items():
+        depths = [len([x for x in rest if x != "**"]) for rest in rests]
+        recursive = any("**" in rest for rest in rests)
+        maxdepth = "" if recursive else f"-maxdepth {max(depths)} "
+        prefix = root.rstrip("/") + "/"
+        # find's -path wildcards match across directories,
+        # so '**' becomes '*' and exact matching is left to the regex
+        predicates = " -o ".join(
+            "-path " + shell_quote(
+                prefix + "/".join(rest).replace("**/", "*").replace("**", "*") if rest else root)
+            for rest in rests)
+        script += SH_FIND_GLOB.format(
+            root=shell_quote(root), mindepth=min(depths), maxdepth=maxdepth,
+            predicates=predicates)
+
+    return script
+
+
 def get_serials():
     """Proxy function for 'adb devices'.
     Return list of two-element tuples.
@@ -82,12 +303,196 @@ def get_serials():
     return device_list
 
 
+class StatusTracker:
+    """Shared, in-memory map of device serials and their adb states.
+
+    When the adb server can be reached directly, the map is kept up to
+    date by a background thread subscribed to the server's
+    'host:track-devices' stream. Otherwise 'adb devices' is polled, but
+    no more often than once every 'ttl' seconds.
+    """
+    def __init__(self, ttl=1.0):
+        self.ttl = ttl
+        self._states = {}
+        self._last_update = None
+        self._tracking = False
+        self._changes = {}
+        self._condition = threading.Condition()
+
+
+    def _track(self, updates):
+        """Apply state updates received from the adb server until the
+        connection is lost.
+        """
+        try:
+            for device_list in updates:
+                self._update(device_list)
+        except (helper.adb_client.AdbClientError, OSError) as error:
+            LOGGER.debug("Lost connection to track-devices stream: %s", error)
+
+        with self._condition:
+            self._tracking = False
+            self._last_update = None
+
+
+    def _update(self, device_list):
+        with self._condition:
+            states = dict(device_list)
+            for serial in set(states) | set(self._states):
+                if states.get(serial) != self._states.get(serial):
+                    self._changes[serial] = self._changes.get(serial, 0) + 1
+            self._states = states
+            self._last_update = monotonic()
+            self._condition.notify_all()
+
+
+    def start_tracking(self):
+        """Subscribe to the adb server's device state updates.
+        Return True if the subscription is active.
+        """
+        with self._condition:
+            if self._tracking:
+                return True
+
+            updates = helper.adb_client.track_devices()
+            try:
+                # the first update holds the current state of all devices
+                device_list = next(updates)
+            except (helper.adb_client.AdbClientError, OSError) as error:
+                LOGGER.debug("Could not subscribe to track-devices: %s", error)
+                return False
+
+            self._tracking = True
+            self._update(device_list)
+
+        threading.Thread(target=self._track, args=(updates,), daemon=True,
+                         name="StatusTracker").start()
+        return True
+
+
+    @property
+    def tracking(self):
+        """True if the state map is being updated by the adb server."""
+        return self._tracking
+
+
+    def refresh(self, force=False, ttl=None):
+        """Make sure the state map is up to date.
+
+        Nothing is done when the map is being updated by the adb
+        server or when the last poll is younger than the ttl (tracker's
+        own ttl if not given), unless force is True.
+        """
+        if self._tracking:
+            return
+
+        if ttl is None:
+            ttl = self.ttl
+        with self._condition:
+            fresh = self._last_update is not None and \
+                    monotonic() - self._last_update < ttl
+        if fresh and not force:
+            return
+
+        if self.start_tracking():
+            return
+
+        self._update(get_serials())
+
+
+    def serials(self):
+        """Return list of (serial, status) tuples for all devices known
+        to adb.
+        """
+        self.refresh()
+        with self._condition:
+            return list(self._states.items())
+
+
+    def get(self, serial):
+        """Return device's current state, or 'offline' if adb does not
+        know the device.
+        """
+        self.refresh()
+        with self._condition:
+            return self._states.get(serial, "offline")
+
+
+    def changes(self, serial):
+        """Return number of state changes of device seen so far."""
+        with self._condition:
+            return self._changes.get(serial, 0)
+
+
+    def wait_for(self, serial=None, state="device", timeout=None, cancel=None,
+                 changed_since=None, ttl=None):
+        """Wait until device with given serial (or any device, if serial
+        is None) is in given state. Devices unknown to adb are in the
+        'offline' state.
+
+        Waiting ends early when timeout (in seconds) passes or when
+        threading.Event cancel is set. If changed_since is given, the
+        device's state must also have changed since changes() returned
+        that value. When states are polled, they are refreshed at least
+        every ttl seconds (tracker's own ttl if not given).
+
+        Return serial of the device which reached the state, or None if
+        the wait timed out or was canceled.
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            self.refresh(ttl=ttl)
+            with self._condition:
+                if serial is None:
+                    candidates = [x for x, y in self._states.items() if y == state]
+                elif self._states.get(serial, "offline") == state:
+                    candidates = [serial]
+                else:
+                    candidates = []
+                if changed_since is not None:
+                    candidates = [x for x in candidates
+                                  if self._changes.get(x, 0) > changed_since]
+                if candidates:
+                    return candidates[0]
+
+                if cancel is not None and cancel.is_set():
+                    return None
+
+                wait = WAIT_CHECK_INTERVAL
+                if deadline is not None:
+                    wait = min(wait, deadline - monotonic())
+                    if wait <= 0:
+                        return None
+
+                # tracked updates wake up waiting threads immediately
+                self._condition.wait(wait)
+
+
+STATUS_TTL = 1.0
+# how often cancellation is checked and polled states refreshed while waiting
+WAIT_CHECK_INTERVAL = 0.1
+# default number of seconds to wait for devices to come back after reconnection
+RECONNECT_TIMEOUT = 60
+# seconds in which devices usually come back after reconnection, after
+# which the user is asked to reconnect the device
+RECONNECT_GRACE = 10
+STATUS_TRACKER = StatusTracker(STATUS_TTL)
+
+
+def wait_for_device(serial=None, timeout=None, cancel=None):
+    """Wait until device with given serial, or any device if serial is
+    None, is online. Return its serial, or None if the wait timed out or
+    was canceled (see StatusTracker.wait_for).
+    """
+    return STATUS_TRACKER.wait_for(serial, "device", timeout, cancel)
+
+
 def get_devices(initialize=True, limit_init=("identity",), allow_offline=False):
     """Return a list of device objects for currently connected devices.
     """
     device_list = []
 
-    for device_serial, device_status in get_serials():
+    for device_serial, device_status in STATUS_TRACKER.serials():
         if device_status != "device" and not allow_offline:
             # device suddenly disconnected or usb debugging not authorized
             continue
@@ -112,20 +517,69 @@ class DeviceOfflineError(DeviceError):
     """Device is offline."""
 
 
+class InfoDict(dict):
+    """Dict holding device's info, which extracts info groups the first
+    time any of their keys is read.
+
+    Only reading single items (info_dict[key] or info_dict.get(key))
+    triggers extraction. Nothing is extracted while the device is not
+    online, or for keys of groups which are being extracted at the time.
+    """
+    def __init__(self, device):
+        super().__init__((x, None) for x in helper.extract_data.INFO_KEYS)
+        self.device = device
+
+
+    def _extract(self, key):
+        device = self.device
+        groups = [
+            x for x in helper.extract_data.KEY_GROUPS.get(key, ())
+            if x not in device._extracted_info_groups and x not in device._extracting]
+        if not groups:
+            return
+
+        if device.status != "device":
+            return
+
+        LOGGER.debug("'%s' - key '%s' requested, extracting %s", device.name, key, groups)
+        device.extract_data(limit_to=groups)
+
+
+    def __getitem__(self, key):
+        self._extract(key)
+        return super().__getitem__(key)
+
+
+    def get(self, key, default=None):
+        self._extract(key)
+        return super().get(key, default)
+
+
 class Device:
     """Class representing a physical Android device."""
     def __init__(self, serial, status='offline', limit_init=()):
         """"""
         self.serial = serial
         self._extracted_info_groups = []
+        self._extracting = set()
         self._name = None
         self._filename = None
         self._init_cache = {}
+        self._fingerprint = None
+        self._props = None
+        self._shell_session = None
+        self._stat_cache = {}
+        self._package_index_time = None
+        self.use_info_cache = helper.cache.ENABLED
 
-        self.info_dict = {x:None for x in helper.extract_data.INFO_KEYS}
+        # info is extracted as it is needed, limit_init lists info
+        # groups extracted right away
+        self.info_dict = InfoDict(self)
 
         self.initialized = False
         self._status = status
+        if helper.shell_session.ENABLED:
+            self.open_shell_session()
 
         if self._status == "device":
             self.extract_data(limit_init)
@@ -137,6 +591,10 @@ class Device:
         if self.status != "device":
             raise DeviceOfflineError(
                 "Called adb command while device {} was offline".format(self.serial), self.serial)
+        if args and args[0] in ADB_MUTATING_COMMANDS:
+            self._stat_cache.clear()
+        elif args and args[0] == "shell":
+            self._forget_stats(args[1:])
 
         command_output = adb_command("-s", self.serial, *args, **kwargs)
 
@@ -150,12 +608,51 @@ class Device:
     def shell_command(self, *args, **kwargs):
         """Same as adb_command(["shell", *args]), but specific to the
         given device.
+
+        If a shell session is open (see open_shell_session), commands
+        whose output is returned are run in it.
         """
         if self.status != "device":
             raise DeviceOfflineError(
                 "Called adb command while device {} was offline".format(self.serial), self.serial)
+        self._forget_stats(args)
+
+        if self._shell_session and kwargs.get("return_output"):
+            try:
+                command_output, exit_code = self._shell_session.run(*args)
+            except helper.shell_session.ShellSessionError as error:
+                # the session is started again with the next command
+                LOGGER.warning("%s", error)
+                command_output = adb_command("-s", self.serial, "shell", *args, **kwargs)
+            else:
+                if kwargs.get("as_list"):
+                    command_output = command_output.splitlines()
+        else:
+            command_output = adb_command("-s", self.serial, "shell", *args, **kwargs)
+
+        if self.status != "device":
+            raise DeviceOfflineError(
+                "Device {} became offline after adb command".format(self.serial), self.serial)
+
+        return command_output
+
 
-        command_output = adb_command("-s", self.serial, "shell", *args, **kwargs)
+    def exec_command(self, command, input_file=None, length=None):
+        """Execute a command through adb's 'exec:' service, optionally
+        sending length bytes of binary file object input_file to its
+        stdin. Return command's output.
+
+        Requires a running adb server and Android 5.0 (API 21) or
+        newer, AdbConnectionError is raised if the server cannot be
+        reached.
+        """
+        if self.status != "device":
+            raise DeviceOfflineError(
+                "Called adb command while device {} was offline".format(self.serial), self.serial)
+        self._forget_stats([command])
+
+        command_output = helper.adb_client.exec_command(
+            self.serial, command, input_file, length)
 
         if self.status != "device":
             raise DeviceOfflineError(
@@ -164,6 +661,243 @@ class Device:
         return command_output
 
 
+    def _forget_stats(self, args):
+        """Discard results of stat_many if shell command given as list
+        of arguments could change files on device.
+        """
+        if self._stat_cache and \
+           RE_MUTATING_COMMAND.search(" ".join(str(x) for x in args)):
+            self._stat_cache.clear()
+
+
+    def open_shell_session(self):
+        """Run all following shell commands whose output is returned in
+        one long-lived shell session, instead of starting a new shell
+        for each of them.
+        """
+        if self._shell_session is None:
+            self._shell_session = helper.shell_session.ShellSession(self.serial)
+
+
+    def close_shell_session(self):
+        """Stop the shell session, if it is open."""
+        if self._shell_session is not None:
+            self._shell_session.close()
+            self._shell_session = None
+
+
+    def shell_stream(self, *args, lines=True):
+        """Same as shell_command(*args), but output is yielded as it is
+        received, never held in memory as a whole. If lines is true,
+        decoded lines are yielded, otherwise raw chunks of bytes.
+        """
+        if self.status != "device":
+            raise DeviceOfflineError(
+                "Called adb command while device {} was offline".format(self.serial), self.serial)
+        self._forget_stats(args)
+
+        chunks = adb_stream("-s", self.serial, "shell", *args)
+        if lines:
+            return helper.iter_lines(chunks)
+
+        return chunks
+
+
+    def shell_to_file(self, out_file, *args):
+        """Execute a shell command and write its raw output straight to
+        out_file (a path or a binary file object).
+        Return number of bytes written.
+        """
+        written = helper.write_chunks(self.shell_stream(*args, lines=False), out_file)
+
+        if self.status != "device":
+            raise DeviceOfflineError(
+                "Device {} became offline after adb command".format(self.serial), self.serial)
+
+        return written
+
+
+    def stat(self, remote_path):
+        """Return SyncStat (mode, size, mtime) of a file on device, or
+        None if it does not exist.
+        """
+        if self.status != "device":
+            raise DeviceOfflineError(
+                "Called adb command while device {} was offline".format(self.serial), self.serial)
+
+        try:
+            with helper.adb_client.SyncConnection(self.serial) as sync:
+                return self._sync_stat(sync, remote_path)
+        except helper.adb_client.AdbConnectionError as error:
+            LOGGER.debug("Falling back to shell stat: %s", error)
+
+        return self._shell_stat(remote_path)
+
+
+    def _sync_stat(self, sync, remote_path):
+        """Return SyncStat of a file on device, using open
+        SyncConnection if the device reports 64-bit sizes through it.
+        """
+        if sync.stat_v2:
+            return sync.stat(remote_path)
+
+        # sizes reported by the old STAT request are 32-bit, but toolbox's
+        # stat of Android 5 and older does not support -c
+        return self._shell_stat(remote_path) or sync.stat(remote_path)
+
+
+    def _shell_stat(self, remote_path):
+        """Return SyncStat of a file on device, read with shell's stat.
+        """
+        out = self.shell_command(
+            SH_STAT.format(shell_quote(remote_path)), return_output=True,
+            as_list=False).split()
+        try:
+            return helper.adb_client.SyncStat(int(out[0], 16), int(out[1]), int(out[2]))
+        except (IndexError, ValueError):
+            return None
+
+
+    def push(self, local_path, remote_path, resume=False):
+        """Copy a local file to device.
+
+        If resume is true, the file is written to a partial file on
+        device, and a push interrupted partway through continues from
+        the end of that file the next time the same file is pushed.
+        Requires Android 7.0 (API 24) or newer, other devices get a
+        regular push.
+
+        Return SyncStat of the pushed file, or None if it could not be
+        copied.
+        """
+        if self.status != "device":
+            raise DeviceOfflineError(
+                "Called adb command while device {} was offline".format(self.serial), self.serial)
+        # any command could have changed files on device
+        self._stat_cache.clear()
+
+        local_path = Path(local_path)
+        local_stat = local_path.stat()
+        if resume and local_stat.st_size and \
+           int(self.info_dict["android_api_level"] or 0) < RESUME_MIN_API:
+            LOGGER.debug("Resumable push is not supported on %s", self.name)
+            resume = False
+
+        try:
+            with helper.adb_client.SyncConnection(self.serial) as sync:
+                if resume and local_stat.st_size:
+                    return self._push_resume(sync, local_path, remote_path)
+
+                with local_path.open(mode="rb") as local_file:
+                    sync.push(local_file, remote_path, local_stat.st_mode,
+                              local_stat.st_mtime)
+                return self._sync_stat(sync, remote_path)
+        except helper.adb_client.AdbConnectionError as error:
+            LOGGER.debug("Falling back to adb executable: %s", error)
+        except (helper.adb_client.AdbClientError, OSError) as error:
+            LOGGER.error("Could not push %s to %s: %s", local_path, remote_path, error)
+            return None
+
+        adb_command("-s", self.serial, "push", local_path, remote_path, return_output=True)
+        return self.stat(remote_path)
+
+
+    def _push_resume(self, sync, local_path, remote_path):
+        """Push file by appending it to a partial file on device,
+        continuing from the end of a partial file left by a previous
+        push of the same file. Every byte is written to storage once.
+        """
+        local_stat = local_path.stat()
+        # partial file's name identifies version of the local file
+        part = f"{remote_path}.helper_part_{local_stat.st_size}_{int(local_stat.st_mtime)}"
+
+        part_stat = self._sync_stat(sync, part)
+        offset = part_stat.size if part_stat else 0
+        if offset > local_stat.st_size:
+            LOGGER.warning("Discarding invalid partial file %s", part)
+            self.shell_command("rm", shell_quote(part), return_output=True)
+            offset = 0
+        elif offset:
+            LOGGER.info("Resuming push of %s at %s bytes", local_path, offset)
+
+        # data arrives in order, so whatever was written before an
+        # interruption is a valid beginning of the file
+        length = local_stat.st_size - offset
+        if length:
+            with local_path.open(mode="rb") as local_file:
+                local_file.seek(offset)
+                output = self.exec_command(
+                    SH_APPEND_STDIN.format(length=length, path=shell_quote(part)),
+                    local_file, length)
+            if output.strip():
+                LOGGER.debug("Appending to %s: %s", part, output.strip())
+
+        part_stat = self._sync_stat(sync, part)
+        if part_stat is None or part_stat.size != local_stat.st_size:
+            LOGGER.error("Could not push %s to %s: partial file is incomplete",
+                         local_path, remote_path)
+            return None
+
+        self.shell_command(
+            "mv", shell_quote(part), shell_quote(remote_path), return_output=True)
+        return self._sync_stat(sync, remote_path)
+
+
+    def pull(self, remote_path, local_path):
+        """Copy a file from device.
+
+        Return SyncStat of the copied remote file, or None if it does
+        not exist or could not be copied.
+        """
+        if self.status != "device":
+            raise DeviceOfflineError(
+                "Called adb command while device {} was offline".format(self.serial), self.serial)
+
+        local_path = Path(local_path)
+        try:
+            with helper.adb_client.SyncConnection(self.serial) as sync:
+                remote_stat = self._sync_stat(sync, remote_path)
+                if remote_stat is None:
+                    return None
+
+                try:
+                    with local_path.open(mode="wb") as local_file:
+                        sync.pull(remote_path, local_file)
+                except (helper.adb_client.AdbClientError, OSError) as error:
+                    LOGGER.error("Could not pull %s: %s", remote_path, error)
+                    local_path.unlink()
+                    return None
+
+                return remote_stat
+        except helper.adb_client.AdbConnectionError as error:
+            LOGGER.debug("Falling back to adb executable: %s", error)
+
+        remote_stat = self.stat(remote_path)
+        if remote_stat is None:
+            return None
+
+        adb_command("-s", self.serial, "pull", remote_path, local_path, return_output=True)
+        return remote_stat if local_path.is_file() else None
+
+
+    def transfer_many(self, transfers, jobs=TRANSFER_JOBS):
+        """Run several transfers at once, each on its own connection.
+
+        Transfers are given as tuples of: "push" or "pull", source path
+        and destination path. Return list of results of push / pull, in
+        the same order.
+        """
+        def transfer(direction, source, destination):
+            if direction == "push":
+                return self.push(source, destination)
+            if direction == "pull":
+                return self.pull(source, destination)
+            raise ValueError(f"Unknown transfer direction '{direction}'")
+
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            return list(executor.map(lambda x: transfer(*x), transfers))
+
+
     @property
     def name(self):
         """Property holding a human-readable name of the device.
@@ -199,32 +933,140 @@ class Device:
     def status(self):
         """Device's current state, as announced by adb. Return offline
         if device was not found by adb.
-        """
-        self._status = "offline"
-        for device_specs in get_serials():
-            if self.serial == device_specs[0]:
-                self._status = device_specs[1]
-                break
 
+        State is read from the shared STATUS_TRACKER.
+        """
+        self._status = STATUS_TRACKER.get(self.serial)
         return self._status
 
 
-    def extract_data(self, limit_to=(), force_extract=False):
-        """"""
-        LOGGER.info("%s - starting data extraction", self.name)
+    @property
+    def props(self):
+        """Dict of all of device's system properties, as reported by
+        getprop. Props are read once and kept for device's lifetime.
+        """
+        if self._props is None:
+            self._props = helper.extract_data.parse_getprop(
+                helper.extract_data.run_extraction_command(self, "getprop"))
+
+        return self._props
+
+
+    @property
+    def build_fingerprint(self):
+        """Device's build fingerprint, used to validate cached info."""
+        if self._fingerprint is None and self._props is not None:
+            self._fingerprint = self._props.get("ro.build.fingerprint", "")
+
+        if self._fingerprint is None:
+            self._fingerprint = self.shell_command(
+                "getprop", "ro.build.fingerprint", return_output=True,
+                as_list=False).strip()
+
+        return self._fingerprint
+
+
+    def _load_cached_group(self, group_name):
+        """Load info group from the on-disk cache.
+        Return True if valid cached info was found.
+        """
+        if not self.use_info_cache or helper.cache.GROUP_TTL.get(group_name, 0) == 0:
+            return False
+
+        info = helper.cache.load_device_info(
+            self.serial, self.build_fingerprint, group_name)
+        if info is None:
+            return False
+
+        LOGGER.info("'%s' - loaded info group '%s' from cache", self.name, group_name)
+        self.info_dict.update(info)
+        if group_name not in self._extracted_info_groups:
+            self._extracted_info_groups.append(group_name)
+        return True
+
+
+    def _store_cached_group(self, group_name, new_keys=()):
+        """Save extracted info group in the on-disk cache."""
+        if not self.use_info_cache or helper.cache.GROUP_TTL.get(group_name, 0) == 0:
+            return
+
+        info_keys = helper.extract_data.INFO_GROUPS[group_name][2] + tuple(new_keys)
+        helper.cache.store_device_info(
+            self.serial, self.build_fingerprint, group_name,
+            # reading keys directly from dict, without triggering extraction
+            {key:dict.get(self.info_dict, key) for key in info_keys})
+
+
+    def _pending_groups(self, limit_to=(), force_extract=False, keys=()):
+        """Resolve which info groups extract_data needs to extract, load
+        the rest from the on-disk cache.
+
+        Return the requested group names and list of (group name,
+        extraction function) tuples of groups to extract.
+        """
+        if isinstance(limit_to, str):
+            limit_to = [limit_to]
+        for group_name in limit_to:
+            if group_name not in EXTRACTION_FUNCTIONS:
+                raise ValueError(f"Unknown info group '{group_name}'")
+        if keys:
+            limit_to = list(limit_to) + helper.extract_data.groups_for_keys(keys)
+
+        if force_extract and (not limit_to or "identity" in limit_to):
+            # re-read props along with the rest of identity
+            self._props = None
+
+        groups = []
         for command_id, command in EXTRACTION_FUNCTIONS.items():
             if limit_to:
                 if command_id not in limit_to:
                     continue
 
-            if command in self._extracted_info_groups:
+            if command_id in self._extracted_info_groups:
                 if not force_extract:
                     LOGGER.info("'%s' - skipping extraction of '%s' - command already executed", self.name, command_id)
                     continue
                 LOGGER.info("'%s' - extraction of the next group has been forced ", self.name)
 
+            if not force_extract and self._load_cached_group(command_id):
+                continue
+
+            groups.append((command_id, command))
+
+        return limit_to, groups
+
+
+    def extract_data(self, limit_to=(), force_extract=False, batch=True, keys=()):
+        """Extract info groups from device into info_dict.
+
+        Extraction can be limited to specific info groups (limit_to) or
+        to the groups needed to produce specific info_dict keys (keys).
+        Groups which were already extracted, or which can be loaded from
+        the on-disk cache (see helper.cache), are skipped unless
+        force_extract is true.
+
+        If batch is true, outputs of all info sources needed by the
+        extracted groups are fetched from device at once, before
+        extraction begins.
+        """
+        LOGGER.info("%s - starting data extraction", self.name)
+        limit_to, groups = self._pending_groups(limit_to, force_extract, keys)
+
+        if batch:
+            helper.extract_data.prefetch_sources(
+                self, helper.extract_data.sources_for_groups(
+                    [command_id for command_id, command in groups]))
+
+        for command_id, command in groups:
             LOGGER.info("'%s' - extracting info group '%s'", self.name, command_id)
-            command(self)
+            known_keys = set(self.info_dict)
+            self._extracting.add(command_id)
+            try:
+                command(self)
+            finally:
+                self._extracting.discard(command_id)
+            # extraction functions may create keys not listed in INFO_KEYS
+            self._store_cached_group(command_id, set(self.info_dict) - known_keys)
             if command_id not in self._extracted_info_groups:
                 self._extracted_info_groups.append(command_id)
                 # progress indicator for long loads
@@ -233,7 +1075,71 @@ class Device:
 
         if not limit_to:
             print()
-        self._init_cache = {}
+        # extraction functions can trigger extraction of other groups,
+        # the cache must outlive those nested calls
+        if not self._extracting:
+            self._init_cache = {}
+
+
+    def stat_many(self, paths):
+        """Check any number of paths on device at once.
+
+        Return dict of paths and their PathStat tuples, describing
+        whether the path exists, its type ("file", "dir", "char",
+        "block", "fifo", "socket" or None), whether it is a symbolic
+        link, whether the current user can read, write and execute it,
+        its size and mtime. Results are reused for STAT_CACHE_TTL
+        seconds, or until a command which can change files (see
+        RE_MUTATING_COMMAND) is run on device.
+        """
+        now = monotonic()
+        results = {}
+        missing = []
+        for path in paths:
+            try:
+                cached_time, path_stat = self._stat_cache[path]
+                if now - cached_time < STAT_CACHE_TTL:
+                    results[path] = path_stat
+                    continue
+            except KeyError:
+                pass
+            missing.append(path)
+
+        scripts = []
+        script = SH_STAT_FUNCTION
+        for index, path in enumerate(missing):
+            line = f"hs {index} {shell_quote(path)}; "
+            if len(script) + len(line) > helper.extract_data.BATCH_MAX_LENGTH:
+                scripts.append(script)
+                script = SH_STAT_FUNCTION
+            script += line
+        if missing:
+            scripts.append(script)
+
+        fetched = {}
+        for script in scripts:
+            for line in self.shell_command(script, return_output=True, as_list=True):
+                try:
+                    index, tests, file_type, *size_mtime = line.split()
+                    exists, link, read, write, execute = [x == "1" for x in tests]
+                    size, mtime = [int(x) for x in size_mtime] if size_mtime else (-1, -1)
+                    path = missing[int(index)]
+                except (ValueError, IndexError):
+                    LOGGER.warning("Unexpected stat output: %s", line)
+                    continue
+
+                fetched[path] = PathStat(
+                    path, exists, STAT_TYPES.get(file_type), link, read, write,
+                    execute, size, mtime)
+
+        now = monotonic()
+        for path in missing:
+            path_stat = fetched.get(
+                path, PathStat(path, False, None, False, False, False, False, -1, -1))
+            self._stat_cache[path] = (now, path_stat)
+            results[path] = path_stat
+
+        return {path:results[path] for path in paths}
 
 
     def is_type(self, file_path, file_type, check_read=False,
@@ -268,20 +1174,20 @@ class Device:
         if not file_path:
             file_path = "."
 
-        #outputs a 6 character-long string describing the file
-        #sample output: 101011 = exists, not symlink, read and execute permissions granted, passed custom test (file_type)
-
-        test = SH_FILE_TEST.format(*[file_path for x in range(5)], file_type, file_path)
-
-        file_status = self.shell_command(test, return_output=True, as_list=False).strip()
+        path_stat = self.stat_many([file_path])[file_path]
+        LOGGER.debug("file %s was tested, received: %s", file_path, path_stat)
 
-        LOGGER.debug("file %s was tested, received: elrwxt %s", file_path, file_status)
-
-        if not len(file_status) > 1:
-            return False
+        if file_type == "e":
+            type_test = path_stat.exists
+        elif file_type in ("L", "h"):
+            type_test = path_stat.link
+        elif file_type in STAT_TYPES:
+            type_test = path_stat.type == STAT_TYPES[file_type]
+        else:
+            raise ValueError(f"Unsupported file test '-{file_type}'")
 
-        #exists, is link, read permission, write permission, execute permission, custom test
-        e, l, r, w, x, t = [bool(int(x)) for x in file_status]
+        e, l, r, w, x, t = (path_stat.exists, path_stat.link, path_stat.read,
+                            path_stat.write, path_stat.execute, type_test)
 
         tests = [
             (True, e, 0),
@@ -319,61 +1225,89 @@ class Device:
         return self.is_type(file_path, "d", *args, **kwargs)
 
 
-    def glob(self, path):
-        """Return list of paths matching the expanded wildcard path.
+    def iglob(self, *patterns):
+        """Yield paths on device matching any of the given glob
+        patterns, as they are found.
 
-        Currently, only the '*' wildcard is supported.
+        Supported wildcards are '*', '?', '[...]' (and '[!...]') within
+        a path segment, and '**' as a whole segment, matching any
+        number of directories. As in shell, wildcards do not match names
+        starting with a dot. Relative patterns are resolved against the
+        shell's working directory.
+
+        Matching is done on device with a single 'find' call per group
+        of patterns sharing their fixed leading directory. On devices
+        without 'find', patterns are expanded by the shell instead and
+        '**' matches a single directory.
         """
-        if "*" not in path:
-            raise ValueError("Path must contain a wildcard!")
+        patterns = [x[2:] if x.startswith("./") else x for x in patterns]
+        if not patterns:
+            return
 
-        #TODO: Make "?" wildcards work
+        regex = re.compile("|".join(f"(?:{glob_to_regex(x)})" for x in patterns))
+        if "find" in self.info_dict["shell_commands"]:
+            script = find_glob_script(patterns)
+        else:
+            script = "".join(
+                SH_ECHO_GLOB.format(shell_glob(x.replace("**", "*"))) for x in patterns)
 
-        safe_path = "*".join([f'"x"' for x in path.split("*")])
+        for line in self.shell_stream(script):
+            path = line.rstrip("\r\n")
+            if path.startswith("./"):
+                path = path[2:]
+            if regex.fullmatch(path):
+                yield path
 
-        shell_command = SH_ECHO_GLOB.format(safe_path)
-        path_list = self.shell_command(shell_command, return_output=True, as_list=False).strip().split(";")
-        path_list = [x[:-1] for x in path_list if x]
-        try:
-            path_list.remove(path)
-        except ValueError:
-            pass
 
-        return path_list
+    def glob(self, *patterns):
+        """Return list of paths on device matching any of the given glob
+        patterns. See iglob for supported wildcards.
+        """
+        return list(self.iglob(*patterns))
 
 
-    def reconnect(self, stdout_=sys.stdout):
+    def reconnect(self, timeout=RECONNECT_TIMEOUT, cancel=None, stdout_=None):
         """Restart connection with device.
 
-        Return true when device comes back online.
+        Return true when device comes back online, or false if it does
+        not within timeout seconds (None to wait indefinitely) or the
+        wait is canceled by setting threading.Event cancel.
         """
+        if stdout_ is None:
+            stdout_ = sys.stdout
+        # state must be known before, for its change to be noticed
+        STATUS_TRACKER.refresh()
+        changes = STATUS_TRACKER.changes(self.serial)
         reconnect_status = adb_command("-s", self.serial, "reconnect",
                                        return_output=True, as_list=False)
         # TODO: New versions of adb started outputting device status when reconnecting devices
 
-        """from time import strftime
-        if reconnect_status.strip().lower() != "done":
-            # I don't even know if there is a chance for unexpected output here
-            stdout_.write("ERROR: ")
-            stdout_.write(reconnect_status + "\n")
-            return False
-        """
-
-        # TODO: If you wait long enough, all problems will just disappear, right?
-        sleep(0.7)
-
-        if self.status != "device":
+        # the session's shell does not survive reconnection,
+        # it is started again with the next command
+        if self._shell_session is not None:
+            self._shell_session.close()
+
+        # the device is back once its state changed since the reconnection
+        # started, polled states are refreshed often enough not to miss
+        # its drop
+        STATUS_TRACKER.refresh(force=True)
+        grace = RECONNECT_GRACE if timeout is None else min(RECONNECT_GRACE, timeout)
+        serial = STATUS_TRACKER.wait_for(
+            self.serial, "device", grace, cancel, changed_since=changes,
+            ttl=WAIT_CHECK_INTERVAL)
+
+        canceled = cancel is not None and cancel.is_set()
+        if serial is None and not canceled and (timeout is None or timeout > grace):
             stdout_.write(
                 " ".join(["Connection with this device had to be reset,",
                           "to continue you must reconnect your device and/or",
                           "grant debugging permission again.\n"]))
-        reconnect_status = adb_command("-s", self.serial, "wait-for-device",
-                                       return_output=True, as_list=False)
-        if reconnect_status:
-            # I have not seen the 'wait-for-<status>' command output anything ever
-            # so this is a precaution in case it ever will
-            stdout_.write("ERROR: ")
-            stdout_.write(reconnect_status + "\n")
+            serial = STATUS_TRACKER.wait_for(
+                self.serial, "device", None if timeout is None else timeout - grace,
+                cancel, changed_since=changes)
+
+        if serial is None:
+            stdout_.write("ERROR: Device did not come back online.\n")
             return False
 
         return True
@@ -418,7 +1352,8 @@ class Device:
         compression types.
         """
         # ensure all required data is available
-        self.extract_data(limit_to=["gpu", "identity", "os"])
+        self.extract_data(keys=["device_model", "device_manufacturer",
+                                "android_version", "gles_texture_compressions"])
 
         model = self.info_dict["device_model"]
         if not model:
@@ -439,21 +1374,22 @@ class Device:
         return "\n".join([line1, line2])
 
 
-    def extract_apk(self, app, out_dir=".", stdout_=sys.stdout):
+    def extract_apk(self, app, out_dir=".", stdout_=None):
         """Extract an application's apk file.
 
         To specify the application, provide either an app name or an
         app object.
         """
+        if stdout_ is None:
+            stdout_ = sys.stdout
         if isinstance(app, helper.apk.App):
             app_name = app.app_name
         else:
             app_name = app
 
-        self.extract_data(limit_to=("installed_packages"))
+        self.extract_data(limit_to=["installed_packages"])
 
-        if app_name not in self.info_dict["system_apps"] and\
-           app_name not in self.info_dict["third-party_apps"]:
+        if app_name not in (self.info_dict["package_index"] or {}):
             stdout_.write(f"{app_name} not in list of installed apps.\n")
             return False
 
@@ -472,17 +1408,17 @@ class Device:
         out_file = Path(out_dir, filename)
 
         stdout_.write("Copying {}'s apk file...\n".format(app_name))
-        self.adb_command("pull", app_path, out_file.__fspath__(), stdout_=stdout_)
-
-        if out_file.is_file():
+        if self.pull(app_path, out_file):
             return out_file.resolve()
 
         stdout_.write("ERROR: The apk file could not be copied!\n")
         return False
 
 
-    def launch_app(self, app, stdout_=sys.stdout):
+    def launch_app(self, app, stdout_=None):
         """Launch an app"""
+        if stdout_ is None:
+            stdout_ = sys.stdout
 
         intent = f"{app.app_name}/{app.launchable_activity}"
 
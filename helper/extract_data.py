@@ -1,12 +1,14 @@
-"""
+"""Functions extracting device information from outputs of shell commands.
 
-Other modules expect that all extraction functions' names start with
-'extract_'.
+Extraction functions are grouped into info groups, see INFO_GROUPS at
+the end of this module for the info sources each of them reads and the
+info keys each of them produces.
 """
 import re
-import string
+import uuid
 import logging
-from collections import OrderedDict
+from time import monotonic
+from collections import OrderedDict, namedtuple
 
 import helper
 
@@ -48,6 +50,21 @@ ABI_TO_ARCH = {
     "mips64"     :"64bit (Mips64)",
 }
 
+# seconds after which the whole package index is listed again, instead of
+# refreshing single packages
+PACKAGE_INDEX_TTL = 300
+
+# partitions of preinstalled packages, used to tell system packages apart
+# only if 'pm list packages -s' did not list any, as updates of system
+# packages are installed in /data/app
+SYSTEM_PATHS = ("/system/", "/system_ext/", "/vendor/", "/product/", "/odm/",
+                "/oem/", "/apex/")
+
+# installed package, as listed by 'pm list packages -f -U -i --show-versioncode'
+# fields not listed by package manager are None
+PackageInfo = namedtuple(
+    "PackageInfo", ("name", "path", "uid", "version_code", "installer", "system"))
+
 #shell script for finding executables in PATH
 SH_PATH_EXE = """
 for dir in ${PATH//:/ }; do
@@ -114,6 +131,7 @@ INFO_SOURCES = {
     "device_libraries" : ("pm", "list", "libraries"),
     "system_apps" : ("pm", "list", "packages", "-s"),
     "third-party_apps" : ("pm", "list", "packages", "-3"),
+    "package_list" : ("pm", "list", "packages", "-f", "-U", "-i", "--show-versioncode"),
     "screen_size" : ("wm", "size"),
     "screen_density" : ("wm", "density"),
     "internal_sd_space" : ("df", "\"$EXTERNAL_STORAGE\""),
@@ -128,6 +146,35 @@ INFO_SOURCES = {
     "debug_device_instrumentation" : ("pm", "list", "instrumentation"),
     }
 
+# one row of df output, all sizes are in bytes
+DfRow = namedtuple("DfRow", ("filesystem", "total", "used", "free"))
+DF_BLOCK_SIZES = {
+    "1k-blocks" : 1024,
+    "1024-blocks" : 1024,
+    "512-blocks" : 512,
+}
+# used when df's header is not recognized - Android's toolbox layout
+DF_FALLBACK_LAYOUT = (1, 2, 3, False, 1)
+# size with optional unit suffix, e.g. '512', '1.8G', '976,0KiB', '18%'
+RE_DF_SIZE = re.compile(r"([0-9]+(?:[.,][0-9]+)?)(?:([KMGTP])(?:i?B)?|B|%)?", re.IGNORECASE)
+
+# matches one '[prop.name]: [value]' entry of getprop's output
+# value can span multiple lines, it ends with the first ']' at line's end
+RE_GETPROP = re.compile(
+    r"^\[([^\]\r\n]+)\]: \[([^\]]*(?:\](?!\r?$)[^\]]*)*)\]\r?$", re.MULTILINE)
+
+# maximum length of a single batched shell command
+# old versions of adb limit the length of service requests to 4KB
+BATCH_MAX_LENGTH = 4000
+
+SH_BATCH_SECTION = """
+echo {marker} {source_name};
+(
+{command}
+) 2>&1;
+echo;
+""".strip()
+
 NOTABLE_FEATURES = [
     ("Bluetooth", "feature:android.hardware.bluetooth"),
     ("Bluetooth Low-Energy", "feature:android.hardware.bluetooth_le"),
@@ -251,6 +298,8 @@ INFO_KEYS = [
     "internal_sd_free",
     "internal_sd_path",
     "kernel_version",
+    "package_index",
+    "packages_by_installer",
     "ram_capacity",
     "shell_commands",
     "system_apps",
@@ -291,6 +340,67 @@ def run_extraction_command(device, source_name, use_cache=True, keep_cache=True)
         return out
 
 
+def build_batch_scripts(source_names, marker):
+    """Return list of shell scripts running commands of all given info
+    sources. Output of each command is preceded by a line containing
+    the marker and the name of the source.
+
+    Sources are split between multiple scripts if the combined length
+    would exceed BATCH_MAX_LENGTH.
+    """
+    scripts = []
+    sections = []
+    length = 0
+    for source_name in source_names:
+        section = SH_BATCH_SECTION.format(
+            marker=marker, source_name=source_name,
+            command=" ".join(INFO_SOURCES[source_name]))
+
+        if sections and length + len(section) > BATCH_MAX_LENGTH:
+            scripts.append("\n".join(sections))
+            sections = []
+            length = 0
+
+        sections.append(section)
+        length += len(section) + 1
+
+    if sections:
+        scripts.append("\n".join(sections))
+
+    return scripts
+
+
+def split_batch_output(batch_output, marker):
+    """Split output of batched scripts into a dict of source names and
+    their outputs.
+    """
+    outputs = {}
+    sections = re.split(f"^{marker} (\\S+)\r?\n", batch_output, flags=re.M)
+    # sections[0] is anything that came before the first marker
+    for source_name, output in zip(sections[1::2], sections[2::2]):
+        # remove the line break added after each command's output
+        outputs[source_name] = re.sub("\r?\n\\Z", "", output, count=1)
+
+    return outputs
+
+
+def prefetch_sources(device, source_names):
+    """Run commands of all given info sources with as few shell
+    commands as possible and store their outputs in device's
+    _init_cache. Sources already present in the cache are skipped.
+    """
+    source_names = [x for x in OrderedDict.fromkeys(source_names)
+                    if x not in device._init_cache]
+    if not source_names:
+        return
+
+    LOGGER.debug("Prefetching info sources: %s", source_names)
+    marker = f"HELPER_SECTION_{uuid.uuid4().hex}"
+    for script in build_batch_scripts(source_names, marker):
+        batch_output = device.shell_command(script, return_output=True, as_list=False)
+        device._init_cache.update(split_batch_output(batch_output, marker))
+
+
 def bytes_to_human(byte_size: int) -> str:
     """Convert bytes to human readable size.
     1KB = 1024B
@@ -307,110 +417,124 @@ def df_parser(df_output: str) -> list:
     manually detect size formatting used in the output.
     May they burn in hell forever.
 
-    Return list of four-element tuples. All sizes are in bytes,
-    tuple[0] = file system
-    tuple[1] = total space
-    tuple[2] = used space
-    tuple[3] = free space
-    """
-    #TODO: do a second pass on this function
-    df_output = [x.split() for x in df_output.splitlines()]
-    index_row = [x.lower() for x in df_output.pop(0)]
-
-    string_to_size = {
-        "1k-blocks":1024,
-        "1024-blocks":1024,
-        "512-blocks":512,
-    }
-    known_size_multiplier = 0
-    for name, size in string_to_size.items():
-        if name in index_row:
-            known_size_multiplier = size
-    # assume human-readable values if header does not reveal block size
-
-    total_column, used_column, free_column = None, None, None
-    for index, column_name in enumerate(index_row):
-        column_name = column_name.lower()
+    Column layout and unit convention are detected once, from the
+    header row, and all rows are then converted with it. Rows broken
+    into two lines (long file system names) are joined back.
 
-        if column_name in ["1k-blocks", "512-blocks", "1024-blocks", "size"]:
-            total_column = index
-        if column_name in ["used", "%used"]:
-            used_column = index
-        if column_name in ["free", "available", "avail"]:
-            free_column = index
+    Return list of DfRow tuples. All sizes are in bytes, -1 marks sizes
+    which could not be read.
+    """
+    lines = df_output.splitlines()
+    header = []
+    while lines and not header:
+        header = lines.pop(0).lower().split()
 
-    # check for missing columns
-    if sum((int(bool(x)) for x in (total_column, used_column, free_column))) < 3:
+    layout = df_layout(header)
+    if layout is None:
         LOGGER.error("Could not find indices of all columns")
-        LOGGER.error("size: %s, used: %s, free: %s", total_column, used_column, free_column)
-        LOGGER.error("Index row is: %s", index_row)
-
-    re_search = re.compile("([0-9.]+)([%A-z]*)")
-    lines = []
-    accepted_chars = string.ascii_lowercase + string.digits + ",.%"
-    accepted_chars = set(accepted_chars)
-    for row in df_output:
+        LOGGER.error("Index row is: %s", header)
+        layout = DF_FALLBACK_LAYOUT
+
+    total_column, used_column, free_column, used_percent, multiplier = layout
+    used_multiplier = 1 if used_percent else multiplier
+    # values repeat a lot between mounts (tmpfs etc.), each is converted once
+    sizes = {}
+    def size(row, column, multiplier):
+        try:
+            value = row[column]
+        except IndexError:
+            return -1
+        try:
+            return sizes[value, multiplier]
+        except KeyError:
+            converted = sizes[value, multiplier] = df_size(value, multiplier)
+            return converted
+
+    rows = []
+    wrapped = None
+    for line in lines:
+        row = line.split()
         if not row:
             continue
-        #TODO: improve error-checking
+
+        if wrapped is not None:
+            row.insert(0, wrapped)
+            wrapped = None
+        elif len(row) == 1:
+            # file system name too long to fit in its column,
+            # the rest of the row is on the next line
+            wrapped = row[0]
+            continue
+
         if "denied" in row:
-            lines.append((row[0], -1, -1, -1))
+            rows.append(DfRow(row[0], -1, -1, -1))
             continue
 
-        if total_column:
-            total_val = row[total_column].lower()
-            # if returns non-empty set, the string contained invalid characters
-            if set(total_val) - accepted_chars:
-                total_val = ""
-        if used_column:
-            used_val = row[used_column].lower()
-            if set(used_val) - accepted_chars:
-                used_val = ""
-        if free_column:
-            free_val = row[free_column].lower()
-            if set(free_val) - accepted_chars:
-                free_val = ""
-
-        # convert values to bytes
-        #TODO: and third, and fourth pass on this
-        # this if-else soup is somehow easier to understand than my previous solution
-        if total_val:
-            if known_size_multiplier:
-                total_val = float(total_val)* known_size_multiplier
-            else:
-                total_val, total_unit = re_search.search(row[total_column]).groups()
-                if total_unit:
-                    total_val = float(total_val) * SIZE_PREFIXES[total_unit.upper()]
-        else:
-            total_val = -1
-
-        if used_val:
-            #TODO:subtract available from total instead of calculating from percentages
-            if "%" in used_val:
-                used_val = re_search.search(used_val).group(1)
-                used_val = float(used_val) * total_val / 100
-            elif known_size_multiplier:
-                used_val = float(used_val) * known_size_multiplier
-            else:
-                used_val, used_unit = re_search.search(used_val).groups()
-                if used_unit:
-                    used_val = float(used_val) * SIZE_PREFIXES[used_unit.upper()]
-        else:
-            used_val = -1
-
-        if free_val:
-            if known_size_multiplier:
-                free_val = float(free_val) * known_size_multiplier
-            else:
-                free_val, free_unit = re_search.search(free_val).groups()
-                if free_unit:
-                    free_val = float(free_val) * SIZE_PREFIXES[free_unit.upper()]
-        else:
-            free_val = -1
+        total = size(row, total_column, multiplier)
+        used = size(row, used_column, used_multiplier)
+        free = size(row, free_column, multiplier)
+        if used_percent and used != -1:
+            used = used * total / 100 if total != -1 else -1
+
+        rows.append(DfRow(row[0], int(total), int(used), int(free)))
+
+    if wrapped is not None:
+        rows.append(DfRow(wrapped, -1, -1, -1))
+
+    return rows
+
+
+def df_layout(header):
+    """Detect column layout of df output from its (lowercase, split)
+    header row.
+
+    Return tuple of: indices of total, used and free columns, whether
+    used space is given in percents and the size of a block (1 if sizes
+    are human-readable), or None if any of the columns is missing.
+    """
+    total_column, used_column, free_column = None, None, None
+    used_percent = False
+    multiplier = 1
+    for index, column_name in enumerate(header):
+        if column_name in DF_BLOCK_SIZES:
+            total_column = index
+            multiplier = DF_BLOCK_SIZES[column_name]
+        elif column_name == "size":
+            total_column = index
+        elif column_name in ("used", "%used"):
+            used_column = index
+            used_percent = column_name == "%used"
+        elif column_name in ("free", "available", "avail"):
+            free_column = index
 
-        lines.append((row[0], int(total_val), int(used_val), int(free_val)))
+    if None in (total_column, used_column, free_column):
+        return None
 
-    return lines
+    return total_column, used_column, free_column, used_percent, multiplier
+
+
+def df_size(value, multiplier):
+    """Return size from df's column converted to bytes, or -1 if it
+    cannot be read. Values without unit suffix are multiplied by
+    multiplier.
+    """
+    match = RE_DF_SIZE.fullmatch(value)
+    if not match:
+        return -1
+
+    value, unit = match.groups()
+    value = float(value.replace(",", "."))
+    if unit:
+        return value * SIZE_PREFIXES[unit.upper()]
+
+    return value * multiplier
+
+
+def parse_getprop(getprop_output):
+    """Parse output of getprop and return dict of prop names and their
+    values. Values spanning multiple lines are kept whole.
+    """
+    return dict(RE_GETPROP.findall(getprop_output))
 
 
 def extract_identity(device):
@@ -419,74 +543,50 @@ def extract_identity(device):
     #serial = run_extraction_command(device, "iserial")
     propnames = OrderedDict([
         # OS
-        ("[ro.build.version.release]", "android_version"),
-        ("[ro.build.version.sdk]", "android_api_level"),
-        ("[ro.build.id]", "android_build_id"),
-        ("[ro.build.fingerprint]", "android_build_fingerprint"),
+        ("ro.build.version.release", "android_version"),
+        ("ro.build.version.sdk", "android_api_level"),
+        ("ro.build.id", "android_build_id"),
+        ("ro.build.fingerprint", "android_build_fingerprint"),
         # AFTERMARKET OS
         # only one of these will be available, if any at all
-        ("[ro.build.version.fireos]", "aftermarket_firmware"),
-        ("[ro.miui.ui.version.name]", "aftermarket_firmware"),
-        ("[ro.oxygen.version]", "aftermarket_firmware"),
-        ("[ro.build.version.opporom]", "aftermarket_firmware"),
-        ("[ro.cm.version]", "aftermarket_firmware"),
-        ("[ro.lineage.version]", "aftermarket_firmware"),
-        ("[ro.aokp.version]", "aftermarket_firmware"),
-        ("[ro.pa.version]", "aftermarket_firmware"),
-        ("[ro.omni.version]", "aftermarket_firmware"),
-        ("[ro.rr.version]", "aftermarket_firmware"),
-        ("[ro.modversion]", "aftermarket_firmware_version"),
+        ("ro.build.version.fireos", "aftermarket_firmware"),
+        ("ro.miui.ui.version.name", "aftermarket_firmware"),
+        ("ro.oxygen.version", "aftermarket_firmware"),
+        ("ro.build.version.opporom", "aftermarket_firmware"),
+        ("ro.cm.version", "aftermarket_firmware"),
+        ("ro.lineage.version", "aftermarket_firmware"),
+        ("ro.aokp.version", "aftermarket_firmware"),
+        ("ro.pa.version", "aftermarket_firmware"),
+        ("ro.omni.version", "aftermarket_firmware"),
+        ("ro.rr.version", "aftermarket_firmware"),
+        ("ro.modversion", "aftermarket_firmware_version"),
         # AliOS, LeWaOS, Baidu Yi, CopperheadOS
         # IDENTITY
         # Sony devices specify human-readable model name in prop key [ro.semc.product.name]
-        ("[ro.boot.serialno]", "device_serial_number"),
-        ("[ro.product.model]", "device_model"),
-        ("[ro.product.manufacturer]", "device_manufacturer"),
-        ("[ro.product.device]", "device_device"),
-        ("[ro.product.name]", "device_name"),
-        ("[ro.product.brand]", "device_brand"),
+        ("ro.boot.serialno", "device_serial_number"),
+        ("ro.product.model", "device_model"),
+        ("ro.product.manufacturer", "device_manufacturer"),
+        ("ro.product.device", "device_device"),
+        ("ro.product.name", "device_name"),
+        ("ro.product.brand", "device_brand"),
         # CPU
-        ("[ro.product.cpu.abi]", "abi1"),
-        ("[ro.product.cpu.abi2]", "abi2"),
-        ("[ro.product.cpu.abilist]", "abilist"),
-        ("[ro.board.platform]", "board"),
+        ("ro.product.cpu.abi", "abi1"),
+        ("ro.product.cpu.abi2", "abi2"),
+        ("ro.product.cpu.abilist", "abilist"),
+        ("ro.board.platform", "board"),
         # PATHS
-        ("[dalvik.vm.stack-trace-file]", "anr_trace_path"),
-        ("[internal_sd_path]", "internal_sd_path"),
-        ("[external_sd_path]", "external_sd_path"),
+        ("dalvik.vm.stack-trace-file", "anr_trace_path"),
+        ("internal_sd_path", "internal_sd_path"),
+        ("external_sd_path", "external_sd_path"),
         # OTHER
-        ("[ro.boot.hardware.ddr]", "ram_type"),
-        ("[ro.sf.lcd_density]", "display_density"),
+        ("ro.boot.hardware.ddr", "ram_type"),
+        ("ro.sf.lcd_density", "display_density"),
     ])
 
-    getprop = run_extraction_command(device, "getprop").splitlines()
-    continued_value = list()
-    multiline_prop = False
-    for line in getprop:
-        if not line:
-            continue
-
-        if multiline_prop:
-            # prop name is kept from last loop
-            prop_value += line.strip()
-        else:
-            prop_name, prop_value = line.split(": ", maxsplit=1)
-
-        if prop_value[-1] != "]":
-            multiline_prop = True
-            continue
-
-        multiline_prop = False
-
-        prop_value = prop_value.strip("\n\r []")
-        if not prop_value:
-            continue
-        try:
-            destination = propnames[prop_name]
-        except KeyError:
-            continue
-
-        device.info_dict[destination] = prop_value.strip()
+    for prop_name, destination in propnames.items():
+        prop_value = device.props.get(prop_name, "").strip()
+        if prop_value:
+            device.info_dict[destination] = prop_value
 
     if device.info_dict["aftermarket_firmware"] is None:
         if device.info_dict["aftermarket_firmware_version"] is not None:
@@ -790,11 +890,13 @@ def extract_storage(device):
     # TODO: Some devices specify only the directory containing the trace file and not the file itself
     # Check whether there is any difference in traces on those devices
 
-    if not device.is_dir(internal_sd):
-        guesses = ["/mnt/sdcard", "/storage/emulated/legacy", "/mnt/shell/emulated/0"]
-
+    # all guesses are checked at once, along with the reported path
+    guesses = ["/mnt/sdcard", "/storage/emulated/legacy", "/mnt/shell/emulated/0"]
+    candidates = [internal_sd] + guesses if internal_sd else guesses
+    stats = device.stat_many(candidates)
+    if not internal_sd or stats[internal_sd].type != "dir":
         for guess in guesses:
-            if device.is_dir(guess):
+            if stats[guess].type == "dir":
                 internal_sd = guess
                 break
 
@@ -806,7 +908,10 @@ def extract_storage(device):
        "permission denied" in external_sd_space:
         filesystem, size, used, free = ["Unavailable" for x in range(4)]
     else:
-        filesystem, size, used, free = df_parser(external_sd_space.strip())[0]
+        try:
+            filesystem, size, used, free = df_parser(external_sd_space.strip())[0]
+        except IndexError:
+            filesystem, size, used, free = ["Unavailable" for x in range(4)]
 
     device.info_dict["external_sd_capacity"] = size
     device.info_dict["external_sd_free"] = free
@@ -816,7 +921,10 @@ def extract_storage(device):
        "permission denied" in internal_sd_space:
         filesystem, size, used, free = ["Unavailable" for x in range(4)]
     else:
-        filesystem, size, used, free = df_parser(internal_sd_space.strip())[0]
+        try:
+            filesystem, size, used, free = df_parser(internal_sd_space.strip())[0]
+        except IndexError:
+            filesystem, size, used, free = ["Unavailable" for x in range(4)]
 
     device.info_dict["internal_sd_capacity"] = size
     device.info_dict["internal_sd_free"] = free
@@ -831,9 +939,147 @@ def extract_available_commands(device):
 
 
 def extract_installed_packages(device):
-    """Extract a list of installed system and third-party packages."""
+    """Extract a list of installed system and third-party packages,
+    and the package index.
+    """
     extract_system_packages(device)
-    extract_thirdparty_packages(device)
+    extract_package_index(device)
+
+
+def parse_package_list(package_list, system_apps=()):
+    """Parse output of 'pm list packages' with any of the options -f, -U,
+    -i and --show-versioncode. Return dict of package names and their
+    PackageInfo. Packages listed in system_apps are marked as system,
+    if system_apps is empty packages installed in one of SYSTEM_PATHS
+    are marked instead.
+    """
+    system_apps = set(system_apps)
+    index = {}
+    for line in package_list.splitlines():
+        if not line.startswith("package:"):
+            continue
+
+        fields = line[8:].split()
+        if not fields:
+            continue
+
+        # path is separated with the last '=', as paths may contain it
+        path, _, name = fields[0].rpartition("=")
+        uid = version_code = installer = None
+        for field in fields[1:]:
+            if field.startswith("uid:"):
+                uid = field[4:]
+            elif field.startswith("versionCode:"):
+                version_code = field[12:]
+            elif field.startswith("installer="):
+                installer = field[10:]
+                if installer == "null":
+                    installer = None
+
+        if system_apps:
+            system = name in system_apps
+        else:
+            system = path.startswith(SYSTEM_PATHS)
+        index[name] = PackageInfo(
+            name, path or None, uid, version_code, installer, system)
+
+    return index
+
+
+def index_packages(device, index):
+    """Store package index and lists derived from it in info_dict."""
+    by_installer = {}
+    for package in index.values():
+        by_installer.setdefault(package.installer, set()).add(package.name)
+
+    device.info_dict["package_index"] = index
+    device.info_dict["packages_by_installer"] = by_installer
+    device._package_index_time = monotonic()
+    third_party = [x.name for x in index.values() if not x.system]
+    device.info_dict["third-party_apps"] = third_party if third_party else "-none-"
+
+
+def refresh_package(device, name):
+    """Update info of a single package in device's package index, after
+    it has been installed or uninstalled.
+
+    Only packages whose names contain the given name are listed. If
+    any other package in that listing differs from the index, or the
+    index is older than PACKAGE_INDEX_TTL, the whole index is extracted
+    again instead.
+    Return PackageInfo of the package, or None if it is not installed.
+    """
+    index = device.info_dict["package_index"]
+    if index is None or device._package_index_time is None or \
+            monotonic() - device._package_index_time > PACKAGE_INDEX_TTL:
+        LOGGER.debug("Package index is missing or outdated, listing all packages")
+        device.extract_data(limit_to=["installed_packages"], force_extract=True)
+        return (device.info_dict["package_index"] or {}).get(name)
+
+    system_apps = device.info_dict["system_apps"] or ()
+    listed = parse_package_list(
+        device.shell_command(*INFO_SOURCES["package_list"], name,
+                             return_output=True, as_list=False),
+        system_apps)
+
+    if not listed:
+        # package manager does not support the options, fall back to
+        # checking whether the package is installed at all
+        paths = device.shell_command(
+            "pm", "path", name, return_output=True, as_list=False)
+        if "package:" in paths:
+            listed[name] = index.get(name) or PackageInfo(
+                name, None, None, None, None, name in system_apps)
+
+    package = listed.pop(name, None)
+    for other in listed.values():
+        if index.get(other.name) != other:
+            LOGGER.info("Package index is out of date (%s changed), listing all packages",
+                        other.name)
+            device.extract_data(limit_to=["installed_packages"], force_extract=True)
+            return (device.info_dict["package_index"] or {}).get(name)
+
+    index = dict(index)
+    if package is None:
+        index.pop(name, None)
+    else:
+        index[name] = package
+
+    index_packages(device, index)
+    return package
+
+
+def extract_package_index(device):
+    """Extract index of installed packages with their paths, uids,
+    version codes and installers, with one package manager call.
+    System packages are those listed by extract_system_packages.
+    Package manager of older Android versions does not support all
+    options, in which case lists of system and third-party packages are
+    extracted and the rest of package info is unknown.
+    """
+    system_apps = device.info_dict["system_apps"] or ()
+    package_list = run_extraction_command(
+        device, "package_list", use_cache=False, keep_cache=False)
+    index = parse_package_list(package_list, system_apps)
+
+    if index and not system_apps:
+        LOGGER.debug("System packages were not listed, telling them apart by paths")
+        device.info_dict["system_apps"] = [x.name for x in index.values() if x.system]
+
+    if not index:
+        LOGGER.debug("Could not list packages with details, falling back to names only")
+        extract_system_packages(device)
+        system_apps = device.info_dict["system_apps"]
+        extract_thirdparty_packages(device)
+        third_party = device.info_dict["third-party_apps"]
+        if third_party == "-none-":
+            third_party = ()
+
+        index = {x:PackageInfo(x, None, None, None, None, True) for x in system_apps}
+        index.update(
+            (x, PackageInfo(x, None, None, None, None, False)) for x in third_party)
+
+    index_packages(device, index)
 
 
 def extract_system_packages(device):
@@ -875,3 +1121,73 @@ def extract_thirdparty_packages(device):
 
     if count == 0:
         device.info_dict["third-party_apps"] = "-none-"
+
+
+# info group name : (extraction function, info sources, produced info keys)
+# Listed sources are always read by the group and are fetched from device
+# before extraction begins, sources read only conditionally are omitted.
+# Groups are extracted in the order in which they appear below.
+INFO_GROUPS = OrderedDict()
+INFO_GROUPS["identity"] = (
+    extract_identity, ("getprop", "kernel_version"),
+    ("aftermarket_firmware", "aftermarket_firmware_version", "android_api_level",
+     "android_build_fingerprint", "android_build_id", "android_version",
+     "anr_trace_path", "board", "cpu_abis", "cpu_architecture", "device_brand",
+     "device_device", "device_manufacturer", "device_model", "device_name",
+     "device_serial_number", "display_density", "kernel_version"))
+INFO_GROUPS["chipset"] = (
+    extract_chipset, ("meminfo", "cpuinfo"),
+    ("board", "cpu_features", "ram_capacity"))
+INFO_GROUPS["cpu"] = (
+    extract_cpu, ("cpu_data",),
+    ("cpu_clock_range", "cpu_summary", "cpu0_clock_intervals", "cpu0_core_count",
+     "cpu0_max_frequency", "cpu0_min_frequency"))
+INFO_GROUPS["gpu"] = (
+    extract_gpu, ("surfaceflinger_dump",),
+    ("gles_extensions", "gles_texture_compressions", "gles_version", "gpu_model",
+     "gpu_vendor"))
+INFO_GROUPS["display"] = (
+    extract_display, ("surfaceflinger_dump",),
+    ("display_density", "display_resolution", "display_x-dpi", "display_y-dpi"))
+INFO_GROUPS["features"] = (
+    extract_features, ("device_features",),
+    ("device_features", "device_notable_features"))
+INFO_GROUPS["storage"] = (
+    extract_storage, ("shell_environment", "external_sd_space", "internal_sd_space"),
+    ("external_sd_capacity", "external_sd_free", "external_sd_path",
+     "internal_sd_capacity", "internal_sd_free", "internal_sd_path"))
+INFO_GROUPS["available_commands"] = (
+    extract_available_commands, ("available_commands",), ("shell_commands",))
+# third-party apps are never cached, so there is no point in prefetching them
+INFO_GROUPS["installed_packages"] = (
+    extract_installed_packages, ("system_apps",),
+    ("package_index", "packages_by_installer", "system_apps", "third-party_apps"))
+
+# info key : info groups producing it
+KEY_GROUPS = {}
+for group_name, group in INFO_GROUPS.items():
+    for info_key in group[2]:
+        KEY_GROUPS.setdefault(info_key, []).append(group_name)
+del group_name, group, info_key
+
+
+def groups_for_keys(info_keys):
+    """Return list of info groups producing given info keys."""
+    groups = []
+    for key in info_keys:
+        key_groups = KEY_GROUPS.get(key)
+        if not key_groups:
+            raise ValueError(f"No info group produces key '{key}'")
+
+        groups.extend(x for x in key_groups if x not in groups)
+
+    return groups
+
+
+def sources_for_groups(group_names):
+    """Return list of info sources read by given info groups."""
+    sources = []
+    for group_name in group_names:
+        sources.extend(x for x in INFO_GROUPS[group_name][1] if x not in sources)
+
+    return sources
@@ -1,10 +1,16 @@
 """Main module combining operations on apks and devices"""
+import re
 import sys
 import logging
 from pathlib import Path
 from time import strftime
 
 import helper
+import helper.cache
+import helper.device
+import helper.adb_client
+import helper.compat
+import helper.extract_data
 from helper.apk import App
 
 LOGGER = logging.getLogger(__name__)
@@ -15,13 +21,25 @@ LOGGER = logging.getLogger(__name__)
 
 #FIXME: install should take two positional arguments: apk file and obb file list
 def install(device, apk_file, obb_files=(), install_location="automatic",
-            stdout_=sys.stdout, **kwargs):
+            skip_identical=False, stdout_=None, **kwargs):
     """Install an app.
+    If skip_identical is true, installation of the apk is skipped if
+    the same version was already installed from identical files.
     """
+    if stdout_ is None:
+        stdout_ = sys.stdout
     apk_file = App(apk_file)
     stdout_.write(f"\nINSTALLING: {apk_file.app_name}\n")
 
-    if install_app(device, apk_file, **kwargs):
+    skipped = skip_identical and installed_identical(
+        device, apk_file, kwargs.get("split_files", ()))
+    if skipped:
+        stdout_.write(
+            f"SKIPPED: {apk_file.display_name} v. {apk_file.version_name} "
+            f"({apk_file.version_code}) is already installed from identical apk\n")
+
+    if skipped or install_app(device, apk_file, install_location=install_location,
+                              stdout_=stdout_, **kwargs):
         if obb_files:
             if apk_file.app_name.startswith("Unknown"):
                 stdout_.write("ERROR: Unknown app name, cannot push obb files!\n")
@@ -34,75 +52,249 @@ def install(device, apk_file, obb_files=(), install_location="automatic",
                     stdout_.write("ERROR: Failed to copy " + obb + "\n")
                     return False
 
-        stdout_.write(f"\nSuccesfully installed {apk_file.app_name}\n")
+        if not skipped:
+            stdout_.write(f"\nSuccesfully installed {apk_file.app_name}\n")
         return True
 
     return False
 
 
+def installed_identical(device, apk_file, split_files=()):
+    """Check if the app is installed on device from exactly the same
+    files: same package, version code and contents of the base and
+    split apks (compared with sha256sum on device, which also covers
+    the apks' signatures).
+    Return True if installing the apk again would change nothing.
+    """
+    if apk_file.app_name.startswith("Unknown"):
+        return False
+
+    package = helper.extract_data.refresh_package(device, apk_file.app_name)
+    if package is None:
+        return False
+
+    version_code = package.version_code
+    if version_code is None:
+        # package manager did not list version codes
+        dump = device.shell_command("dumpsys", "package", apk_file.app_name,
+                                    return_output=True, as_list=False)
+        version_code = re.search("versionCode=([0-9]+)", dump)
+        version_code = version_code.group(1) if version_code else None
+
+    if version_code != str(apk_file.version_code):
+        LOGGER.debug("Installed version code %s differs from %s",
+                     version_code, apk_file.version_code)
+        return False
+
+    if "sha256sum" not in (device.info_dict["shell_commands"] or ()):
+        LOGGER.info("sha256sum not available on device, cannot compare apks")
+        return False
+
+    remote_paths = []
+    for line in device.shell_command("pm", "path", apk_file.app_name,
+                                     return_output=True, as_list=True):
+        if line.startswith("package:"):
+            remote_paths.append(line[8:].strip())
+
+    local_paths = [apk_file.host_path, *split_files]
+    if len(remote_paths) != len(local_paths):
+        return False
+
+    remote_hashes = []
+    for line in device.shell_command(
+            "sha256sum", *[helper.device.shell_quote(x) for x in remote_paths],
+            return_output=True, as_list=True):
+        if line.strip():
+            remote_hashes.append(line.split()[0].lower())
+
+    local_hashes = [helper.cache.apk_sha256(x) for x in local_paths]
+    return sorted(remote_hashes) == sorted(local_hashes)
+
+
 def install_app(device, apk_file, install_location="automatic",
-                installer_name="android.helper", keep_data=False, stdout_=sys.stdout):
-    """Install an application from a local apk file."""
+                installer_name="android.helper", keep_data=False, split_files=(),
+                stdout_=None):
+    """Install an application from a local apk file.
+    Split apks of the application can be given in split_files.
+    """
+    if stdout_ is None:
+        stdout_ = sys.stdout
     possible_install_locations = {"automatic":"", "external":"-s", "internal":"-f"}
 
     if apk_file.app_name.startswith("Unknown"):
         LOGGER.warning("This app does not appear to be a valid .apk archive")
     else:
         is_compatible = apk_file.check_compatibility(device)
-        if not is_compatible[0]:
+        if is_compatible[0] is None:
+            stdout_.write("WARNING: Could not check if this apk and device are compatible!\n")
+        elif not is_compatible[0]:
             stdout_.write("WARNING: This apk and device are not compatible!\n")
-            for reason in is_compatible[1]:
-                stdout_.write(reason + "\n")
+        for reason in is_compatible[1]:
+            stdout_.write(reason + "\n")
 
     device.extract_data(limit_to=["installed_packages"])
+    installed = installed_package(device, apk_file.app_name)
 
-    if apk_file.app_name in device.info_dict["third-party_apps"]:
+    if installed and not installed.system:
         stdout_.write("WARNING: Different version of the app already installed\n")
         if not uninstall_app(device, apk_file, keep_data, stdout_=stdout_):
             stdout_.write("ERROR: Could not uninstall the app!\n")
             return False
-    elif apk_file.app_name in device.info_dict["system_apps"]:
+    elif installed:
         stdout_.write("WARNING: This app already exists on device as a system app!\n")
         stdout_.write("         System apps can only be upgraded to newer versions.\n")
 
-    apk_filename = Path(apk_file.host_path).name
-    destination = ("/data/local/tmp/helper_" + apk_filename).replace(" ", "_")
+    options = ["-r", "-i", installer_name]
+    if possible_install_locations[install_location]:
+        options.append(possible_install_locations[install_location])
+    apk_paths = [Path(apk_file.host_path)] + [Path(x) for x in split_files]
 
-    stdout_.write("Copying the apk file to device...\n")
-    device.adb_command("push", apk_file.host_path, destination, stdout_=stdout_)
-
-    if not device.is_file(destination):
-        stdout_.write("ERROR: Could not copy apk file to device\n")
+    process_log = None
+    api_level = int(device.info_dict["android_api_level"] or 0)
+    if split_files:
+        stream = api_level >= helper.device.SESSION_INSTALL_MIN_API
+    else:
+        stream = api_level >= helper.device.STREAM_INSTALL_MIN_API
+    if stream:
+        stdout_.write(f"Installing {apk_file.display_name}...\n")
+        stdout_.write(
+            f"Please check your device, as it may now ask you to confirm the installation.\n")
+        try:
+            process_log = stream_install(device, apk_paths, options)
+        except helper.adb_client.AdbConnectionError as error:
+            LOGGER.debug("Could not stream the apk, falling back to staging: %s", error)
+        except (helper.adb_client.AdbClientError, OSError) as error:
+            process_log = f"{error}\n"
+    elif split_files:
+        stdout_.write("ERROR: Split apks can only be installed on Android 5.0 or newer\n")
         return False
 
-    stdout_.write(f"Installing {apk_file.display_name}...\n")
-    stdout_.write(
-        f"Please check your device, as it may now ask you to confirm the installation.\n")
-
-    destination = f"'{destination}'"
-    device.shell_command("pm", "install", "-r", "-i", installer_name,
-                         possible_install_locations[install_location],
-                         destination, stdout_=stdout_)
-    device.shell_command("rm", destination, stdout_=stdout_)
-
-
-    device.extract_data(limit_to=["installed_packages"], force_extract=True)
+    if process_log is None:
+        process_log = staged_install(device, apk_paths[0], options, stdout_=stdout_)
+        if process_log is None:
+            return False
 
-    # TODO: detect installation failure for system apps
-    if apk_file.app_name not in device.info_dict["third-party_apps"]:
+    if "success" not in process_log.lower():
         stdout_.write("ERROR: App could not be installed!\n")
+        stdout_.write(process_log.strip() + "\n")
         return False
 
+    helper.extract_data.refresh_package(device, apk_file.app_name)
+
     stdout_.write("Installation completed!\n")
     return True
 
 
-def push_obb(device, obb_file, app_name, stdout_=sys.stdout):
+def check_compatibility(apk_files, devices, stdout_=None):
+    """Check every apk against every device and write a report.
+    Return list of rows (one for every apk) of (compatible, reasons)
+    tuples (one for every device).
+    """
+    if stdout_ is None:
+        stdout_ = sys.stdout
+    apps = [App(apk_file) for apk_file in apk_files]
+    rows = helper.compat.check_matrix(apps, devices)
+    for app, row in zip(apps, rows):
+        compatible_count = sum(compatible is True for compatible, _ in row)
+        stdout_.write(f"\n{app.display_name} ({app.app_name}) - "
+                      f"compatible with {compatible_count} of "
+                      f"{len(devices)} devices\n")
+        for device, (compatible, reasons) in zip(devices, row):
+            if compatible:
+                stdout_.write(f"    {device.name}: OK\n")
+                continue
+
+            status = "UNKNOWN" if compatible is None else "INCOMPATIBLE"
+            stdout_.write(f"    {device.name}: {status}\n")
+            for reason in reasons:
+                stdout_.write(f"        {reason}\n")
+
+    return rows
+
+
+def stream_install(device, apk_paths, options):
+    """Install apks by streaming them straight to the package manager,
+    without copying them to device's storage first. Several apks
+    (base and splits of one app) are installed in one install session.
+
+    Single apks require Android 6.0 (API 23) or newer, several apks
+    Android 5.0 (API 21) or newer.
+    Return package manager's output.
+    """
+    if int(device.info_dict["android_api_level"] or 0) >= 24:
+        package_manager = "cmd package"
+    else:
+        package_manager = "pm"
+    options = " ".join(options)
+
+    if len(apk_paths) == 1:
+        size = apk_paths[0].stat().st_size
+        with apk_paths[0].open(mode="rb") as apk:
+            return device.exec_command(
+                f"{package_manager} install {options} -S {size}", apk, size)
+
+    total_size = sum(path.stat().st_size for path in apk_paths)
+    process_log = device.exec_command(
+        f"{package_manager} install-create {options} -S {total_size}")
+    session = re.search(r"\[(\d+)\]", process_log)
+    if not session:
+        return process_log
+
+    session = session.group(1)
+    committed = False
+    try:
+        for index, path in enumerate(apk_paths):
+            size = path.stat().st_size
+            with path.open(mode="rb") as apk:
+                process_log = device.exec_command(
+                    f"{package_manager} install-write -S {size} {session} {index}.apk -",
+                    apk, size)
+            if "success" not in process_log.lower():
+                return process_log
+
+        committed = True
+        return device.exec_command(f"{package_manager} install-commit {session}")
+    finally:
+        if not committed:
+            try:
+                device.exec_command(f"{package_manager} install-abandon {session}")
+            except (helper.adb_client.AdbClientError, helper.device.DeviceOfflineError,
+                    OSError) as error:
+                LOGGER.debug("Could not abandon install session %s: %s", session, error)
+
+
+def staged_install(device, apk_path, options, stdout_=None):
+    """Install an apk by copying it to device's temporary directory
+    and installing it from there.
+    Return package manager's output or None if the apk could not be
+    copied.
+    """
+    if stdout_ is None:
+        stdout_ = sys.stdout
+    destination = ("/data/local/tmp/helper_" + apk_path.name).replace(" ", "_")
+
+    stdout_.write("Copying the apk file to device...\n")
+    if not device.push(apk_path, destination):
+        stdout_.write("ERROR: Could not copy apk file to device\n")
+        return None
+
+    stdout_.write(f"Installing {apk_path.name}...\n")
+    stdout_.write(
+        f"Please check your device, as it may now ask you to confirm the installation.\n")
+
+    destination = f"'{destination}'"
+    process_log = device.shell_command(
+        "pm", "install", *options, destination, return_output=True, as_list=False)
+    device.shell_command("rm", destination, return_output=True)
+    return process_log
+
+
+def push_obb(device, obb_file, app_name, stdout_=None):
     """Push obb expansion file to app's obb folder on device's
     internal SD card.
     """
-    device.extract_data(limit_to=["storage"])
-
+    if stdout_ is None:
+        stdout_ = sys.stdout
     # Prepare the target directory
     obb_folder = device.info_dict["internal_sd_path"] + "/Android/obb"
     device.shell_command("mkdir", obb_folder, return_output=True)
@@ -118,26 +310,32 @@ def push_obb(device, obb_file, app_name, stdout_=sys.stdout):
         device.info_dict["internal_sd_path"], "Android/obb", app_name, obb_name])
 
     #pushing obb in two steps - some devices block pushing directly to obb folder
-    device.adb_command("push", obb_file, device.info_dict["internal_sd_path"] + "/" + obb_name,
-                       stdout_=stdout_)
+    # obb files can be huge, interrupted pushes are resumed
+    obb_temp_file = device.info_dict["internal_sd_path"] + "/" + obb_name
+    if not device.push(obb_file, obb_temp_file, resume=True):
+        stdout_.write("ERROR: Could not copy obb file to device.\n")
+        return False
+
     device.shell_command(
-        "mv", f"'{device.info_dict['internal_sd_path']}/{obb_name}'",
-        f"'{obb_target_file}'", stdout_=stdout_)
+        "mv", helper.device.shell_quote(obb_temp_file),
+        helper.device.shell_quote(obb_target_file), stdout_=stdout_)
 
-    if device.is_file(obb_target_file):
+    if device.stat(obb_target_file):
         return True
 
     stdout_.write("ERROR: Pushed obb file was not found in destination folder.\n")
     return False
 
 
-def record(device, output=".", name=None, silent=False, stdout_=sys.stdout):
+def record(device, output=".", name=None, silent=False, stdout_=None):
     """Start recording device's screen.
     Recording can be stopped by either reaching the time limit, or
     pressing ctrl+c. After the recording has stopped, the helper
     confirms that the recording has been saved to device's storage and
     copies it to drive.
     """
+    if stdout_ is None:
+        stdout_ = sys.stdout
     # existence of "screenrecord" can depend on manufacturer and
     # version of Android
     #
@@ -145,7 +343,8 @@ def record(device, output=".", name=None, silent=False, stdout_=sys.stdout):
     # regular users from their device - hold the power button and it should
     # appear alongside reset and shutdown options
 
-    device.extract_data(limit_to=["available_commands", "storage", "identity"])
+    # identity is needed for device's filename
+    device.extract_data(limit_to=["identity"])
 
     if 'screenrecord' not in device.info_dict["shell_commands"]:
         stdout_.write(
@@ -202,56 +401,83 @@ def record(device, output=".", name=None, silent=False, stdout_=sys.stdout):
         pass
     stdout_.write("\nRecording stopped.\n")
 
-    device.reconnect(stdout_=stdout_)
-
-    if not device.is_file(remote_recording):
-        stdout_.write("ERROR: Recorded video was not found on device!\n")
+    if not device.reconnect(stdout_=stdout_):
         return False
 
     output = Path(output) / Path(remote_recording).name
-
-    device.adb_command("pull", remote_recording, output, stdout_=stdout_)
-    if output.is_file():
+    if device.pull(remote_recording, output):
         return Path(output).resolve()
 
-    stdout_.write("ERROR: Could not copy recorded video!\n")
+    stdout_.write("ERROR: Could not copy recorded video from device!\n")
     return False
 
 
-def pull_traces(device, output=None, stdout_=sys.stdout):
+def pull_traces(device, output=None, stdout_=None):
     """Copy the 'traces' file to the specified folder."""
+    if stdout_ is None:
+        stdout_ = sys.stdout
     if output is None:
         output = Path().resolve()
     else:
         output = Path(output).resolve()
 
-    device.extract_data(limit_to=["storage", "identity"])
-
+    # identity is needed for device's filename
+    device.extract_data(limit_to=["identity"])
     anr_filename = "".join([device.filename, "_anr_",
                             strftime("%Y.%m.%d_%H.%M.%S"), ".txt"])
 
     remote_anr_file = "".join([device.info_dict["internal_sd_path"], "/", anr_filename])
     device.shell_command("cat", device.info_dict["anr_trace_path"], ">", remote_anr_file)
 
-    if not device.is_file(remote_anr_file):
-        stdout_.write("ERROR: The file was not found on device!\n")
-        return False
-
-    device.adb_command(
-        "pull", remote_anr_file, output / anr_filename, stdout_=stdout_)
-
-    if (output / anr_filename).is_file():
+    if device.pull(remote_anr_file, output / anr_filename):
         return (output / anr_filename).resolve()
 
-    stdout_.write("ERROR: The file was not copied!\n")
+    stdout_.write("ERROR: The file was not found on device or could not be copied!\n")
     return False
 
 
-def clear_app_data(device, app, stdout_=sys.stdout):
+def installed_package(device, app_name):
+    """Return PackageInfo of package installed on device or None."""
+    return (device.info_dict["package_index"] or {}).get(app_name)
+
+
+def packages_from_installer(device, installer):
+    """Return sorted list of packages installed by given installer."""
+    device.extract_data(limit_to=["installed_packages"])
+    by_installer = device.info_dict["packages_by_installer"] or {}
+    return sorted(by_installer.get(installer, ()))
+
+
+def for_each_package(function):
+    """Wrap cleaner function operating on a package, so that it also
+    accepts "from <installer>", operating on all packages installed by
+    that installer.
+    """
+    def wrapper(device, app, stdout_=None):
+        if stdout_ is None:
+            stdout_ = sys.stdout
+        if not isinstance(app, str) or not app.startswith("from "):
+            return function(device, app, stdout_=stdout_)
+
+        installer = app[5:].strip()
+        packages = packages_from_installer(device, installer)
+        if not packages:
+            stdout_.write(f"No apps installed by {installer} found\n")
+
+        results = [function(device, x, stdout_=stdout_) for x in packages]
+        return all(results)
+
+    wrapper.__doc__ = function.__doc__
+    return wrapper
+
+
+def clear_app_data(device, app, stdout_=None):
     """Clear app data.
 
     The app argument can be either package id or an initialized app object.
     """
+    if stdout_ is None:
+        stdout_ = sys.stdout
     if isinstance(app, str):
         display_name = app
         app_name = app
@@ -272,8 +498,7 @@ def clear_app_data(device, app, stdout_=sys.stdout):
         stdout_.write("Done\n")
         return True
 
-    if app_name not in device.info_dict["system_apps"] and \
-       app_name not in device.info_dict["third-party_apps"]:
+    if not installed_package(device, app_name):
         stdout_.write("ERROR: Application not found on device!\n")
         return False
 
@@ -282,11 +507,13 @@ def clear_app_data(device, app, stdout_=sys.stdout):
     return False
 
 
-def uninstall_app(device, app, keep_data=False, stdout_=sys.stdout):
+def uninstall_app(device, app, keep_data=False, stdout_=None):
     """Uninstall applications from device.
 
     The app argument can be either package id or an initialized app object.
     """
+    if stdout_ is None:
+        stdout_ = sys.stdout
     if isinstance(app, str):
         display_name = app
         app_name = app
@@ -300,10 +527,10 @@ def uninstall_app(device, app, keep_data=False, stdout_=sys.stdout):
         keep_data = ""
 
     device.extract_data(limit_to=["installed_packages"])
-    system_app = False
+    installed = installed_package(device, app_name)
+    system_app = bool(installed and installed.system)
 
-    if app_name in device.info_dict["system_apps"]:
-        system_app = True
+    if system_app:
         stdout_.write(
             f"{display_name} is a system app and cannot be removed completely.\n")
         stdout_.write(f"Resetting {display_name} to factory version...")
@@ -329,8 +556,7 @@ def uninstall_app(device, app, keep_data=False, stdout_=sys.stdout):
         stdout_.write(process_log + "\n")
         return False
 
-    device.extract_data(limit_to=["installed_packages"])
-    if app_name in device.info_dict["third-party_apps"]:
+    if helper.extract_data.refresh_package(device, app_name):
         stdout_.write("ERROR: App could not be removed!\n")
         stdout_.write(process_log + "\n")
         return False
@@ -339,13 +565,15 @@ def uninstall_app(device, app, keep_data=False, stdout_=sys.stdout):
     return True
 
 
-def remove(device, target, recursive=False, stdout_=sys.stdout):
+def remove(device, target, recursive=False, stdout_=None):
     """Remove file from device.
 
     Returns True after successful removal of the file or if it
     does not exist and False for permission error and unsuccessful
     removal.
     """
+    if stdout_ is None:
+        stdout_ = sys.stdout
     if recursive:
         recursive = "-r"
     else:
@@ -389,8 +617,10 @@ def remove(device, target, recursive=False, stdout_=sys.stdout):
     return False
 
 
-def replace(device, remote, local, stdout_=sys.stdout):
+def replace(device, remote, local, stdout_=None):
     """Replace remote file with user-provided one."""
+    if stdout_ is None:
+        stdout_ = sys.stdout
     if not remove(device, remote, stdout_=stdout_):
         stdout_.write(f"Cannot replace {remote}\n")
         return False
@@ -398,9 +628,7 @@ def replace(device, remote, local, stdout_=sys.stdout):
     stdout_.write(f"Placing {Path(local).name} in its place...")
     stdout_.flush()
 
-    device.adb_command("push", local, remote, stdout_=stdout_)
-
-    if not device.is_file(remote):
+    if not device.push(local, remote):
         stdout_.write("ERROR: The file was not found on device!\n")
         return False
 
@@ -419,8 +647,8 @@ def replace(device, remote, local, stdout_=sys.stdout):
 CLEANER_OPTIONS = {"remove"           :(remove,         1, [False]),
                    "remove_recursive" :(remove,         1, [True]),
                    "replace"          :(replace,        2, []),
-                   "uninstall"        :(uninstall_app,  1, []),
-                   "clear_data"       :(clear_app_data, 1, [])
+                   "uninstall"        :(for_each_package(uninstall_app),  1, []),
+                   "clear_data"       :(for_each_package(clear_app_data), 1, [])
                   }
 
 
@@ -488,10 +716,12 @@ def parse_cleaner_config(config=helper.CLEANER_CONFIG):
 
 
 def clean(device, config=None, parsed_config=None, force=False,
-          stdout_=sys.stdout):
+          stdout_=None):
     """Clean the specified device using instructions contained in
     cleaner_config file.
     """
+    if stdout_ is None:
+        stdout_ = sys.stdout
     # TODO: Count the number of removed files / apps
     bad_config = ""
 
@@ -511,37 +741,9 @@ def clean(device, config=None, parsed_config=None, force=False,
         stdout_.write("Empty config! Cannot clean!\n")
         return False
 
-    #FIXME: remove interface-related code
-    # this must only live in GUI/CLI modules
-    # Ask user to confirm cleaning
     if not force:
-        stdout_.write("The following actions will be performed:\n")
-        indent = 4
-        for key, action in [("remove_recursive", "remove"),
-                            ("remove", "remove"),
-                            ("clear_data", "clear app data"),
-                            ("uninstall", "uninstall")]:
-
-            if key not in parsed_config:
-                continue
-            for item in parsed_config[key]:
-                stdout_.write(f"{action} : {item[0]} \n")
-
-        if "replace" in parsed_config:
-            for pair in parsed_config["replace"]:
-                stdout_.write(f"\nThe file: {pair[0]}\n")
-                stdout_.write(f"{indent * ' '}will be replaced with:\n")
-                stdout_.write(f"{indent * '  '}{pair[1]} \n")
-
-        stdout_.write("\nContinue?\n")
-
-        while True:
-            usr_choice = input("Y/N : ").strip().upper()
-            if usr_choice == "N":
-                stdout_.write("Cleaning canceled!\n")
-                return False
-            if usr_choice == "Y":
-                break
+        if not confirm_clean(parsed_config, stdout_=stdout_):
+            return False
 
     for option, items in parsed_config.items():
         for value in items:
@@ -549,10 +751,51 @@ def clean(device, config=None, parsed_config=None, force=False,
                                                 *CLEANER_OPTIONS[option][2],
                                                 stdout_=stdout_)
 
+    return True
+
+
+def confirm_clean(parsed_config, stdout_=None):
+    """List actions described by parsed cleaner config and ask user to
+    confirm them. Return True if the user agreed.
+    """
+    if stdout_ is None:
+        stdout_ = sys.stdout
+    #FIXME: remove interface-related code
+    # this must only live in GUI/CLI modules
+    stdout_.write("The following actions will be performed:\n")
+    indent = 4
+    for key, action in [("remove_recursive", "remove"),
+                        ("remove", "remove"),
+                        ("clear_data", "clear app data"),
+                        ("uninstall", "uninstall")]:
+
+        if key not in parsed_config:
+            continue
+        for item in parsed_config[key]:
+            stdout_.write(f"{action} : {item[0]} \n")
+
+    if "replace" in parsed_config:
+        for pair in parsed_config["replace"]:
+            stdout_.write(f"\nThe file: {pair[0]}\n")
+            stdout_.write(f"{indent * ' '}will be replaced with:\n")
+            stdout_.write(f"{indent * '  '}{pair[1]} \n")
+
+    stdout_.write("\nContinue?\n")
+
+    while True:
+        usr_choice = input("Y/N : ").strip().upper()
+        if usr_choice == "N":
+            stdout_.write("Cleaning canceled!\n")
+            return False
+        if usr_choice == "Y":
+            return True
+
 
 def logcat_record(device, *filters, output_file=None, log_format="threadtime",
-                  stdout_=sys.stdout):
+                  stdout_=None):
     """"""
+    if stdout_ is None:
+        stdout_ = sys.stdout
     # TODO: Simultaneously display and write the log if above verbosity threshold
     # e.g. Only display log in the console if verbosity in all filters is above
     # 'info' (that is also why I'm not using logcat -f /path/to/file)
@@ -0,0 +1,186 @@
+"""Long-lived shell sessions on devices.
+
+Instead of starting a new 'adb shell' (and a new sh process on the
+device) for every command, ShellSession keeps one shell open and runs
+commands in it one after another. Output of each command is followed by
+a line with a unique marker and the command's exit code, which is how
+the end of output is found. A session whose command does not finish in
+time is killed and started again with the next command.
+"""
+import re
+import uuid
+import queue
+import logging
+import threading
+import subprocess
+from time import monotonic
+
+import helper
+import helper.device
+
+LOGGER = logging.getLogger(__name__)
+
+# if true, every new Device opens a shell session
+ENABLED = False
+ENCODING = "utf-8"
+# seconds after which a command is considered stuck and the session is
+# started again
+COMMAND_TIMEOUT = 300
+# seconds to wait for a new shell to become ready
+SPAWN_TIMEOUT = 20
+# marker is split in two in the command itself, so that the command
+# echoed back by a terminal never matches it
+SH_MARKER = "printf '\\n%s%s %d\\n' {marker_a} {marker_b} $?\n"
+# command runs in a subshell of the session's shell, so that it cannot
+# change the session's state, and is passed to eval as a single quoted
+# argument, so that unbalanced quotes or unterminated heredocs cannot leave
+# the shell waiting for more input
+SH_RUN_COMMAND = "( eval {} ) 2>&1 </dev/null; "
+# in case adb allocated a terminal, stop it from echoing commands and
+# clear the prompts
+SH_INIT = "stty -echo 2>/dev/null; PS1=''; PS2=''; "
+
+
+class ShellSessionError(Exception):
+    """Shell session ended unexpectedly."""
+
+
+def session_args(serial):
+    """Return command line starting an interactive shell on device."""
+    return (helper.ADB.__fspath__(), "-s", serial, "shell")
+
+
+def _read_lines(stream, lines):
+    """Put lines read from stream into queue, followed by b"" at the
+    end of stream, then close the stream.
+    """
+    try:
+        for line in iter(stream.readline, b""):
+            lines.put(line)
+    except (OSError, ValueError):
+        pass
+    lines.put(b"")
+    stream.close()
+
+
+class ShellSession:
+    """Shell running on device, accepting commands through a pipe.
+
+    The shell is started on first use and started again whenever it
+    exits (for example because the device has been reconnected) or a
+    command does not finish within its timeout.
+    """
+    def __init__(self, serial):
+        self.serial = serial
+        self._process = None
+        self._reader = None
+        self._lines = None
+        self._lock = threading.Lock()
+
+
+    @property
+    def alive(self):
+        """Whether the shell process is running."""
+        return self._process is not None and self._process.poll() is None
+
+
+    def _spawn(self):
+        """Start a new shell process and wait until it is ready."""
+        self.close()
+        LOGGER.debug("Starting shell session on %s", self.serial)
+        self._process = subprocess.Popen(
+            session_args(self.serial), stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self._lines = queue.Queue()
+        self._reader = threading.Thread(
+            target=_read_lines, args=(self._process.stdout, self._lines), daemon=True,
+            name=f"ShellSession-{self.serial}")
+        self._reader.start()
+        # prompt and echoed commands printed before the first marker are
+        # discarded
+        self._send_and_read(SH_INIT, SPAWN_TIMEOUT)
+
+
+    def _send_and_read(self, script, timeout):
+        """Write script followed by SH_MARKER to shell and return lines
+        of output printed before the marker and script's exit code.
+        """
+        marker = uuid.uuid4().hex
+        marker_a, marker_b = "HELPER_SESSION_", marker
+        script += SH_MARKER.format(marker_a=marker_a, marker_b=marker_b)
+        end_line = re.compile(
+            rb"^" + (marker_a + marker_b).encode() + rb" (\d+)\r?$")
+
+        try:
+            self._process.stdin.write(script.encode(ENCODING))
+            self._process.stdin.flush()
+        except OSError as error:
+            self.close()
+            raise ShellSessionError(f"Could not write to shell session: {error}")
+
+        deadline = None if timeout is None else monotonic() + timeout
+        output = []
+        while True:
+            try:
+                line = self._lines.get(
+                    timeout=None if deadline is None else max(0, deadline - monotonic()))
+            except queue.Empty:
+                self.close()
+                raise ShellSessionError(
+                    f"Shell session on {self.serial} did not respond within "
+                    f"{timeout} seconds")
+
+            if not line:
+                self.close()
+                raise ShellSessionError(
+                    f"Shell session on {self.serial} ended unexpectedly")
+
+            match = end_line.match(line)
+            if match:
+                return output, int(match.group(1))
+            output.append(line)
+
+
+    def run(self, *args, timeout=COMMAND_TIMEOUT):
+        """Run a command in the session and return its decoded output
+        and exit code. Arguments are joined with spaces, like adb does.
+
+        If the command does not finish within timeout seconds (None to
+        wait indefinitely), the session is closed and
+        ShellSessionError is raised.
+        """
+        with self._lock:
+            if not self.alive:
+                self._spawn()
+
+            command = " ".join(str(arg) for arg in args)
+            output, exit_code = self._send_and_read(
+                SH_RUN_COMMAND.format(helper.device.shell_quote(command)), timeout)
+
+        # remove the newline printed before the marker
+        output = b"".join(output)
+        output = output[:-2] if output.endswith(b"\r\n") else output[:-1]
+        return output.decode(ENCODING, "replace"), exit_code
+
+
+    def close(self):
+        """Stop the shell process, if it is running."""
+        process, self._process = self._process, None
+        reader, self._reader = self._reader, None
+        if process is None:
+            return
+
+        LOGGER.debug("Closing shell session on %s", self.serial)
+        try:
+            process.stdin.close()
+        except OSError:
+            pass
+        try:
+            process.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        # otherwise the stream is closed by the reader thread, once it is
+        # closed by all processes writing to it
+        if reader is None:
+            process.stdout.close()
@@ -1,9 +1,13 @@
 import sys
+import struct
 import logging
 from pathlib import Path
 
+import pytest
+
+import helper.cache
 from helper import extract_data
-from helper.device import DeviceOfflineError, Device
+from helper.device import DeviceOfflineError, Device, PathStat
 
 LOGGER = logging.getLogger(__name__)
 EXTRACTION_FUNCTIONS = {x[8::]:getattr(extract_data, x) for x in dir(extract_data) if x.startswith("extract_")}
@@ -30,6 +34,8 @@ class DummyDevice(Device):
 
         super().__init__(*args, **kwargs)
         self._status = status
+        # dummies share serial numbers between different dumps
+        self.use_info_cache = False
 
 
     @property
@@ -79,6 +85,12 @@ class DummyDevice(Device):
         return True
 
 
+    def stat_many(self, paths):
+        """Report all dummy paths as existing, accessible directories."""
+        return {path:PathStat(path, True, "dir", False, True, True, True, 0, 0)
+                for path in paths}
+
+
     def load_dummy_data(self, config_dir=None):
         """Load dump data into _init_cache.
         Data in the cache is used for data extraction functions.
@@ -95,3 +107,108 @@ class DummyDevice(Device):
                 if not self.ignore_load_errors:
                     raise
 
+
+class FakeDevice(Device):
+    """Online device answering shell commands with outputs, a dict of
+    argument tuples and their outputs or a function called with the
+    arguments. Arguments of all shell commands are kept in commands.
+    """
+    status = "device"
+
+    def __init__(self, serial="serial", outputs=None):
+        self.outputs = {} if outputs is None else outputs
+        self.commands = []
+        super().__init__(serial)
+        self.use_info_cache = False
+
+
+    def shell_command(self, *args, **kwargs):
+        self.commands.append(args)
+        if callable(self.outputs):
+            output = self.outputs(*args)
+        else:
+            output = self.outputs.get(args, "")
+
+        return output.splitlines() if kwargs.get("as_list") else output
+
+
+@pytest.fixture
+def cache_dir(monkeypatch, tmp_path):
+    """Empty cache directory, used instead of the real one."""
+    path = tmp_path / "cache"
+    monkeypatch.setattr(helper.cache, "CACHE_DIR", path)
+    monkeypatch.setattr(helper.cache, "_APK_HASHES", {})
+    monkeypatch.setattr(helper.cache, "_APK_USAGE", {})
+    return path
+
+
+def string_pool(strings):
+    """Encode strings as an utf-16 string pool chunk."""
+    offsets, data = [], b""
+    for string in strings:
+        offsets.append(len(data))
+        data += struct.pack("<H", len(string)) + string.encode("utf-16-le") + b"\0\0"
+    data += b"\0" * (-len(data) % 4)
+    header_size = 28
+    strings_start = header_size + 4 * len(strings)
+    return struct.pack("<HHIIIIII", 0x0001, header_size, strings_start + len(data),
+                       len(strings), 0, 0, strings_start, 0) \
+           + struct.pack(f"<{len(strings)}I", *offsets) + data
+
+
+def binary_manifest(element):
+    """Encode (name, attributes, children) element tree as binary XML."""
+    strings = []
+    def index(string):
+        if string not in strings:
+            strings.append(string)
+        return strings.index(string)
+
+    def encode(name, attributes, children):
+        attribute_data = b""
+        for key, value in attributes.items():
+            if isinstance(value, str):
+                raw, value_type, data = index(value), 0x03, index(value)
+            elif isinstance(value, bool):
+                raw, value_type, data = 0xFFFFFFFF, 0x12, int(value)
+            elif isinstance(value, tuple):
+                raw, value_type, data = 0xFFFFFFFF, 0x01, value[1]
+            else:
+                raw, value_type, data = 0xFFFFFFFF, 0x10, value
+            attribute_data += struct.pack("<IIIHBBI", 0xFFFFFFFF, index(key),
+                                          raw, 8, 0, value_type, data)
+        chunks = [struct.pack("<HHIIIIIHHHHHH", 0x0102, 16, 36 + len(attribute_data),
+                              1, 0xFFFFFFFF, 0xFFFFFFFF, index(name), 20, 20,
+                              len(attributes), 0, 0, 0) + attribute_data]
+        for child in children:
+            chunks.extend(encode(*child))
+        chunks.append(struct.pack("<HHIIIII", 0x0103, 16, 24, 1, 0xFFFFFFFF,
+                                  0xFFFFFFFF, index(name)))
+        return chunks
+
+    body = b"".join(encode(*element))
+    body = string_pool(strings) + body
+    return struct.pack("<HHI", 0x0003, 8, 8 + len(body)) + body
+
+
+def resource_table(values):
+    """Encode resource table with string resources 0x7f010000 onwards,
+    values is a list of tuples of (default value, 'de' value).
+    """
+    strings = [x for pair in values for x in pair]
+    type_chunks = b""
+    for config, offset in ((b"", 0), (b"de", 1)):
+        config = struct.pack("<I", 64) + config.ljust(60, b"\0")
+        header_size = 20 + len(config)
+        entries = b"".join(struct.pack("<HHIHBBI", 8, 0, 0, 8, 0, 0x03, x * 2 + offset)
+                           for x in range(len(values)))
+        entries_start = header_size + 4 * len(values)
+        type_chunks += struct.pack("<HHIBBHII", 0x0201, header_size,
+                                   entries_start + len(entries), 1, 0, 0,
+                                   len(values), entries_start) + config \
+                       + struct.pack(f"<{len(values)}I", *range(0, 16 * len(values), 16)) \
+                       + entries
+    package = struct.pack("<HHII", 0x0200, 288, 288 + len(type_chunks), 0x7f) \
+              + b"\0" * 276 + type_chunks
+    body = string_pool(strings) + package
+    return struct.pack("<HHII", 0x0002, 12, 12 + len(body), 1) + body
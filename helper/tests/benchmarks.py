@@ -0,0 +1,281 @@
+"""Microbenchmarks of parsers used in info extraction.
+
+Outputs dumped with 'debug-dump' to helper's compat_data directory are
+used as input when available, synthetic outputs are used otherwise.
+
+Run with: python -m helper.tests.benchmarks [benchmark_name ...]
+"""
+import re
+import sys
+import string
+import timeit
+from pathlib import Path
+
+import helper
+from helper import apk
+from helper import extract_data
+
+COMPATIBILITY_DIR = Path(helper.CWD, "compat_data")
+REPEAT = 5
+
+
+def load_dumps(source_name):
+    """Return list of outputs of given info source found in
+    compat_data.
+    """
+    if not COMPATIBILITY_DIR.is_dir():
+        return []
+
+    dumps = []
+    for dump_file in sorted(COMPATIBILITY_DIR.glob(f"*/{source_name}")):
+        with dump_file.open(mode="r", encoding="utf-8") as dump:
+            dumps.append(dump.read())
+
+    return dumps
+
+
+def synthetic_getprop(prop_count=800):
+    """Return getprop-like output with given number of props."""
+    lines = [f"[vendor.synthetic.prop{x}]: [value {x}]" for x in range(prop_count)]
+    lines.insert(prop_count // 2, "[ro.build.fingerprint]: [brand/name/device:9/ID/1:user/release-keys]")
+    lines.insert(prop_count // 3, "[persist.multiline]: [first line\nsecond line]")
+    return "\n".join(lines) + "\n"
+
+
+def legacy_getprop(getprop_output):
+    """Line-by-line getprop parsing, as previously done in
+    extract_identity.
+    """
+    props = {}
+    multiline_prop = False
+    for line in getprop_output.splitlines():
+        if not line:
+            continue
+
+        if multiline_prop:
+            prop_value += line.strip()
+        else:
+            prop_name, prop_value = line.split(": ", maxsplit=1)
+
+        if prop_value[-1] != "]":
+            multiline_prop = True
+            continue
+
+        multiline_prop = False
+        props[prop_name] = prop_value.strip("\n\r []")
+
+    return props
+
+
+def synthetic_df(mount_count=300):
+    """Return df -h like output with given number of mounts."""
+    lines = ["Filesystem                Size      Used Available Use% Mounted on"]
+    for index in range(mount_count):
+        lines.append(f"/dev/block/dm-{index:<10} {index % 9}.{index % 7}G  "
+                     f"{index % 5}.1M  {index % 3 + 1}.2G  {index % 100}% /mnt/{index}")
+    return "\n".join(lines)
+
+
+def legacy_df_parser(df_output):
+    """Column-by-column df parsing, as previously done in
+    extract_data.df_parser.
+    """
+    df_output = [x.split() for x in df_output.splitlines()]
+    index_row = [x.lower() for x in df_output.pop(0)]
+
+    string_to_size = {
+        "1k-blocks":1024,
+        "1024-blocks":1024,
+        "512-blocks":512,
+    }
+    known_size_multiplier = 0
+    for name, size in string_to_size.items():
+        if name in index_row:
+            known_size_multiplier = size
+
+    total_column, used_column, free_column = None, None, None
+    for index, column_name in enumerate(index_row):
+        if column_name in ["1k-blocks", "512-blocks", "1024-blocks", "size"]:
+            total_column = index
+        if column_name in ["used", "%used"]:
+            used_column = index
+        if column_name in ["free", "available", "avail"]:
+            free_column = index
+
+    re_search = re.compile("([0-9.]+)([%A-z]*)")
+    lines = []
+    accepted_chars = set(string.ascii_lowercase + string.digits + ",.%")
+    for row in df_output:
+        if not row:
+            continue
+        if "denied" in row:
+            lines.append((row[0], -1, -1, -1))
+            continue
+
+        values = []
+        for column in (total_column, used_column, free_column):
+            value = row[column].lower() if column else ""
+            if set(value) - accepted_chars:
+                value = ""
+            values.append(value)
+        total_val, used_val, free_val = values
+
+        if total_val:
+            if known_size_multiplier:
+                total_val = float(total_val)* known_size_multiplier
+            else:
+                total_val, total_unit = re_search.search(row[total_column]).groups()
+                if total_unit:
+                    total_val = float(total_val) * extract_data.SIZE_PREFIXES[total_unit.upper()]
+        else:
+            total_val = -1
+
+        if used_val:
+            if "%" in used_val:
+                used_val = re_search.search(used_val).group(1)
+                used_val = float(used_val) * total_val / 100
+            elif known_size_multiplier:
+                used_val = float(used_val) * known_size_multiplier
+            else:
+                used_val, used_unit = re_search.search(used_val).groups()
+                if used_unit:
+                    used_val = float(used_val) * extract_data.SIZE_PREFIXES[used_unit.upper()]
+        else:
+            used_val = -1
+
+        if free_val:
+            if known_size_multiplier:
+                free_val = float(free_val) * known_size_multiplier
+            else:
+                free_val, free_unit = re_search.search(free_val).groups()
+                if free_unit:
+                    free_val = float(free_val) * extract_data.SIZE_PREFIXES[free_unit.upper()]
+        else:
+            free_val = -1
+
+        lines.append((row[0], int(total_val), int(used_val), int(free_val)))
+
+    return lines
+
+
+def synthetic_badging(permission_count=1500, feature_count=500):
+    """Return 'aapt dump badging'-like output of a large app."""
+    lines = [
+        "package: name='com.example.game' versionCode='1042' "
+        "versionName='1.0.42' platformBuildVersionName='9'",
+        "sdkVersion:'16'",
+        "targetSdkVersion:'28'",
+    ]
+    lines.extend(f"uses-permission: name='com.example.permission.P{x}'"
+                 + (" maxSdkVersion='18'" if x % 10 == 0 else "")
+                 for x in range(permission_count))
+    lines.extend(f"application-label-{x}:'Example Game'" for x in range(60))
+    lines.append("application: label='Example Game' icon='res/mipmap/icon.png'")
+    lines.append("launchable-activity: name='com.example.game.MainActivity'  "
+                 "label='' icon=''")
+    lines.extend(f"uses-feature: name='com.example.feature.F{x}'"
+                 for x in range(feature_count))
+    lines.extend(f"uses-feature-not-required: name='com.example.optional.F{x}'"
+                 for x in range(feature_count))
+    lines.extend(f"uses-implied-feature: name='com.example.implied.F{x}' "
+                 f"reason='requested com.example.permission.P{x} permission'"
+                 for x in range(feature_count))
+    lines.append("supports-gl-texture:'GL_OES_compressed_ETC1_RGB8_texture'")
+    lines.append("native-code: 'arm64-v8a' 'armeabi-v7a' 'x86'")
+    return "\n".join(lines) + "\n"
+
+
+def legacy_badging(dump):
+    """Badging parsing with separate regex searches for every field, as
+    previously done in apk.App.from_file.
+    """
+    info = {}
+    search_group = {
+        "app_name" : "(?:name\\=\\')([^\\']*)",
+        "display_name" : "(?:^application\\:\\ label\\=\\')([^\\']*)",
+        "version_name" : "(?:versionName\\=\\')([^\\']*)",
+        "version_code" : "(?:versionCode\\=\\')([^\\']*)",
+        "min_sdk" : "(?:^sdkVersion\\:\\')([^\\']*)",
+        "target_sdk" : "(?:^targetSdkVersion\\:\\')([^\\']*)",
+        "max_sdk" : "(?:^maxSdkVersion\\=\\')([^\\']*)",
+        "supported_abis" : "(?:^native-code\\:\\ )(.*)",
+        "launchable_activity" : "(?:launchable\\-activity\\:\\ name=\\')([^\\']*)",
+        }
+
+    findall_group = {
+        "supported_texture_compressions" : "(?:supports\\-gl\\-texture\\:\\')([^\\']*)",
+        "used_permissions" : "(?:uses\\-permission\\:\\ name\\=\\')([^\\']*)(?:.*max\\-sdkVersion\\=\\')?([^\\']*)",
+        "used_implied_features" : "(?:uses\\-implied\\-feature\\:\\ name\\=\\')([^\\']*)(?:.*reason\\=\\')?([^\\']*)",
+        "used_opt_features" : "(?:uses\\-feature\\-not\\-required\\:\\ name\\=\\')([^\\']*)",
+        "used_features" : "(?:uses\\-feature\\:\\ name\\=\\')([^\\']*)",
+        }
+
+    for key, value in search_group.items():
+        extracted = re.search(value, dump, re.M)
+        if extracted:
+            info[key] = extracted.group(1).strip()
+
+    for key, value in findall_group.items():
+        extracted = re.findall(value, dump, re.M)
+        if extracted:
+            info[key] = extracted
+
+    if "supported_abis" in info:
+        info["supported_abis"] = info["supported_abis"].replace("'", "").strip().split()
+    for key in ("used_implied_features", "used_permissions"):
+        if key in info:
+            info[key] = dict(info[key])
+
+    return info
+
+
+def bench_badging():
+    """aapt badging parsing: single pass vs regex search per field."""
+    dumps = load_dumps("badging") or [synthetic_badging()]
+    return {
+        "parse_badging": lambda: [apk.parse_badging(x) for x in dumps],
+        "legacy": lambda: [legacy_badging(x) for x in dumps],
+    }
+
+
+def bench_getprop():
+    """getprop parsing: regex pass vs legacy line loop."""
+    dumps = load_dumps("getprop") or [synthetic_getprop()]
+    return {
+        "parse_getprop": lambda: [extract_data.parse_getprop(x) for x in dumps],
+        "legacy": lambda: [legacy_getprop(x) for x in dumps],
+    }
+
+
+def bench_df():
+    """df parsing: single pass vs legacy per-column conversion."""
+    dumps = load_dumps("disk_space") or [synthetic_df()]
+    return {
+        "df_parser": lambda: [extract_data.df_parser(x) for x in dumps],
+        "legacy": lambda: [legacy_df_parser(x) for x in dumps],
+    }
+
+
+BENCHMARKS = {
+    "getprop" : bench_getprop,
+    "df" : bench_df,
+    "badging" : bench_badging,
+}
+
+
+def run(names=(), number=200, stdout_=sys.stdout):
+    """Run selected benchmarks (all by default) and print the best time
+    of each variant.
+    """
+    for name, benchmark in BENCHMARKS.items():
+        if names and name not in names:
+            continue
+
+        stdout_.write(f"{name}: {benchmark.__doc__.strip()}\n")
+        for variant, function in benchmark().items():
+            best = min(timeit.repeat(function, number=number, repeat=REPEAT))
+            stdout_.write(f"    {variant:<20} {best / number * 1000:.3f} ms\n")
+
+
+if __name__ == "__main__":
+    run(sys.argv[1:])
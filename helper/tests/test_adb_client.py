@@ -0,0 +1,518 @@
+import io
+import re
+import asyncio
+import socket
+import struct
+import socketserver
+import threading
+import types
+
+import pytest
+
+import helper.device
+import helper.main
+from helper import adb_client
+from helper.async_device import AsyncDevice
+from helper.tests import FakeDevice
+
+
+class FakeAdbHandler(socketserver.BaseRequestHandler):
+    """Stand-in for the adb server, speaking the host protocol."""
+    devices = {"emulator-5554": "device", "0123456789ABCDEF": "unauthorized"}
+    shell_output = {"echo hello": b"hello\r\n"}
+    files = {}
+    sends = []
+    installed = {}
+    features = "shell_v2,cmd,stat_v2"
+    # number of SEND request during which connection is dropped
+    fail_on_send = None
+    # output of package manager rejecting installs after receiving a part of an apk
+    reject_install = None
+    # number of bytes after which appending to a file is interrupted
+    fail_on_append = None
+    appends = []
+    # toolbox's stat of Android 5 and older does not support -c
+    stat_format = True
+
+    def read_request(self):
+        size = int(self.read_exactly(4), 16)
+        return self.read_exactly(size).decode()
+
+    def read_exactly(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError
+            data += chunk
+        return data
+
+    def reply(self, data=None, fail=False):
+        self.request.sendall(b"FAIL" if fail else b"OKAY")
+        if data is not None:
+            self.request.sendall(b"%04x" % len(data) + data)
+
+    def shell(self, command):
+        """Output of the few shell commands used in file transfers."""
+        files = self.files
+        match = re.fullmatch(r"mv ('.+') ('.+')", command)
+        if match:
+            files[unquote(match[2])] = files.pop(unquote(match[1]))
+            return b""
+        match = re.fullmatch(r"stat -c '%f %s %Y' ('.+') 2>/dev/null", command)
+        if match and not self.stat_format:
+            return b"stat: Unknown option -c\n"
+        if match:
+            content = files.get(unquote(match[1]))
+            return b"" if content is None else f"81a4 {len(content)} 1\n".encode()
+        return self.shell_output.get(command, b"")
+
+    def append(self, command):
+        """Append data received on stdin to a file, as head does."""
+        match = re.fullmatch(r"head -c (\d+) >> ('.+')", command)
+        if not match:
+            return False
+        path, length = unquote(match[2]), int(match[1])
+        self.appends.append(length)
+        self.files.setdefault(path, b"")
+        received = 0
+        while received < length:
+            chunk = self.request.recv(min(4096, length - received))
+            if not chunk:
+                raise ConnectionError
+            self.files[path] += chunk
+            received += len(chunk)
+            if self.fail_on_append is not None and received >= self.fail_on_append:
+                self.request.shutdown(socket.SHUT_RDWR)
+                return True
+        return True
+
+    def package_manager(self, command):
+        """Output of streamed install commands, received apks are
+        stored in the installed dict.
+        """
+        args = command.split()
+        if "install-commit" in args:
+            return b"Success\n"
+        if "install-abandon" in args:
+            self.installed["abandoned"] = args[-1]
+            return b"Success\n"
+        size = int(args[args.index("-S") + 1])
+        if "install-create" in args:
+            return b"Success: created install session [7]\n"
+        if self.reject_install:
+            self.read_exactly(1000)
+            return self.reject_install
+        apk = self.read_exactly(size)
+        if "install-write" in args:
+            self.installed[args[-2]] = apk
+            return f"Success: streamed {size} bytes\n".encode()
+        self.installed["base"] = apk
+        return b"Success\n"
+
+    def sync(self):
+        """Serve sync requests from the in-memory files dict."""
+        while True:
+            request_id, size = struct.unpack("<4sI", self.read_exactly(8))
+            data = self.read_exactly(size)
+            if request_id == b"QUIT":
+                return
+            if request_id == b"STAT":
+                content = self.files.get(data.decode())
+                mode = 0 if content is None else 0o100644
+                size = 0 if content is None else len(content)
+                self.request.sendall(
+                    struct.pack("<4sIII", b"STAT", mode, size % 2**32, 1))
+            elif request_id == b"LST2":
+                content = self.files.get(data.decode())
+                error = 2 if content is None else 0
+                mode = 0 if content is None else 0o100644
+                size = 0 if content is None else len(content)
+                # times differ from STAT's, to tell which request was used
+                self.request.sendall(struct.pack(
+                    "<4sIQQIIIIQqqq", b"LST2", error, 0, 0, mode, 1, 0, 0, size, 2, 2, 2))
+            elif request_id == b"RECV":
+                content = self.files.get(data.decode())
+                if content is None:
+                    message = b"No such file or directory"
+                    self.request.sendall(struct.pack("<4sI", b"FAIL", len(message)) + message)
+                    continue
+                for index in range(0, len(content), 4096):
+                    chunk = content[index:index + 4096]
+                    self.request.sendall(struct.pack("<4sI", b"DATA", len(chunk)) + chunk)
+                self.request.sendall(struct.pack("<4sI", b"DONE", 0))
+            elif request_id == b"SEND":
+                path = data.decode().rsplit(",", 1)[0]
+                self.sends.append(path)
+                content = b""
+                while True:
+                    packet_id, size = struct.unpack("<4sI", self.read_exactly(8))
+                    if packet_id == b"DONE":
+                        break
+                    content += self.read_exactly(size)
+                    if len(self.sends) == self.fail_on_send:
+                        # adbd removes partially sent files
+                        self.request.shutdown(socket.SHUT_RDWR)
+                        return
+                self.files[path] = content
+                self.request.sendall(struct.pack("<4sI", b"OKAY", 0))
+
+    def handle(self):
+        try:
+            request = self.read_request()
+            if request == "host:devices":
+                devices = "".join(f"{x}\t{y}\n" for x, y in self.devices.items())
+                self.reply(devices.encode())
+                return
+
+            if request.startswith("host-serial:") and request.endswith(":features"):
+                self.reply(self.features.encode())
+                return
+
+            if request == "host:track-devices":
+                devices = "".join(f"{x}\t{y}\n" for x, y in self.devices.items())
+                self.reply(devices.encode())
+                # keep the stream open until client disconnects
+                self.request.recv(1)
+                return
+
+            if request.startswith("host:transport:"):
+                serial = request.split(":", 2)[2]
+                if serial not in self.devices:
+                    self.reply(f"device '{serial}' not found".encode(), fail=True)
+                    return
+                self.reply()
+                service = self.read_request()
+                if service == "shell:garbled":
+                    self.request.sendall(b"JUNK")
+                    return
+                if service.startswith("shell:"):
+                    self.reply()
+                    self.request.sendall(self.shell(service[6:]))
+                    return
+                if service.startswith("exec:"):
+                    self.reply()
+                    if not self.append(service[5:]):
+                        self.request.sendall(self.package_manager(service[5:]))
+                    return
+                if service == "sync:":
+                    self.reply()
+                    self.sync()
+                    return
+
+            self.reply(b"unknown service", fail=True)
+        except ConnectionError:
+            pass
+
+
+def unquote(string):
+    """Undo helper.device.shell_quote."""
+    return string[1:-1].replace("'\\''", "'")
+
+
+@pytest.fixture
+def fake_server(monkeypatch):
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), FakeAdbHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(adb_client, "ADB_PORT", server.server_address[1])
+    monkeypatch.setattr(FakeAdbHandler, "files", {})
+    monkeypatch.setattr(FakeAdbHandler, "installed", {})
+    monkeypatch.setattr(adb_client, "_FEATURES", {})
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_devices(fake_server):
+    assert adb_client.devices() == [
+        ("emulator-5554", "device"), ("0123456789ABCDEF", "unauthorized")]
+
+
+def test_shell(fake_server):
+    assert adb_client.shell("emulator-5554", "echo", "hello") == "hello\r\n"
+
+
+def test_shell_unknown_device(fake_server):
+    with pytest.raises(adb_client.AdbCommandError):
+        adb_client.shell("missing", "echo", "hello")
+
+
+def test_adb_command_routing(fake_server):
+    """Commands returning output go through the native client."""
+    assert helper.device.get_serials()[0] == ("emulator-5554", "device")
+    output = helper.device.adb_command(
+        "-s", "emulator-5554", "shell", "echo", "hello", return_output=True, as_list=True)
+    assert output == ["hello"]
+    output = helper.device.adb_command(
+        "-s", "missing", "shell", "echo", "hello", return_output=True)
+    assert output.startswith("error: ")
+
+
+def test_adb_command_broken_reply(fake_server):
+    """Commands sent to devices are not repeated when the connection
+    breaks partway through them.
+    """
+    with pytest.raises(helper.device.DeviceOfflineError):
+        helper.device.adb_command(
+            "-s", "emulator-5554", "shell", "garbled", return_output=True)
+    with pytest.raises(helper.device.DeviceOfflineError):
+        list(helper.device.adb_stream("-s", "emulator-5554", "shell", "garbled"))
+
+
+def test_framing():
+    assert adb_client.encode_request("host:devices") == b"000chost:devices"
+    assert not adb_client.request_failed(b"OKAY")
+    assert adb_client.request_failed(b"FAIL")
+    with pytest.raises(adb_client.AdbClientError):
+        adb_client.request_failed(b"JUNK")
+    assert adb_client.encode_sync(b"STAT", "/sdcard") == b"STAT\x07\0\0\0/sdcard"
+    assert adb_client.sync_header(b"DONE", 1.5) == b"DONE\x01\0\0\0"
+    assert adb_client.parse_sync_header(b"DATA\0\x01\0\0") == (b"DATA", 256)
+
+
+def test_unsupported_commands():
+    with pytest.raises(adb_client.UnsupportedCommandError):
+        adb_client.run(["-s", "emulator-5554", "pull", "/sdcard/file"], return_output=True)
+    with pytest.raises(adb_client.UnsupportedCommandError):
+        adb_client.run(["-s", "emulator-5554", "shell", "ls"], return_output=False)
+
+
+def test_server_unavailable(monkeypatch):
+    server = socketserver.TCPServer(("127.0.0.1", 0), FakeAdbHandler)
+    port = server.server_address[1]
+    server.server_close()
+    monkeypatch.setattr(adb_client, "ADB_PORT", port)
+    with pytest.raises(adb_client.AdbConnectionError):
+        adb_client.devices()
+
+
+def test_status_tracker_subscription(fake_server):
+    tracker = helper.device.StatusTracker()
+    assert tracker.get("emulator-5554") == "device"
+    assert tracker.get("0123456789ABCDEF") == "unauthorized"
+    assert tracker.get("missing") == "offline"
+    assert tracker.tracking
+
+
+def test_status_tracker_polling(monkeypatch):
+    calls = []
+    def fake_serials():
+        calls.append(1)
+        return [("emulator-5554", "device")]
+
+    monkeypatch.setattr(adb_client, "ENABLED", False)
+    monkeypatch.setattr(helper.device, "get_serials", fake_serials)
+    tracker = helper.device.StatusTracker(ttl=60)
+    assert tracker.get("emulator-5554") == "device"
+    assert tracker.serials() == [("emulator-5554", "device")]
+    assert len(calls) == 1
+    tracker.refresh(force=True)
+    assert len(calls) == 2
+
+
+def test_sync_push_pull(fake_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(helper.device.Device, "status", "device")
+    device = helper.device.Device("emulator-5554")
+    local = tmp_path / "local.bin"
+    local.write_bytes(bytes(range(256)) * 1000)
+
+    remote_stat = device.push(local, "/sdcard/remote.bin")
+    assert remote_stat.size == 256000
+    assert FakeAdbHandler.files["/sdcard/remote.bin"] == local.read_bytes()
+
+    assert device.pull("/sdcard/remote.bin", tmp_path / "pulled.bin") == remote_stat
+    assert (tmp_path / "pulled.bin").read_bytes() == local.read_bytes()
+    assert device.pull("/sdcard/missing", tmp_path / "missing") is None
+    assert device.stat("/sdcard/missing") is None
+
+    results = device.transfer_many(
+        [("push", local, f"/sdcard/{x}") for x in range(5)]
+        + [("pull", "/sdcard/remote.bin", tmp_path / f"{x}") for x in range(5)])
+    assert all(x.size == 256000 for x in results)
+
+
+def test_sync_resumed_push(fake_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(helper.device.Device, "status", "device")
+    device = helper.device.Device("emulator-5554")
+    device._extracted_info_groups.append("identity")
+    device.info_dict["android_api_level"] = "28"
+    local = tmp_path / "main.obb"
+    local.write_bytes(bytes(range(256)) * 200)
+    remote = "/sdcard/it's main.obb"
+
+    # connection is lost after 30000 bytes were written
+    monkeypatch.setattr(FakeAdbHandler, "appends", [])
+    monkeypatch.setattr(FakeAdbHandler, "fail_on_append", 30000)
+    assert device.push(local, remote, resume=True) is None
+    assert remote not in FakeAdbHandler.files
+    written = sum(len(x) for x in FakeAdbHandler.files.values())
+    assert 30000 <= written < 51200
+
+    # only the remaining bytes are sent, straight into the partial file
+    monkeypatch.setattr(FakeAdbHandler, "fail_on_append", None)
+    remote_stat = device.push(local, remote, resume=True)
+    assert remote_stat.size == 51200
+    assert FakeAdbHandler.appends == [51200, 51200 - written]
+    assert FakeAdbHandler.files == {remote: local.read_bytes()}
+
+
+def test_sync_stat_sizes(fake_server, monkeypatch):
+    """Sizes over 4GB are read with LST2, or with shell's stat when the
+    device does not support it.
+    """
+    monkeypatch.setattr(helper.device.Device, "status", "device")
+    device = helper.device.Device("emulator-5554")
+    FakeAdbHandler.files["/sdcard/huge.obb"] = b"x" * (2**32 + 5)
+    assert device.stat("/sdcard/huge.obb").size == 2**32 + 5
+
+    monkeypatch.setattr(FakeAdbHandler, "features", "shell_v2")
+    monkeypatch.setattr(adb_client, "_FEATURES", {})
+    assert device.stat("/sdcard/huge.obb").size == 2**32 + 5
+    assert device.stat("/sdcard/missing") is None
+
+    # old STAT request is used when shell's stat cannot report sizes
+    monkeypatch.setattr(FakeAdbHandler, "stat_format", False)
+    del FakeAdbHandler.files["/sdcard/huge.obb"]
+    FakeAdbHandler.files["/sdcard/small.obb"] = b"x" * 5
+    assert device.stat("/sdcard/small.obb").size == 5
+    assert device.stat("/sdcard/missing") is None
+    async_device = AsyncDevice("emulator-5554", device)
+    assert asyncio.run(async_device.stat("/sdcard/small.obb")).size == 5
+    assert asyncio.run(async_device.stat("/sdcard/missing")) is None
+
+
+def test_stream_install(fake_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(helper.device.Device, "status", "device")
+    device = helper.device.Device("emulator-5554")
+    device._extracted_info_groups.append("identity")
+    device.info_dict["android_api_level"] = "28"
+    base, split = tmp_path / "base.apk", tmp_path / "split.apk"
+    base.write_bytes(b"base" * 50000)
+    split.write_bytes(b"split" * 100)
+
+    assert helper.main.stream_install(device, [base], ["-r"]) == "Success\n"
+    assert FakeAdbHandler.installed == {"base": base.read_bytes()}
+
+    FakeAdbHandler.installed.clear()
+    assert helper.main.stream_install(device, [base, split], ["-r"]) == "Success\n"
+    assert FakeAdbHandler.installed == {"0.apk": base.read_bytes(), "1.apk": split.read_bytes()}
+
+    # package manager stops reading the apk, its output is still returned
+    # and the install session is abandoned
+    base.write_bytes(b"base" * 2000000)
+    failure = b"Failure [INSTALL_FAILED_INSUFFICIENT_STORAGE]\n"
+    monkeypatch.setattr(FakeAdbHandler, "reject_install", failure)
+    assert helper.main.stream_install(device, [base], ["-r"]) == failure.decode()
+    FakeAdbHandler.installed.clear()
+    assert helper.main.stream_install(device, [base, split], ["-r"]) == failure.decode()
+    assert FakeAdbHandler.installed == {"abandoned": "7"}
+
+
+def test_install_methods(tmp_path, monkeypatch):
+    """Single apks are streamed from Android 6.0, splits from 5.0, apks
+    are copied to device first on older devices or unknown API levels.
+    """
+    methods = []
+    monkeypatch.setattr(helper.main, "stream_install",
+                        lambda *args, **kwargs: methods.append("stream") or "Success")
+    monkeypatch.setattr(helper.main, "staged_install",
+                        lambda *args, **kwargs: methods.append("staged") or "Success")
+    apk = types.SimpleNamespace(
+        app_name="Unknown", display_name="Unknown", host_path=tmp_path / "base.apk")
+    for api_level, split_files in (("23", ()), ("22", ()), (None, ()), ("21", ["split.apk"])):
+        device = FakeDevice()
+        device._extracted_info_groups.append("identity")
+        device.info_dict.update(device_manufacturer="Maker", device_model="Model",
+                                android_api_level=api_level)
+        helper.main.install_app(device, apk, split_files=split_files, stdout_=io.StringIO())
+    assert methods == ["stream", "staged", "staged", "stream"]
+
+
+def test_status_tracker_wait_for(monkeypatch):
+    monkeypatch.setattr(adb_client, "ENABLED", False)
+    states = [[("emulator-5554", "offline")]]
+    monkeypatch.setattr(helper.device, "get_serials", lambda: states[-1])
+    tracker = helper.device.StatusTracker(ttl=0)
+
+    assert tracker.wait_for("emulator-5554", timeout=0.2) is None
+    assert tracker.wait_for(state="offline", timeout=0.2) == "emulator-5554"
+    cancel = threading.Event()
+    cancel.set()
+    assert tracker.wait_for("emulator-5554", cancel=cancel) is None
+
+    changes = tracker.changes("emulator-5554")
+    threading.Timer(0.2, lambda: states.append([("emulator-5554", "device")])).start()
+    assert tracker.wait_for("emulator-5554", timeout=5, changed_since=changes) == "emulator-5554"
+    assert tracker.changes("emulator-5554") == changes + 1
+
+
+def test_reconnect(monkeypatch):
+    monkeypatch.setattr(adb_client, "ENABLED", False)
+    states = [[("emulator-5554", "device")]]
+    monkeypatch.setattr(helper.device, "get_serials", lambda: states[-1])
+    monkeypatch.setattr(helper.device, "adb_command", lambda *args, **kwargs: "")
+    monkeypatch.setattr(helper.device, "STATUS_TRACKER", helper.device.StatusTracker())
+    monkeypatch.setattr(helper.device, "RECONNECT_GRACE", 2)
+    device = helper.device.Device("emulator-5554")
+    output = io.StringIO()
+
+    # device which did not drop yet is not reported as reconnected
+    assert not device.reconnect(timeout=0.3, stdout_=output)
+    assert "reconnect your device" not in output.getvalue()
+
+    # slow reconnection, over a second long, is awaited silently
+    threading.Timer(0.1, lambda: states.append([])).start()
+    threading.Timer(1.3, lambda: states.append([("emulator-5554", "device")])).start()
+    output = io.StringIO()
+    assert device.reconnect(timeout=5, stdout_=output)
+    assert output.getvalue() == ""
+
+    # user is asked to act only after the grace period
+    output = io.StringIO()
+    assert not device.reconnect(timeout=2.3, stdout_=output)
+    assert "reconnect your device" in output.getvalue()
+
+
+def test_status_tracker_wait_for_tracked(fake_server, monkeypatch):
+    tracker = helper.device.StatusTracker()
+    assert tracker.wait_for(timeout=1) == "emulator-5554"
+    assert tracker.wait_for("0123456789ABCDEF", timeout=0.2) is None
+    assert tracker.tracking
+
+
+def test_async_device(fake_server, tmp_path, monkeypatch):
+    device = AsyncDevice("emulator-5554")
+    device.device._extracted_info_groups.append("identity")
+    device.info_dict.update(
+        android_api_level="28", device_manufacturer="Fake", device_model="Emulator")
+    local = tmp_path / "local.bin"
+    local.write_bytes(bytes(range(256)) * 1000)
+
+    async def run():
+        outputs = await asyncio.gather(*[device.shell("echo", "hello") for x in range(50)])
+        assert outputs == ["hello\r\n"] * 50
+
+        remote_stat = await device.push(local, "/sdcard/remote.bin")
+        assert remote_stat.size == 256000
+        assert await device.stat("/sdcard/missing") is None
+        assert await device.pull("/sdcard/remote.bin", tmp_path / "pulled") == remote_stat
+        assert (tmp_path / "pulled").read_bytes() == local.read_bytes()
+        assert await device.pull("/sdcard/missing", tmp_path / "missing") is None
+
+        assert await device.install(local, [local])
+        assert FakeAdbHandler.installed["1.apk"] == local.read_bytes()
+
+        # single apks are copied to device before Android 6.0
+        device.info_dict["android_api_level"] = "22"
+        staged = "/data/local/tmp/helper_local.bin"
+        monkeypatch.setitem(FakeAdbHandler.shell_output,
+                            f"pm install -r '{staged}'", b"Success\n")
+        assert await device.install(local)
+        assert FakeAdbHandler.files[staged] == local.read_bytes()
+
+        with pytest.raises(helper.device.DeviceOfflineError):
+            await AsyncDevice("missing").shell("echo", "hello")
+
+    asyncio.run(run())
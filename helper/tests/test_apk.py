@@ -0,0 +1,199 @@
+import io
+import csv
+import json
+import zlib
+import hashlib
+import zipfile
+
+import pytest
+
+import helper.apk
+import helper.axml
+import helper.cache
+import helper.main
+import helper.extract_data
+from helper.tests import FakeDevice, binary_manifest, cache_dir, resource_table
+
+
+def test_axml(monkeypatch, tmp_path):
+    monkeypatch.setattr(helper.cache, "ENABLED", False)
+    monkeypatch.setattr(helper.apk, "aapt_command", None)
+    permission = "android.permission."
+    manifest = binary_manifest(
+        ("manifest", {"package":"com.example.app", "versionCode":42,
+                      "versionName":"4.2"}, [
+            ("uses-sdk", {"minSdkVersion":16, "targetSdkVersion":"28"}, []),
+            ("uses-permission", {"name":permission + "CAMERA"}, []),
+            ("uses-permission", {"name":permission + "READ_CONTACTS",
+                                 "maxSdkVersion":22}, []),
+            ("uses-feature", {"name":"android.hardware.camera.autofocus",
+                              "required":False}, []),
+            ("uses-feature", {"name":"android.hardware.sensor.compass"}, []),
+            ("supports-gl-texture", {"name":"GL_OES_compressed_ETC1_RGB8_texture"}, []),
+            ("application", {"label":("ref", 0x7f010001)}, [
+                ("activity", {"name":".Settings"}, []),
+                ("activity", {"name":".MainActivity"}, [
+                    ("intent-filter", {}, [
+                        ("action", {"name":"android.intent.action.MAIN"}, []),
+                        ("category", {"name":"android.intent.category.LAUNCHER"}, []),
+                    ]),
+                ]),
+            ]),
+        ]))
+
+    apk_path = tmp_path / "app.apk"
+    with zipfile.ZipFile(apk_path, "w") as apk:
+        apk.writestr("AndroidManifest.xml", manifest)
+        apk.writestr("resources.arsc", resource_table(
+            [("Other", "Andere"), ("Example App", "Beispiel")]))
+        apk.writestr("lib/x86/libmain.so", b"")
+        apk.writestr("lib/armeabi-v7a/libmain.so", b"")
+
+    app = helper.apk.App(apk_path)
+    assert app.app_name == "com.example.app"
+    assert app.display_name == "Example App"
+    assert (app.version_code, app.version_name) == ("42", "4.2")
+    assert (app.min_sdk, app.target_sdk, app.max_sdk) == ("16", "28", "0")
+    assert app.used_permissions == {permission + "CAMERA":"",
+                                    permission + "READ_CONTACTS":"22"}
+    assert app.used_features == ["android.hardware.sensor.compass",
+                                 "android.hardware.camera",
+                                 "android.hardware.faketouch"]
+    assert app.used_opt_features == ["android.hardware.camera.autofocus"]
+    assert set(app.used_implied_features) == {"android.hardware.camera",
+                                              "android.hardware.faketouch"}
+    assert app.supported_abis == ["armeabi-v7a", "x86"]
+    assert app.supported_texture_compressions == ["GL_OES_compressed_ETC1_RGB8_texture"]
+    assert app.launchable_activity == "com.example.app.MainActivity"
+
+    # aapt is used for anything that could not be parsed
+    monkeypatch.setattr(helper.apk, "aapt_command",
+                        lambda *args, **kwargs: "package: name='com.broken'\n")
+    broken_path = tmp_path / "broken.apk"
+    with zipfile.ZipFile(broken_path, "w") as apk:
+        apk.writestr("AndroidManifest.xml", manifest[:100])
+    assert helper.apk.App(broken_path).app_name == "com.broken"
+
+    # encrypted, corrupted and unsupported entries are reported as AxmlError
+    for error in (RuntimeError, NotImplementedError, zlib.error):
+        def read(self, name, pwd=None, error=error):
+            raise error(name)
+        monkeypatch.setattr(zipfile.ZipFile, "read", read)
+        with pytest.raises(helper.axml.AxmlError):
+            helper.axml.read_apk(apk_path)
+        assert helper.apk.App(apk_path).app_name == "com.broken"
+
+
+def test_bulk_inspect(tmp_path, cache_dir):
+    (tmp_path / "out" / "nested").mkdir(parents=True)
+    for index, name in enumerate(("a", "nested/b", "c")):
+        with zipfile.ZipFile(tmp_path / "out" / f"{name}.apk", "w") as apk:
+            apk.writestr("AndroidManifest.xml", binary_manifest(
+                ("manifest", {"package":f"com.app{index}", "versionCode":index}, [])))
+    (tmp_path / "out" / "notes.txt").write_text("")
+
+    apks = helper.apk.find_apks([str(tmp_path / "out")])
+    assert [x.name for x in apks] == ["a.apk", "c.apk", "b.apk"]
+    assert helper.apk.find_apks([str(tmp_path / "out" / "*.apk")]) == apks[:2]
+
+    stdout, stderr = io.StringIO(), io.StringIO()
+    failed = helper.apk.bulk_inspect(
+        apks + [tmp_path / "missing.apk"], "jsonl", 2, stdout, stderr)
+    assert failed == 1
+    results = [json.loads(x) for x in stdout.getvalue().splitlines()]
+    assert sorted(x["app_name"] for x in results) == ["com.app0", "com.app1", "com.app2"]
+    assert "Inspected 3 apks" in stderr.getvalue()
+    assert "1 failed" in stderr.getvalue()
+    # info of all apks is written to the cache by the parent process
+    cached = helper.cache.load_json(helper.cache.apk_cache_path())
+    assert len(cached["entries"]) == 3
+    assert len(cached["files"]) == 3
+
+    stdout = io.StringIO()
+    helper.apk.bulk_inspect(apks, "csv", 2, stdout, io.StringIO())
+    rows = list(csv.DictReader(io.StringIO(stdout.getvalue())))
+    assert sorted(x["version_code"] for x in rows) == ["0", "1", "2"]
+    assert rows[0]["used_features"] == "android.hardware.faketouch"
+
+    with pytest.raises(SystemExit):
+        helper.apk.main(["-f", "jsonl", "-j", "-1", str(tmp_path / "out")])
+
+
+def test_parse_badging():
+    dump = """package: name='com.example.app' versionCode='42' versionName='4.2 ' platformBuildVersionName='9'
+sdkVersion:'16'
+targetSdkVersion:'28'
+maxSdkVersion:'30'
+uses-permission: name='android.permission.CAMERA'
+uses-permission: name='android.permission.READ_CONTACTS' maxSdkVersion='22'
+uses-permission-sdk-23: name='android.permission.SEND_SMS'
+application-label:'Example'
+application-label-de:'Beispiel'
+application: label='Example' icon='res/mipmap/icon.png'
+launchable-activity: name='com.example.app.MainActivity'  label='' icon=''
+uses-feature-not-required: name='android.hardware.camera.autofocus'
+uses-feature: name='android.hardware.camera'
+uses-implied-feature: name='android.hardware.camera' reason='requested android.permission.CAMERA permission'
+uses-feature: name='android.hardware.faketouch'
+supports-gl-texture:'GL_OES_compressed_ETC1_RGB8_texture'
+supports-screens: 'small' 'normal' 'large' 'xlarge'
+native-code: 'arm64-v8a' 'x86'
+alt-native-code: 'armeabi'
+"""
+    assert helper.apk.parse_badging(dump) == {
+        "app_name" : "com.example.app",
+        "version_code" : "42",
+        "version_name" : "4.2",
+        "min_sdk" : "16",
+        "target_sdk" : "28",
+        "max_sdk" : "30",
+        "used_permissions" : {"android.permission.CAMERA" : "",
+                              "android.permission.READ_CONTACTS" : "22"},
+        "display_name" : "Example",
+        "launchable_activity" : "com.example.app.MainActivity",
+        "used_opt_features" : ["android.hardware.camera.autofocus"],
+        "used_features" : ["android.hardware.camera", "android.hardware.faketouch"],
+        "used_implied_features" : {
+            "android.hardware.camera" : "requested android.permission.CAMERA permission"},
+        "supported_texture_compressions" : ["GL_OES_compressed_ETC1_RGB8_texture"],
+        "supported_abis" : ["arm64-v8a", "x86"],
+    }
+
+
+def test_skip_identical_install(monkeypatch, tmp_path, cache_dir):
+    apk_path = tmp_path / "game.apk"
+    with zipfile.ZipFile(apk_path, "w") as apk:
+        apk.writestr("AndroidManifest.xml", binary_manifest(
+            ("manifest", {"package":"com.example.game", "versionCode":5,
+                          "versionName":"1.5"}, [])))
+    installed = {"version_code" : "5", "sha256" : hashlib.sha256(apk_path.read_bytes()).hexdigest()}
+    def outputs(*args):
+        if args[:3] == ("pm", "list", "packages") and "-f" in args:
+            return ("package:/data/app/game-1/base.apk=com.example.game "
+                    f"versionCode:{installed['version_code']} installer=null uid:10123")
+        if args == ("pm", "path", "com.example.game"):
+            return "package:/data/app/game-1/base.apk"
+        if args[0] == "sha256sum":
+            return f"{installed['sha256']}  /data/app/game-1/base.apk"
+        if args == helper.extract_data.INFO_SOURCES["available_commands"]:
+            return "ls\nsha256sum"
+        return ""
+
+    install_calls = []
+    monkeypatch.setattr(helper.main, "install_app",
+                        lambda *args, **kwargs: install_calls.append(args) or True)
+    device = FakeDevice(outputs=outputs)
+
+    stdout = io.StringIO()
+    assert helper.main.install(device, apk_path, skip_identical=True, stdout_=stdout)
+    assert "SKIPPED" in stdout.getvalue()
+    assert not install_calls
+    assert ("sha256sum", "'/data/app/game-1/base.apk'") in device.commands
+
+    # installed without the option, or if anything differs
+    helper.main.install(device, apk_path, stdout_=io.StringIO())
+    installed["sha256"] = "0" * 64
+    helper.main.install(device, apk_path, skip_identical=True, stdout_=io.StringIO())
+    installed["version_code"] = "4"
+    helper.main.install(device, apk_path, skip_identical=True, stdout_=io.StringIO())
+    assert len(install_calls) == 3
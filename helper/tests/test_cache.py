@@ -0,0 +1,104 @@
+from pathlib import Path
+
+import helper.apk
+import helper.cache
+import helper.device
+import helper.extract_data
+from helper.tests import FakeDevice, cache_dir
+
+
+def test_device_info_cache(monkeypatch, cache_dir):
+    calls = []
+    def extract_fake(device):
+        calls.append(device.serial)
+        device.info_dict["device_model"] = "Model"
+        # keys not listed in INFO_KEYS must be cached as well
+        device.info_dict["cpu1_core_count"] = 4
+
+    monkeypatch.setitem(helper.extract_data.INFO_GROUPS, "fake",
+                        (extract_fake, (), ("device_model",)))
+    monkeypatch.setitem(helper.device.EXTRACTION_FUNCTIONS, "fake", extract_fake)
+    monkeypatch.setitem(helper.cache.GROUP_TTL, "fake", None)
+    monkeypatch.setitem(helper.extract_data.KEY_GROUPS, "device_model", ["fake"])
+
+    outputs = {("getprop", "ro.build.fingerprint") : "build/1\n"}
+    def cached_device():
+        device = FakeDevice("serial:5555", outputs)
+        device.use_info_cache = True
+        return device
+
+    cached_device().extract_data(limit_to=["fake"])
+    device = cached_device()
+    device.extract_data(limit_to=["fake"])
+    assert len(calls) == 1
+    assert device.info_dict["device_model"] == "Model"
+    assert device.info_dict["cpu1_core_count"] == 4
+
+    # forced extraction skips the cache
+    device.extract_data(limit_to=["fake"], force_extract=True)
+    assert len(calls) == 2
+
+    # cached info is discarded after device's build changes
+    outputs[("getprop", "ro.build.fingerprint")] = "build/2\n"
+    cached_device().extract_data(limit_to=["fake"])
+    assert len(calls) == 3
+
+
+def test_apk_cache(monkeypatch, tmp_path, cache_dir):
+    monkeypatch.setattr(helper.cache, "APK_CACHE_MAX_ENTRIES", 2)
+    calls = []
+    def aapt_fake(*args, **kwargs):
+        calls.append(args[-1])
+        return (f"package: name='com.{Path(args[-1]).stem}' versionCode='1' "
+                "versionName='1.0'\nsdkVersion:'16'\nnative-code: 'armeabi-v7a'\n")
+
+    monkeypatch.setattr(helper.apk, "aapt_command", aapt_fake)
+    apks = []
+    for name in ("a", "b", "c"):
+        apks.append(tmp_path / f"{name}.apk")
+        apks[-1].write_bytes(name.encode())
+
+    app = helper.apk.App(apks[0])
+    cache_file = helper.cache.apk_cache_path()
+    saved = cache_file.stat().st_mtime_ns
+    cached_app = helper.apk.App(apks[0])
+    assert cached_app.get_report() == app.get_report()
+    assert cached_app.min_sdk == "16"
+    assert cached_app.supported_abis == ["armeabi-v7a"]
+    assert len(calls) == 1
+    # hits do not rewrite the cache, their times of use are saved later
+    assert cache_file.stat().st_mtime_ns == saved
+    sha256 = helper.cache.file_sha256(apks[0])
+    assert sha256 in helper.cache._APK_USAGE
+    helper.cache.flush_apk_usage()
+    assert not helper.cache._APK_USAGE
+
+    # entries of other versions are discarded
+    version = helper.cache.APK_CACHE_VERSION
+    monkeypatch.setattr(helper.cache, "APK_CACHE_VERSION", version + 1)
+    helper.apk.App(apks[0])
+    assert len(calls) == 2
+    monkeypatch.setattr(helper.cache, "APK_CACHE_VERSION", version)
+    helper.apk.App(apks[0])
+    assert len(calls) == 3
+    del calls[1:]
+
+    # same contents under a different path are found by hash
+    copy = tmp_path / "copy.apk"
+    copy.write_bytes(b"a")
+    assert helper.apk.App(copy).app_name == "com.a"
+    assert len(calls) == 1
+
+    # modified file is parsed again
+    apks[0].write_bytes(b"modified")
+    helper.apk.App(apks[0])
+    assert len(calls) == 2
+
+    # least recently used entries are evicted
+    helper.apk.App(apks[1])
+    helper.apk.App(apks[2])
+    helper.apk.App(apks[2])
+    helper.apk.App(apks[1])
+    assert len(calls) == 4
+    helper.apk.App(apks[0])
+    assert len(calls) == 5
@@ -0,0 +1,69 @@
+import zipfile
+
+import helper.apk
+import helper.compat
+from helper.tests import binary_manifest, cache_dir
+
+
+def test_compatibility_matrix(tmp_path, cache_dir):
+
+    apks = []
+    for name, sdk, feature, abi in (("a", 16, "android.hardware.nfc", "x86"),
+                                    ("b", 26, "android.hardware.camera", "arm64-v8a")):
+        apks.append(tmp_path / f"{name}.apk")
+        with zipfile.ZipFile(apks[-1], "w") as apk:
+            apk.writestr("AndroidManifest.xml", binary_manifest(
+                ("manifest", {"package":f"com.{name}"}, [
+                    ("uses-sdk", {"minSdkVersion":sdk}, []),
+                    ("uses-feature", {"name":feature}, []),
+                    ("uses-feature", {"name":"android.hardware.nfc", "required":False}, []),
+                ])))
+            apk.writestr(f"lib/{abi}/libmain.so", b"")
+
+    class FakeDevice:
+        extractions = 0
+
+        def __init__(self, serial, api_level, features, abis):
+            self.name = self.serial = serial
+            self.build_fingerprint = f"build/{serial}"
+            self.info_dict = {
+                "android_api_level" : str(api_level), "cpu_abis" : abis,
+                "gles_extensions" : [],
+                "device_features" : features + ["android.hardware.faketouch"]}
+
+        def extract_data(self, keys=()):
+            FakeDevice.extractions += 1
+
+    devices = [
+        FakeDevice("old", 19, ["android.hardware.camera"], ["armeabi-v7a", "x86"]),
+        FakeDevice("new", 28, ["android.hardware.camera"], ["arm64-v8a"]),
+        FakeDevice("new2", 28, ["android.hardware.camera"], ["arm64-v8a"]),
+    ]
+    apps = [helper.apk.App(x) for x in apks]
+    rows = helper.compat.check_matrix(apps, devices)
+    assert rows[0][0] == (False, ["Feature android.hardware.nfc not available on device"])
+    assert rows[0][1][0] is False
+    assert rows[0][1][1] == [
+        "Device does not use supported abis (['x86'])",
+        "Feature android.hardware.nfc not available on device"]
+    assert rows[1][0] == (False, [
+        "API level of at least 26 is required but the device uses 19",
+        "Device does not use supported abis (['arm64-v8a'])"])
+    assert rows[1][1] == rows[1][2] == (True, [])
+    assert apps[1].check_compatibility(devices[1]) == (True, [])
+    assert FakeDevice.extractions == 3
+
+    # results are cached by apk hash and build fingerprint
+    rows_cached = helper.compat.check_matrix(apps, devices)
+    assert [[tuple(x) for x in row] for row in rows_cached] == rows
+    assert FakeDevice.extractions == 3
+    devices[0].build_fingerprint = "build/updated"
+    helper.compat.check_matrix(apps, devices)
+    assert FakeDevice.extractions == 4
+
+    # devices with missing info are neither compatible nor incompatible
+    unknown = FakeDevice("unknown", "", ["android.hardware.camera"], None)
+    assert helper.compat.check_matrix(apps[1:], [unknown]) == [[(None, [
+        "Could not read device's android_api_level, cpu_abis"])]]
+    unknown.info_dict.update(android_api_level="28", cpu_abis=["arm64-v8a"])
+    assert helper.compat.check_matrix(apps[1:], [unknown]) == [[(True, [])]]
@@ -7,7 +7,7 @@ import helper
 import helper.device
 from helper.tests import DummyDevice
 
-from helper.extract_data import INFO_KEYS, SURFACED_VERBOSE
+from helper.extract_data import INFO_KEYS, INFO_GROUPS, INFO_SOURCES, SURFACED_VERBOSE
 
 FULL_DEVICE_CONFIG = Path(helper.CWD, "tests", "full_config")
 COMPATIBILITY_DIR = Path(helper.CWD, "compat_data")
@@ -53,6 +53,16 @@ class TestExtractModule:
         self.verify_info_config(SURFACED_VERBOSE)
 
 
+    def test_verify_info_groups(self):
+        """Verify that info groups read existing sources and produce existing info keys."""
+        for group_name, (function, sources, keys) in INFO_GROUPS.items():
+            assert callable(function)
+            for source in sources:
+                assert source in INFO_SOURCES
+            for key in keys:
+                assert key in INFO_KEYS
+
+
     def test_reference_existing_keys_only(self):
         """Check if the modules references existing info keys."""
         extraction_module = Path(helper.CWD, "helper", "extract_data.py")
@@ -0,0 +1,208 @@
+import io
+import subprocess
+
+import helper.device
+import helper.extract_data
+import helper.main
+from helper.device import Device
+from helper.tests import FakeDevice
+
+
+def test_prefetch_sources(monkeypatch):
+    """Outputs of batched commands must be identical to those of
+    commands executed separately.
+    """
+    sources = {
+        "no_newline" : ("printf", "'a b'"),
+        "newline" : ("printf", "'a\\n\\n'"),
+        "empty" : ("true",),
+        "stderr" : ("ls", "/nonexistent/path"),
+        "script" : ("""
+            NUM=0;
+            while [ $NUM -lt 3 ]; do
+                echo line $NUM;
+                NUM=$((NUM+1));
+            done;""",),
+    }
+    monkeypatch.setattr(helper.extract_data, "INFO_SOURCES", sources)
+    monkeypatch.setattr(helper.extract_data, "BATCH_MAX_LENGTH", 200)
+
+    class LocalDevice:
+        _init_cache = {"cached" : "cached output"}
+        shell_calls = 0
+
+        def shell_command(self, *args, **kwargs):
+            self.shell_calls += 1
+            return subprocess.run(
+                ["sh", "-c", " ".join(args)], stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT).stdout.decode()
+
+    device = LocalDevice()
+    helper.extract_data.prefetch_sources(device, list(sources) + ["cached"])
+    # BATCH_MAX_LENGTH forces the sources to be split between scripts
+    assert 1 < device.shell_calls < len(sources)
+    assert device._init_cache.pop("cached") == "cached output"
+    assert len(device._init_cache) == len(sources)
+
+    for source_name, output in device._init_cache.items():
+        assert output == LocalDevice().shell_command(*sources[source_name])
+
+
+def test_lazy_info_dict(monkeypatch):
+    calls = []
+    def extract_first(device):
+        calls.append("first")
+        device.info_dict["device_model"] = "Model"
+
+    def extract_second(device):
+        calls.append("second")
+        # reading other group's key extracts that group
+        device.info_dict["device_brand"] = device.info_dict["device_model"] + " Brand"
+        # reading own keys must not start extraction again
+        assert device.info_dict["device_brand"].endswith("Brand")
+        # cache must survive the nested extraction
+        assert device._init_cache
+
+    monkeypatch.setitem(helper.extract_data.INFO_GROUPS, "first",
+                        (extract_first, (), ("device_model",)))
+    monkeypatch.setitem(helper.extract_data.INFO_GROUPS, "second",
+                        (extract_second, (), ("device_brand",)))
+    monkeypatch.setitem(helper.device.EXTRACTION_FUNCTIONS, "first", extract_first)
+    monkeypatch.setitem(helper.device.EXTRACTION_FUNCTIONS, "second", extract_second)
+    monkeypatch.setitem(helper.extract_data.KEY_GROUPS, "device_model", ["first"])
+    monkeypatch.setitem(helper.extract_data.KEY_GROUPS, "device_brand", ["second"])
+
+    device = FakeDevice()
+    device.status = "offline"
+    assert device.info_dict["device_model"] is None
+    assert not calls
+
+    device.status = "device"
+    device._init_cache["source"] = "output"
+    assert device.info_dict.get("device_brand") == "Model Brand"
+    assert device.info_dict["device_model"] == "Model"
+    assert calls == ["second", "first"]
+    assert not device._init_cache
+
+
+def test_parse_getprop():
+    getprop = (
+        "[ro.build.fingerprint]: [brand/name/device:9/ID/1:user/release-keys]\r\n"
+        "[ro.empty]: []\r\n"
+        "[persist.multiline]: [first line\r\n"
+        "second line]\r\n"
+        "[ro.product.model]: [Model [X]]\r\n")
+    props = helper.extract_data.parse_getprop(getprop)
+    assert props == {
+        "ro.build.fingerprint": "brand/name/device:9/ID/1:user/release-keys",
+        "ro.empty": "",
+        "persist.multiline": "first line\r\nsecond line",
+        "ro.product.model": "Model [X]",
+    }
+
+    device = Device("serial")
+    device._init_cache["getprop"] = getprop
+    assert device.props["ro.product.model"] == "Model [X]"
+    assert device.build_fingerprint == props["ro.build.fingerprint"]
+
+
+def test_package_index():
+    package_list = "\n".join([
+        "package:/data/app/~~Ab1==/com.example.game-Xy9==/base.apk=com.example.game "
+        "versionCode:1042 installer=com.android.vending uid:10123",
+        "package:/system/app/Browser/Browser.apk=com.android.browser "
+        "versionCode:28 installer=null uid:10045",
+        "package:/data/app/com.example.tool-1/base.apk=com.example.tool "
+        "versionCode:3 installer=com.android.vending uid:10124",
+        "package:/data/app/com.example.helper-1/base.apk=com.example.helper "
+        "versionCode:1 installer=android.helper uid:10125",
+        "package:/data/app/com.android.chrome-1/base.apk=com.android.chrome "
+        "versionCode:90 installer=null uid:10046",
+    ])
+    outputs = {
+        ("pm", "list", "packages", "-s") : "package:com.android.browser\npackage:com.android.chrome\n",
+        ("pm", "list", "packages", "-f", "-U", "-i", "--show-versioncode") : package_list,
+        ("pm", "list", "packages", "-3") : "package:com.example.tool\n",
+    }
+    def respond(*args):
+        if args[:2] == ("pm", "uninstall"):
+            return "Success"
+        return outputs.get(args, "")
+
+    device = FakeDevice(outputs=respond)
+    commands = device.commands
+    index = device.info_dict["package_index"]
+    assert index["com.example.game"] == helper.extract_data.PackageInfo(
+        "com.example.game", "/data/app/~~Ab1==/com.example.game-Xy9==/base.apk",
+        "10123", "1042", "com.android.vending", False)
+    assert index["com.android.browser"].system
+    assert index["com.android.browser"].installer is None
+    # updates of system packages are installed in /data/app
+    assert index["com.android.chrome"].system
+    assert device.info_dict["packages_by_installer"]["com.android.vending"] == {
+        "com.example.game", "com.example.tool"}
+    assert sorted(device.info_dict["third-party_apps"]) == [
+        "com.example.game", "com.example.helper", "com.example.tool"]
+
+    # system packages are told apart by their paths if they were not listed
+    other_device = FakeDevice("other", {
+        args:output for args, output in outputs.items() if "-s" not in args})
+    assert other_device.info_dict["system_apps"] == ["com.android.browser"]
+    assert not other_device.info_dict["package_index"]["com.example.game"].system
+
+    # cleaner can uninstall all apps from one installer
+    uninstall = helper.main.CLEANER_OPTIONS["uninstall"][0]
+    uninstall(device, "from com.android.vending", stdout_=io.StringIO())
+    assert [x[-1] for x in commands if x[:2] == ("pm", "uninstall")] == [
+        "com.example.game", "com.example.tool"]
+
+    # older package managers do not support all options
+    outputs[("pm", "list", "packages", "-f", "-U", "-i", "--show-versioncode")] = \
+        "Error: Unknown option: -U"
+    device.extract_data(limit_to=["installed_packages"], force_extract=True)
+    assert sorted(device.info_dict["package_index"]) == [
+        "com.android.browser", "com.android.chrome", "com.example.tool"]
+    assert device.info_dict["package_index"]["com.example.tool"].version_code is None
+
+
+def test_refresh_package(monkeypatch):
+    list_args = ("pm", "list", "packages", "-f", "-U", "-i", "--show-versioncode")
+    packages = {
+        "com.example.game" : "package:/data/app/game-1/base.apk=com.example.game "
+                             "versionCode:1 installer=android.helper uid:10123",
+    }
+    def respond(*args):
+        if args[:len(list_args)] == list_args:
+            name = args[len(list_args):]
+            return "\n".join(line for package, line in packages.items()
+                             if not name or name[0] in package)
+        return ""
+
+    device = FakeDevice(outputs=respond)
+    commands = device.commands
+    device.extract_data(limit_to=["installed_packages"])
+    assert commands.count(list_args) == 1
+
+    # installing and uninstalling only lists the affected package
+    packages["com.example.game.demo"] = (
+        "package:/data/app/demo-1/base.apk=com.example.game.demo "
+        "versionCode:7 installer=android.helper uid:10124")
+    info = helper.extract_data.refresh_package(device, "com.example.game.demo")
+    assert info.version_code == "7"
+    assert "com.example.game.demo" in device.info_dict["packages_by_installer"]["android.helper"]
+    del packages["com.example.game.demo"]
+    assert helper.extract_data.refresh_package(device, "com.example.game.demo") is None
+    assert "com.example.game.demo" not in device.info_dict["package_index"]
+    assert commands.count(list_args) == 1
+
+    # changes to other listed packages mean the index is out of date
+    packages["com.example.game"] = packages["com.example.game"].replace("game-1", "game-2")
+    helper.extract_data.refresh_package(device, "com.example")
+    assert commands.count(list_args) == 2
+    assert device.info_dict["package_index"]["com.example.game"].path == \
+        "/data/app/game-2/base.apk"
+
+    # as does the index's age
+    monkeypatch.setattr(helper.extract_data, "PACKAGE_INDEX_TTL", -1)
+    helper.extract_data.refresh_package(device, "com.example.game")
+    assert commands.count(list_args) == 3
@@ -1,3 +1,19 @@
+import os
+import random
+import shutil
+import subprocess
+import threading
+from pathlib import Path
+
+import pytest
+
+import helper
+import helper.cli
+import helper.device
+import helper.adb_client
+import helper.extract_data
+import helper.shell_session
+from helper.device import Device, DeviceOfflineError
 from helper.extract_data import df_parser
 
 def test_df_parser():
@@ -137,5 +153,279 @@ def test_df_parser():
 
     for test_case, expected_results in zip(test_cases, test_results):
         actual_results = df_parser(test_case)
+        assert len(actual_results) == len(expected_results)
         for line_actual, line_expected in zip(actual_results, expected_results):
             assert line_actual == line_expected
+
+
+def test_df_parser_vendor_formats():
+    K = lambda x: int(x*1024)
+    M = lambda x: int(x*1024**2)
+    G = lambda x: int(x*1024**3)
+
+    corpus = {
+        # toolbox df on Android 4.x, no options accepted
+        """Filesystem             Size   Used   Free   Blksize
+/mnt/sdcard              12G     4G     8G   4096""": [
+            ("/mnt/sdcard", G(12), G(4), G(8))],
+        # toybox df, long file system name wrapped to its own line
+        """Filesystem            1K-blocks    Used Available Use% Mounted on
+/dev/block/platform/soc/1da4000.ufshc/by-name/userdata
+                          115247656 8367316 106749268   8% /data
+/dev/fuse                 115247656 8367316 106749268   8% /storage/emulated""": [
+            ("/dev/block/platform/soc/1da4000.ufshc/by-name/userdata",
+             K(115247656), K(8367316), K(106749268)),
+            ("/dev/fuse", K(115247656), K(8367316), K(106749268))],
+        # busybox df -h with binary unit suffixes and comma decimals
+        """Filesystem                Size      Used Available Use% Mounted on
+tmpfs                   925,3MiB    128KiB  925,2MiB   0% /dev
+/dev/block/dm-0           2.5GiB    2.4GiB   96.0MiB  96% /""": [
+            ("tmpfs", int(925.3*1024**2), K(128), int(925.2*1024**2)),
+            ("/dev/block/dm-0", int(2.5*1024**3), int(2.4*1024**3), M(96))],
+        # short and malformed rows
+        """Filesystem     1K-blocks   Used Available Use% Mounted on
+/dev/block/vda   2064208  1234
+df: /storage/sdcard1: Permission denied
+overlay           ?         ?       ?        -  /mnt""": [
+            ("/dev/block/vda", K(2064208), K(1234), -1),
+            ("df:", -1, -1, -1),
+            ("overlay", -1, -1, -1)],
+        # error message only, no header
+        "df: /storage/sdcard1: No such file or directory": [],
+    }
+    for df_output, expected_results in corpus.items():
+        assert df_parser(df_output) == expected_results
+
+    row = df_parser(list(corpus)[0])[0]
+    assert (row.filesystem, row.total, row.used, row.free) == row
+
+
+def test_df_parser_fuzz():
+    """Random, well-formed outputs always parse to the values they were
+    generated from. Malformed values never raise.
+    """
+    rng = random.Random(1234)
+    units = [("", 1), ("K", 1024), ("M", 1024**2), ("G", 1024**3)]
+    for _ in range(200):
+        rows, expected = [], []
+        for index in range(rng.randint(0, 30)):
+            values = []
+            for _ in range(3):
+                unit, multiplier = rng.choice(units)
+                number = rng.randint(0, 9999)
+                values.append((f"{number}{unit}", number * multiplier))
+            name = f"/dev/block/fuzz{index}" * rng.randint(1, 4)
+            separator = "\n    " if len(name) > 40 else " "
+            rows.append(name + separator + " ".join(x[0] for x in values) + " 1% /mnt")
+            expected.append((name, *(x[1] for x in values)))
+        output = "Filesystem Size Used Avail Use% Mounted on\n" + "\n".join(rows)
+        assert df_parser(output) == expected
+
+        garbage = "".join(rng.choice("abcK.,%- \n\t0123456789") for _ in range(200))
+        df_parser("Filesystem Size Used Free\n" + garbage)
+
+
+def test_run_on_devices(capsys):
+    class FakeDevice:
+        def __init__(self, serial):
+            self.serial = serial
+            self.name = serial
+
+    barrier = threading.Barrier(3, timeout=5)
+    def command(device, args):
+        # all devices must be handled at the same time to pass the barrier
+        print("start", device.serial)
+        barrier.wait()
+        # output of functions resolving stdout at call time is buffered too
+        helper.exe(Path(shutil.which("echo")), "exe", device.serial)
+        print("end", device.serial)
+        if device.serial == "offline":
+            raise DeviceOfflineError("", device.serial)
+        return device.serial != "failing"
+
+    devices = [FakeDevice(x) for x in ("ok", "offline", "failing")]
+    failed = helper.cli.run_on_devices(command, devices, None)
+    assert sorted(failed) == ["failing", "offline"]
+
+    output = capsys.readouterr().out.splitlines()
+    for serial in ("ok", "offline", "failing"):
+        # output of each device is printed in one piece
+        index = output.index(f"[{serial}] start {serial}")
+        assert output[index + 1] == f"[{serial}] exe {serial}"
+        assert output[index + 2] == f"[{serial}] end {serial}"
+    assert "Finished on 1 of 3 devices." in output
+
+    assert helper.cli.PARSER.parse_args(["dump", "-j", "2"]).jobs == 2
+    for jobs in ("-1", "x"):
+        with pytest.raises(SystemExit):
+            helper.cli.PARSER.parse_args(["dump", "-j", jobs])
+
+
+def test_main_missing_device(monkeypatch, capsys):
+    monkeypatch.setattr(helper.cli, "find_adb_and_aapt", lambda: None)
+    monkeypatch.setattr(helper.adb_client, "ENABLED", False)
+    monkeypatch.setattr(helper.device, "get_serials", lambda: [("other", "device")])
+    monkeypatch.setattr(helper.device, "STATUS_TRACKER", helper.device.StatusTracker(ttl=0))
+    # chosen device which is not connected is reported instead of waited for
+    helper.cli.main(["traces", "-d", "missing", "-o", "."])
+    assert "Device with serial number missing was not found" in capsys.readouterr().out
+
+
+def test_streaming_exe(tmp_path):
+    sh = Path("/bin/sh")
+    chunks = helper.exe_chunks(sh, "-c", "printf 'a\\r\\nb\\nc'")
+    assert list(helper.iter_lines(chunks)) == ["a\r\n", "b\n", "c"]
+
+    # multi-byte characters split between chunks
+    chunks = [b"x\xc5", b"\x82y\r", b"\nz"]
+    assert list(helper.iter_lines(chunks)) == ["xły\r\n", "z"]
+
+    written = helper.write_chunks(
+        helper.exe_chunks(sh, "-c", "yes line | head -n 100000"), tmp_path / "out")
+    assert written == len("line\n") * 100000
+    assert (tmp_path / "out").stat().st_size == written
+
+    # closing the generator early terminates the process
+    chunks = helper.exe_chunks(sh, "-c", "yes")
+    next(chunks)
+    chunks.close()
+
+
+def test_shell_session(monkeypatch):
+    monkeypatch.setattr(helper.shell_session, "session_args", lambda serial: ("sh",))
+    session = helper.shell_session.ShellSession("serial")
+    try:
+        assert session.run("echo", "hello") == ("hello\n", 0)
+        assert session.run("printf", "'no newline'") == ("no newline", 0)
+        assert session.run("echo error >&2; exit 3") == ("error\n", 3)
+        # commands run in a subshell, state does not leak between them
+        assert session.run("cd /; exit 0") == ("", 0)
+        assert session.run("cat") == ("", 0)
+        # commands run in the session's shell, not in new sh processes
+        assert session.run("echo", "$PPID") == (f"{os.getpid()}\n", 0)
+
+        process = session._process
+        process.kill()
+        process.wait()
+        # dead shell is started again on next command
+        assert session.run("echo", "again") == ("again\n", 0)
+        assert session._process is not process
+
+        # commands which would leave the shell waiting for input fail
+        # on their own
+        assert session.run("echo 'unbalanced")[1] != 0
+        assert session.run("cat <<EOF\nline")[0].startswith("line")
+        assert session.run("echo", "{braces}") == ("{braces}\n", 0)
+
+        # stuck commands end the session, which is started again
+        process = session._process
+        with pytest.raises(helper.shell_session.ShellSessionError):
+            session.run("sleep 5", timeout=0.2)
+        assert session.run("echo", "again") == ("again\n", 0)
+        assert session._process is not process
+    finally:
+        session.close()
+
+    # output printed by a terminal before the first command is discarded
+    monkeypatch.setattr(
+        helper.shell_session, "session_args",
+        lambda serial: ("sh", "-c", "echo banner; printf 'prompt $ '; exec sh -i 2>&1"))
+    session = helper.shell_session.ShellSession("serial")
+    try:
+        assert session.run("echo", "hello") == ("hello\n", 0)
+    finally:
+        session.close()
+
+    device = Device("serial")
+    monkeypatch.setattr(Device, "status", "device")
+    device._shell_session = session
+    assert device.shell_command("echo a; echo b", return_output=True, as_list=True) == ["a", "b"]
+    device.close_shell_session()
+    assert not session.alive
+
+
+def test_stat_many(monkeypatch, tmp_path):
+    (tmp_path / "file").write_bytes(b"12345")
+    (tmp_path / "dir").mkdir()
+    (tmp_path / "link").symlink_to(tmp_path / "file")
+    (tmp_path / "it's").write_bytes(b"")
+    scripts = []
+    def shell_command(self, script, return_output=True, as_list=False):
+        self._forget_stats([script])
+        scripts.append(script)
+        return subprocess.run(["sh", "-c", script], stdout=subprocess.PIPE,
+                              universal_newlines=True).stdout.splitlines()
+
+    monkeypatch.setattr(Device, "shell_command", shell_command)
+    device = Device("serial")
+    paths = [str(tmp_path / x) for x in ("file", "dir", "link", "missing", "it's")]
+    stats = device.stat_many(paths)
+    assert list(stats) == paths
+    assert len(scripts) == 1
+
+    path_file, path_dir, path_link, path_missing, path_quoted = stats.values()
+    assert path_file.exists and path_file.type == "file" and not path_file.link
+    assert path_file.size == 5 and path_file.read and path_file.write
+    assert path_dir.type == "dir" and path_dir.execute
+    assert path_link.link and path_link.type == "file" and path_link.size == 5
+    assert not path_missing.exists and path_missing.type is None
+    assert path_quoted.exists
+
+    # results are cached until a command changing files is run
+    assert device.is_file(paths[0]) == 1
+    assert device.is_dir(paths[1]) == 1
+    assert device.is_dir(paths[0]) == -1
+    assert device.is_file(paths[2], symlink_ok=False) == -2
+    assert device.is_file(paths[3]) == 0
+    assert len(scripts) == 1
+    device.shell_command("ls 2>/dev/null")
+    device.stat_many([str(tmp_path / "other")])
+    device.stat_many(paths)
+    assert len(scripts) == 3
+    device.shell_command(f"rm {paths[3]}")
+    device.stat_many(paths[:1])
+    assert len(scripts) == 5
+    assert device.stat_many(paths[:1])
+    device.shell_command(f"echo 1 > {paths[3]}")
+    device.stat_many(paths[:1])
+    assert len(scripts) == 7
+
+    # long lists are split into several scripts
+    many = [str(tmp_path / f"missing_{x}") for x in range(300)]
+    assert not any(x.exists for x in device.stat_many(many).values())
+    assert all(len(x) <= helper.extract_data.BATCH_MAX_LENGTH for x in scripts)
+
+
+def test_glob(monkeypatch, tmp_path):
+    for path in ("a/x1.txt", "a/y2.txt", "a/.hidden", "a/b/x3.txt", "a/b/c/x4.log",
+                 "d/x5.txt", "it's/x6.txt"):
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).write_bytes(b"")
+
+    scripts = []
+    def shell_stream(self, script, lines=True):
+        scripts.append(script)
+        process = subprocess.Popen(["sh", "-c", script], stdout=subprocess.PIPE)
+        return helper.iter_lines(process.stdout)
+
+    monkeypatch.setattr(Device, "shell_stream", shell_stream)
+    device = Device("serial")
+    device._extracted_info_groups.append("available_commands")
+    root = str(tmp_path)
+    def glob(*patterns):
+        return sorted(x[len(root) + 1:] for x in device.iglob(*[f"{root}/{x}" for x in patterns]))
+
+    for shell_commands in (["find"], []):
+        device.info_dict["shell_commands"] = shell_commands
+        assert glob("a/*") == ["a/b", "a/x1.txt", "a/y2.txt"]
+        assert glob("a/?1.*", "d/*") == ["a/x1.txt", "d/x5.txt"]
+        assert glob("a/[!x]*.txt") == ["a/y2.txt"]
+        assert glob("*/x[0-9].txt") == ["a/x1.txt", "d/x5.txt", "it's/x6.txt"]
+        assert glob("a/missing*") == []
+    assert len(scripts) == 10
+
+    device.info_dict["shell_commands"] = ["find"]
+    assert glob("a/**/x*") == ["a/b/c/x4.log", "a/b/x3.txt", "a/x1.txt"]
+    assert glob("**/*.log") == ["a/b/c/x4.log"]
+    assert glob("a/**") == ["a/b", "a/b/c", "a/b/c/x4.log", "a/b/x3.txt",
+                            "a/x1.txt", "a/y2.txt"]